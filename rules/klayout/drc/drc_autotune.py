@@ -0,0 +1,216 @@
+# Copyright 2022 GlobalFoundries PDK Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tune the number of threads of each GlobalFoundries 180nm MCU DRC rule deck.
+
+Usage:
+    drc_autotune.py (--help| -h)
+    drc_autotune.py (--path=<file_path>) (--gf180mcu=<combined_options>) [--deck=<deck>]... [--threads=<threads>] [--tolerance=<tolerance>] [--run_mode=<run_mode>] [--topcell=<topcell_name>]
+
+Options:
+    --help -h                           Print this help message.
+    --path=<file_path>                  A representative input GDS file.
+    --gf180mcu=<combined_options>       Select combined options of metal_top, mim_option, and metal_level. Allowed values (A, B, C).
+    --deck=<deck>                       Rule deck to tune, can be repeated. Default is the main, antenna and density decks and all rule_decks shards.
+    --threads=<threads>                 Comma separated thread counts to measure. Default is powers of 2 up to the number of cpus.
+    --tolerance=<tolerance>             Accepted slowdown against the fastest fitted run time when picking fewer threads. [default: 0.05]
+    --run_mode=<run_mode>               Select klayout mode Allowed modes (flat , deep, tiling). [default: flat]
+    --topcell=<topcell_name>            Topcell name to use.
+
+Each deck is run at every thread count and its run times are fitted to t(n) = a + b / n (serial part a,
+parallel part b). The smallest thread count within the tolerance of the fastest fitted time is saved per
+deck and layout size class, the runners use it when --thr isn't given.
+"""
+
+from docopt import docopt
+import os
+import json
+import glob
+import time
+import logging
+import subprocess
+import numpy as np
+
+from drc_catalog import cache_dir
+
+# Layout size classes by GDS file size in bytes
+SIZE_CLASSES = [("small", 10 << 20), ("medium", 200 << 20), ("large", 2 << 30), ("huge", None)]
+
+
+def size_class(gds_path):
+    """
+    Returns the size class of a layout.
+    """
+    size = os.path.getsize(gds_path)
+    for name, limit in SIZE_CLASSES:
+        if limit is None or size < limit:
+            return name
+
+
+def profile_path():
+    return os.path.join(cache_dir("autotune"), "profile.json")
+
+
+def load_profile():
+    """
+    Returns the saved profile {deck: {size class: {threads, a, b, samples}}}.
+    """
+    try:
+        with open(profile_path(), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def tuned_threads(deck, gds_path, default):
+    """
+    Returns the tuned thread count of a deck for a layout, or default if the deck wasn't tuned.
+
+    :param deck: The rule deck path or name
+    :param gds_path: The path to the GDS file to check
+    :param default: The thread count used without a profile
+    :return: The number of threads.
+    """
+    entry = load_profile().get(os.path.basename(deck), {})
+    if not entry or not os.path.exists(gds_path):
+        return default
+    cls = size_class(gds_path)
+    if cls in entry:
+        return entry[cls]["threads"]
+
+    # Fall back to the nearest tuned size class
+    names = [n for n, _ in SIZE_CLASSES]
+    nearest = min(entry, key=lambda c: abs(names.index(c) - names.index(cls)))
+    return entry[nearest]["threads"]
+
+
+def fit_scaling(samples):
+    """
+    Fits the run times to t(n) = a + b / n with least squares.
+
+    :param samples: A list of (threads, seconds)
+    :return: The (a, b) coefficients, both non negative.
+    """
+    n = np.array([s[0] for s in samples], dtype=np.float64)
+    t = np.array([s[1] for s in samples], dtype=np.float64)
+    (a, b), *_ = np.linalg.lstsq(np.stack([np.ones_like(n), 1 / n], axis=1), t, rcond=None)
+    if a < 0:
+        a, b = 0.0, float(np.mean(t * n))
+    if b < 0:
+        a, b = float(np.mean(t)), 0.0
+    return float(a), float(b)
+
+
+def best_threads(a, b, max_threads, tolerance):
+    """
+    Returns the smallest thread count whose fitted time is within tolerance of the fastest one.
+    """
+    fastest = a + b / max_threads
+    for n in range(1, max_threads + 1):
+        if a + b / n <= fastest * (1 + tolerance):
+            return n
+    return max_threads
+
+
+def time_deck(deck, path, threads, switches):
+    """
+    Runs one deck with the given number of threads.
+
+    :return: The wall time in seconds, None if klayout failed.
+    """
+    report = f"/tmp/autotune_{os.getpid()}.lyrdb"
+    t0 = time.time()
+    status = subprocess.run(f"klayout -b -r {deck} -rd input={path} -rd report={report} -rd thr={threads} {switches}", shell=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+    seconds = time.time() - t0
+    if os.path.exists(report):
+        os.remove(report)
+    if status != 0:
+        logging.error(f"{os.path.basename(deck)} with {threads} threads failed with status {status}")
+        return None
+    return seconds
+
+
+def main():
+
+    path = arguments["--path"]
+    if not os.path.exists(path):
+        logging.error("The input GDS file path doesn't exist, please recheck.")
+        exit()
+
+    pdk_root = os.environ['PDK_ROOT']
+    pdk      = os.environ['PDK']
+
+    decks = arguments["--deck"] or ([f"{pdk_root}/{pdk}/gf180mcu.drc", f"{pdk_root}/{pdk}/gf180mcu_antenna.drc", f"{pdk_root}/{pdk}/gf180mcu_density.drc"]
+                                    + sorted(glob.glob(f"{pdk_root}/{pdk}/rule_decks/*.drc")))
+
+    if arguments["--threads"]:
+        threads = sorted({int(n) for n in arguments["--threads"].split(",")})
+    else:
+        threads = [1 << i for i in range(os.cpu_count().bit_length()) if 1 << i <= os.cpu_count()]
+
+    if len(threads) < 2:
+        logging.error("At least two thread counts are needed to fit the scaling curve.")
+        exit()
+
+    # Imported here, run_drc imports this module for tuned_threads
+    from run_drc import build_switches
+    switches = build_switches(dict(arguments, **{"--no_feol": False, "--no_beol": False, "--no_offgrid": False,
+                                                 "--connectivity": False, "--density": True}))
+    if arguments["--topcell"]:
+        switches = switches + f'-rd topcell={arguments["--topcell"]}'
+
+    profile = load_profile()
+    cls = size_class(path)
+
+    failed = []
+    for deck in decks:
+        samples = [(n, time_deck(deck, path, n, switches)) for n in threads]
+        # A crashed run is no timing, the deck keeps its previous profile
+        if any(seconds is None for _, seconds in samples):
+            logging.error(f"{os.path.basename(deck)} isn't tuned, some of its runs failed")
+            failed.append(os.path.basename(deck))
+            continue
+        a, b = fit_scaling(samples)
+        best = best_threads(a, b, threads[-1], float(arguments["--tolerance"]))
+        serial = a / (a + b) if a + b > 0 else 1.0
+        logging.info(f"{os.path.basename(deck)}: t(n) = {a:.1f} + {b:.1f}/n s, serial fraction {serial:.0%}, best {best} threads")
+
+        profile.setdefault(os.path.basename(deck), {})[cls] = {"threads": best, "a": a, "b": b, "samples": samples,
+                                                                "layout": os.path.abspath(path), "date": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+        # Saved after each deck, an interrupted run keeps the decks already tuned
+        with open(profile_path(), "w") as f:
+            json.dump(profile, f, indent=1)
+
+    logging.info(f"Thread profile of {cls} layouts saved at {profile_path()}")
+    if failed:
+        logging.error(f"Decks not tuned because of failed runs: {failed}")
+        exit(1)
+
+# ================================================================
+# -------------------------- MAIN --------------------------------
+# ================================================================
+
+if __name__ == "__main__":
+
+    # logs format
+    logging.basicConfig(level=logging.DEBUG, format=f"%(asctime)s | %(levelname)-7s | %(message)s", datefmt='%d-%b-%Y %H:%M:%S')
+
+    # arguments
+    arguments = docopt(__doc__, version='DRC AUTOTUNE: 0.1')
+
+    # Calling main function
+    main()
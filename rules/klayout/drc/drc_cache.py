@@ -0,0 +1,297 @@
+# Copyright 2022 GlobalFoundries PDK Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Whole-run cache of GlobalFoundries 180nm MCU DRC results.
+
+Usage:
+    drc_cache.py (--help| -h)
+    drc_cache.py status
+    drc_cache.py clear
+
+Options:
+    --help -h                           Print this help message.
+
+A run is keyed by the hash of the input layout, of the rule decks it runs and the
+ruby files they load, of the full switches string and of the klayout version. The
+lyrdb files of a finished run are stored gzipped under that key, a later run with
+the same key gets them back without starting klayout. The connectivity databases (L2N) extracted by the connectivity
+rules are kept next to the runs, keyed by layout, top cell and main deck, and so are the
+marker layouts of the regression (testing/run_regression.py). Each store is
+bounded in size (GF180MCU_DRC_CACHE_SIZE in MB, default 2048), the least recently used
+entries are dropped first.
+"""
+
+from docopt import docopt
+import os
+import re
+import gzip
+import json
+import time
+import shutil
+import hashlib
+import threading
+import logging
+
+from drc_catalog import cache_dir, file_hash
+
+# Bump when the stored run layout changes, old entries are then ignored
+RUN_CACHE_VERSION = 1
+
+DEFAULT_CACHE_SIZE_MB = 2048
+
+# Ruby files loaded by the rule decks from the PDK, e.g. utils/bounded_output.rb
+DECK_LOAD = re.compile(r'load\(File\.join\(ENV\["PDK_ROOT"\], ENV\["PDK"\], ((?:"[^"]+",\s*)*"[^"]+")\)\)')
+
+
+def runs_dir():
+    return cache_dir("runs")
+
+
+def max_cache_bytes():
+    return int(os.environ.get("GF180MCU_DRC_CACHE_SIZE", DEFAULT_CACHE_SIZE_MB)) << 20
+
+
+def deck_loads(deck_path):
+    """
+    Returns the paths of the ruby files a rule deck loads from the PDK.
+    """
+    with open(deck_path, "r") as f:
+        parts = DECK_LOAD.findall(f.read())
+    pdk_dir = os.path.join(os.environ.get("PDK_ROOT", ""), os.environ.get("PDK", ""))
+    return sorted({os.path.join(pdk_dir, *re.findall(r'"([^"]+)"', p)) for p in parts})
+
+
+def run_key(gds_path, decks, switches, klayout_version):
+    """
+    Returns the cache key of a DRC run.
+
+    :param gds_path: The path to the GDS file
+    :param decks: The rule deck paths run on the layout
+    :param switches: The switches string passed to the rule decks
+    :param klayout_version: The klayout version string
+    :return: The hex digest keying the run.
+    """
+    h = hashlib.sha1()
+    h.update(f"{RUN_CACHE_VERSION}\n{klayout_version.strip()}\n".encode())
+    h.update(f"{file_hash(gds_path)}\n".encode())
+    for deck in sorted(decks):
+        h.update(f"{os.path.basename(deck)}={file_hash(deck)}\n".encode())
+        # The files a deck loads change its results as much as the deck itself
+        for path in deck_loads(deck):
+            digest = file_hash(path) if os.path.exists(path) else "missing"
+            h.update(f"{os.path.basename(path)}={digest}\n".encode())
+    # Switch order and spacing don't change the run
+    h.update(" ".join(sorted(switches.replace("-rd ", "-rd=").split())).encode())
+    return h.hexdigest()
+
+
+def lookup(key, outputs):
+    """
+    Restores the lyrdb files of a cached run.
+
+    :param key: The run key
+    :param outputs: A dict of {name: lyrdb path} to restore the stored files to
+    :return: The list of restored names, None if the run isn't cached.
+    """
+    entry = os.path.join(runs_dir(), key)
+    meta_path = os.path.join(entry, "meta.json")
+    try:
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    restored = []
+    for name in meta["files"]:
+        if name not in outputs:
+            continue
+        with gzip.open(os.path.join(entry, f"{name}.lyrdb.gz"), "rb") as src, open(outputs[name], "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        restored.append(name)
+
+    # Recently used entries are kept longest
+    os.utime(meta_path)
+    return restored
+
+
+def store(key, outputs, info=None):
+    """
+    Stores the lyrdb files of a finished run, then bounds the store size.
+
+    :param key: The run key
+    :param outputs: A dict of {name: lyrdb path}, missing files are skipped
+    :param info: Extra fields saved in the entry meta data
+    """
+    root = runs_dir()
+    tmp = os.path.join(root, f".{key}.{os.getpid()}")
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    files = []
+    for name, path in outputs.items():
+        if not os.path.exists(path):
+            continue
+        with open(path, "rb") as src, gzip.open(os.path.join(tmp, f"{name}.lyrdb.gz"), "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        files.append(name)
+
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump(dict(info or {}, files=files, date=time.strftime("%Y-%m-%d %H:%M:%S")), f, indent=1)
+
+    # Entries appear whole, a concurrent run with the same key just keeps its own copy
+    entry = os.path.join(root, key)
+    shutil.rmtree(entry, ignore_errors=True)
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    prune(max_cache_bytes())
+
+
+def entries():
+    """
+    Returns the cached runs as a list of (key, size in bytes, last use time), oldest first.
+    """
+    root = runs_dir()
+    result = []
+    for key in os.listdir(root):
+        entry = os.path.join(root, key)
+        meta_path = os.path.join(entry, "meta.json")
+        if key.startswith(".") or not os.path.exists(meta_path):
+            continue
+        size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+        result.append((key, size, os.path.getmtime(meta_path)))
+    return sorted(result, key=lambda e: e[2])
+
+
+def prune(max_bytes):
+    """
+    Drops the least recently used runs until the store fits in max_bytes.
+    """
+    runs = entries()
+    total = sum(e[1] for e in runs)
+    for key, size, _ in runs:
+        if total <= max_bytes:
+            break
+        shutil.rmtree(os.path.join(runs_dir(), key), ignore_errors=True)
+        total -= size
+
+
+def l2n_path(gds_path, topcell, deck):
+    """
+    Returns the path of the saved connectivity database (L2N) of a layout.
+
+    The connectivity rules of the decks save their extracted nets there (-rd l2n_out) and later
+    runs with the same layout, top cell and main deck load them (-rd l2n_in) instead of extracting again.
+
+    :param gds_path: The path to the GDS file
+    :param topcell: The checked top cell
+    :param deck: The main rule deck path, it defines the connectivity
+    :return: The L2N file path, it may not exist yet.
+    """
+    h = hashlib.sha1(f"{RUN_CACHE_VERSION}\n{file_hash(gds_path)}\n{topcell}\n{file_hash(deck)}".encode())
+    return os.path.join(cache_dir("l2n"), f"{h.hexdigest()}.l2n")
+
+
+def store_l2n(tmp_path, path):
+    """
+    Moves a freshly written connectivity database in place, then bounds the L2N store size.
+    """
+    os.replace(tmp_path, path)
+    _prune_files(cache_dir("l2n"), ".l2n")
+
+
+def marker_path(gds_path, marker_deck, switches, klayout_version):
+    """
+    Returns the path of the cached marker layout of a regression testcase.
+
+    The marker pass of the regression runs the generated marker deck on a testcase and writes
+    the rule results as layers of a copy of the testcase, which only depends on these inputs.
+
+    :param gds_path: The path to the testcase GDS file
+    :param marker_deck: The path of the generated marker deck (markers.drc)
+    :param switches: The switches string passed to the marker deck
+    :param klayout_version: The output of klayout -v
+    :return: The GDS file path, it may not exist yet.
+    """
+    h = hashlib.sha1(f"{RUN_CACHE_VERSION}\n{klayout_version.strip()}\n{file_hash(gds_path)}\n{file_hash(marker_deck)}\n".encode())
+    h.update(" ".join(sorted(switches.replace("-rd ", "-rd=").split())).encode())
+    return os.path.join(cache_dir("markers"), f"{h.hexdigest()}.gds")
+
+
+def store_marker(gds_path, path):
+    """
+    Copies a freshly generated marker layout in the cache, then bounds the marker store size.
+    """
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}"
+    shutil.copyfile(gds_path, tmp)
+    os.replace(tmp, path)
+    _prune_files(cache_dir("markers"), ".gds")
+
+
+# Concurrent regression pairs store their markers from threads of one process
+_prune_lock = threading.Lock()
+
+
+def _prune_files(root, ext):
+    with _prune_lock:
+        files = sorted((os.path.join(root, f) for f in os.listdir(root) if f.endswith(ext)), key=os.path.getmtime)
+        total = sum(os.path.getsize(f) for f in files)
+        for f in files:
+            if total <= max_cache_bytes():
+                break
+            total -= os.path.getsize(f)
+            os.remove(f)
+
+
+def clear():
+    """
+    Drops all cached runs, connectivity databases and regression layouts and decks.
+    """
+    shutil.rmtree(runs_dir(), ignore_errors=True)
+    shutil.rmtree(cache_dir("l2n"), ignore_errors=True)
+    shutil.rmtree(cache_dir("markers"), ignore_errors=True)
+    shutil.rmtree(cache_dir("micro"), ignore_errors=True)
+    shutil.rmtree(cache_dir("micro_decks"), ignore_errors=True)
+
+
+def main():
+
+    if arguments["clear"]:
+        clear()
+        logging.info("DRC run cache cleared.")
+        return
+
+    runs = entries()
+    total = sum(e[1] for e in runs)
+    for key, size, used in runs:
+        print(f"{key}  {size / (1 << 20):8.1f} MB  last used {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(used))}")
+    logging.info(f"{len(runs)} cached runs, {total / (1 << 20):.1f} MB of {max_cache_bytes() >> 20} MB in {runs_dir()}")
+
+# ================================================================
+# -------------------------- MAIN --------------------------------
+# ================================================================
+
+if __name__ == "__main__":
+
+    # logs format
+    logging.basicConfig(level=logging.DEBUG, format=f"%(asctime)s | %(levelname)-7s | %(message)s", datefmt='%d-%b-%Y %H:%M:%S')
+
+    # arguments
+    arguments = docopt(__doc__, version='DRC CACHE: 0.1')
+
+    # Calling main function
+    main()
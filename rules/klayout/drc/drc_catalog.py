@@ -0,0 +1,536 @@
+# Copyright 2022 GlobalFoundries PDK Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Rule catalog of the GlobalFoundries 180nm MCU DRC rule decks.
+
+Each deck is parsed once into its rules (one entry per `.output` statement) with
+their description, section, switch guards, input layers and the derived layers
+they depend on. The parsed catalog is cached as JSON keyed by the deck hash, so
+the runners and the regression scripts share one parse of the decks.
+"""
+
+import os
+import re
+import json
+import hashlib
+
+# Bump when the parsed structure changes, old cache entries are then ignored
+CATALOG_VERSION = 2
+
+# Bump when prune_deck writes different decks, pruned decks cached with it are then regenerated
+PRUNE_VERSION = 2
+
+OUTPUT = re.compile(r'\.output\(\s*"([^"]+)"\s*(?:,\s*"((?:[^"\\]|\\.)*)")?')
+BASE_LAYER = re.compile(r"^\s*(\w+)\s*=\s*(?:polygons|input|labels)\(\s*(\d+)\s*,\s*(\d+)\s*\)")
+ASSIGN = re.compile(r"^\s*(\w+(?:\s*,\s*\w+)*)\s*=(?!=)\s*(.+)$")
+IDENT = re.compile(r"(?<![.\w$@:])([a-z_]\w*)\b")
+STRING = re.compile(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'')
+BANNER = re.compile(r"^#-{2,}\s*(.*?)\s*-{2,}\s*$")
+RULE_START = re.compile(r"^\s*(?:# Rule |logger\.info\(\"Executing rule )")
+FORGET = re.compile(r"^\s*\w+\.forget\s*$")
+BLOCK_VARS = re.compile(r"\bdo\s*\|([^|]*)\|\s*$")
+INSERT = re.compile(r"(?<![.\w])(\w+)\.data\.insert\(")
+SWITCH = re.compile(r"-rd\s+(\w+)=(\S+)")
+COUNT_SUM = re.compile(r"^\s*(\w+_count)\s*=\s*\1\s*\+\s*(\w+_count)\s*$")
+CONNECT = re.compile(r"^\s*connect(?:_global|_implicit)?\(")
+
+
+def cache_dir(*parts):
+    """
+    Returns (and creates) a directory of the shared DRC cache.
+
+    The cache lives in ~/.cache/gf180mcu_drc unless GF180MCU_DRC_CACHE is set.
+
+    :param parts: Sub directories inside the cache
+    :return: The directory path.
+    """
+    root = os.environ.get("GF180MCU_DRC_CACHE") or os.path.join(os.path.expanduser("~"), ".cache", "gf180mcu_drc")
+    path = os.path.join(root, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+# sha1 of the files hashed by this process, keyed by (path, modification time, size)
+_file_hashes = {}
+
+
+def file_hash(path):
+    """
+    Returns the sha1 of a file content, each version of a file is only read once per process.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if key not in _file_hashes:
+        h = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        _file_hashes[key] = h.hexdigest()
+    return _file_hashes[key]
+
+
+def _code(line):
+    # Blank string literals and drop comments, columns still match the original line
+    line = STRING.sub(lambda m: m.group(0)[0] + " " * (len(m.group(0)) - 2) + m.group(0)[-1], line)
+    return line.split("#", 1)[0]
+
+
+def parse_deck(deck_path):
+    """
+    Parses one rule deck.
+
+    :param deck_path: The path to the rule deck
+    :return: A dict with deck, hash, sections [(name, first line, last line)], layers {name: [layer, datatype]},
+             derived {name: [definition lines]}, connects, a list of {line, guards, inputs} of the connectivity
+             statements, and rules, a list of rule dicts in deck order.
+    """
+    with open(deck_path, "r") as f:
+        lines = f.read().split("\n")
+
+    sections = []
+    layers = {}
+    defs = {}
+    outputs = []
+    connects = []
+    stack = []
+    frames = 0
+
+    def guards_of():
+        guards = []
+        for kind, previous, condition, _, _ in stack:
+            if kind != "if":
+                continue
+            if condition is not None:
+                guards.append(condition)
+            else:
+                guards.append("!(" + " || ".join(previous) + ")")
+        return guards
+
+    def branch_of():
+        # The if branches enclosing a line, a definition dominates a use if its branches are a subset
+        return frozenset((frame[3], frame[4]) for frame in stack if frame[0] == "if")
+
+    for num, line in enumerate(lines, 1):
+        banner = BANNER.match(line)
+        if banner and banner.group(1) and num > 1 and lines[num - 2].startswith("#===="):
+            if sections:
+                sections[-1][2] = num - 2
+            sections.append([banner.group(1), num - 1, len(lines)])
+            continue
+
+        code = _code(line)
+        stripped = code.strip()
+        source = line[:len(code)].strip()
+        if not stripped:
+            continue
+
+        # Block structure, only if/elsif/else branches become guards
+        word = re.match(r"(\w+)", stripped)
+        word = word.group(1) if word else ""
+        if word == "if":
+            frames += 1
+            stack.append(["if", [], source[2:].strip(), frames, 0])
+        elif word == "elsif" and stack and stack[-1][0] == "if":
+            stack[-1][1].append(stack[-1][2])
+            stack[-1][2] = source[5:].strip()
+            stack[-1][4] += 1
+        elif word == "else" and stack and stack[-1][0] == "if":
+            stack[-1][1].append(stack[-1][2])
+            stack[-1][2] = None
+            stack[-1][4] += 1
+        elif word == "end":
+            if stack:
+                stack.pop()
+            continue
+        elif word in ("def", "case", "begin", "unless", "while"):
+            stack.append([word, [], None, 0, 0])
+        elif re.search(r"\bdo\s*(\|[^|]*\|)?\s*$", stripped):
+            stack.append(["do", [], None, 0, 0])
+
+        if any(frame[0] == "def" for frame in stack):
+            continue
+
+        base = BASE_LAYER.match(code)
+        if base:
+            layers[base.group(1)] = [int(base.group(2)), int(base.group(3))]
+            defs.setdefault(base.group(1), []).append((num, [], branch_of()))
+            continue
+
+        assign = ASSIGN.match(code)
+        if assign and word not in ("if", "elsif"):
+            ids = IDENT.findall(assign.group(2))
+            for name in re.split(r"\s*,\s*", assign.group(1).strip()):
+                defs.setdefault(name, []).append((num, ids, branch_of()))
+
+        # Block variables come from the receiver, e.g. layer.data.each do |p|
+        block = BLOCK_VARS.search(code)
+        if block:
+            ids = IDENT.findall(code[:block.start()])
+            for name in re.split(r"\s*,\s*", block.group(1).strip()):
+                defs.setdefault(name, []).append((num, ids, branch_of()))
+
+        # Layers filled in place, e.g. violations.data.insert(p)
+        for name in INSERT.findall(code):
+            defs.setdefault(name, []).append((num, IDENT.findall(code), branch_of()))
+
+        # Connectivity statements read layers outside of the rule expressions
+        if CONNECT.match(code):
+            connects.append((num, guards_of(), IDENT.findall(code), branch_of()))
+
+        for match in OUTPUT.finditer(line):
+            expr = code[:code.find(".output")]
+            outputs.append((num, match.group(1), (match.group(2) or "").replace('\\"', '"'), guards_of(),
+                            IDENT.findall(expr), branch_of()))
+
+    def section_of(num):
+        for name, start, end in sections:
+            if start <= num <= end:
+                return name
+        return ""
+
+    memo = {}
+
+    def resolve(name, before, branch):
+        # Definitions of name above the line using it, back to the first one dominating the use.
+        # Definitions in other if branches (e.g. per METAL_LEVEL) may all reach the use.
+        key = (name, before, branch)
+        if key in memo:
+            return memo[key]
+        memo[key] = set()
+        found = set()
+        for line, ids, def_branch in reversed([d for d in defs.get(name, ()) if d[0] < before]):
+            found.add((name, line))
+            for ident in ids:
+                if ident in defs:
+                    found |= resolve(ident, line, def_branch)
+            if def_branch <= branch:
+                break
+        memo[key] = found
+        return found
+
+    rules = []
+    prev_end = 0
+    for index, (num, name, description, guards, ids, branch) in enumerate(outputs):
+        start = prev_end + 1
+        for i in range(prev_end + 1, num + 1):
+            if RULE_START.match(lines[i - 1]):
+                start = i
+                break
+        end = num
+        while end < len(lines) and FORGET.match(lines[end]):
+            end += 1
+        prev_end = end
+
+        found = set()
+        for ident in ids:
+            found |= resolve(ident, num, branch)
+        inputs = sorted({n for n, _ in found if n in layers})
+        derived = sorted({n for n, _ in found if n not in layers})
+        dep_lines = sorted({line for _, line in found})
+
+        rules.append({"name": name, "description": description, "deck": os.path.basename(deck_path),
+                      "index": index, "section": section_of(num), "lines": [start, end], "output_line": num,
+                      "guards": guards, "inputs": inputs,
+                      "input_layers": sorted({tuple(layers[n]) for n in inputs}), "derived": derived,
+                      "dep_lines": dep_lines})
+
+    connect_list = []
+    for num, guards, ids, branch in connects:
+        found = set()
+        for ident in ids:
+            found |= resolve(ident, num, branch)
+        connect_list.append({"line": num, "guards": guards, "inputs": sorted({n for n, _ in found if n in layers})})
+
+    derived_defs = {n: [d[0] for d in ds] for n, ds in defs.items() if n not in layers}
+    return {"version": CATALOG_VERSION, "deck": os.path.basename(deck_path), "path": os.path.abspath(deck_path),
+            "hash": file_hash(deck_path), "sections": sections, "layers": layers, "derived": derived_defs,
+            "connects": connect_list, "rules": rules}
+
+
+def load_deck(deck_path):
+    """
+    Returns the parsed catalog of a rule deck, from the cache if the deck didn't change.
+
+    :param deck_path: The path to the rule deck
+    :return: The dict returned by parse_deck.
+    """
+    digest = file_hash(deck_path)
+    cached = os.path.join(cache_dir("catalog"), f"{digest}.json")
+
+    if os.path.exists(cached):
+        try:
+            with open(cached, "r") as f:
+                catalog = json.load(f)
+            if catalog.get("version") == CATALOG_VERSION:
+                catalog["path"] = os.path.abspath(deck_path)
+                return catalog
+        except (ValueError, OSError):
+            pass
+
+    catalog = parse_deck(deck_path)
+    tmp = f"{cached}.{os.getpid()}"
+    with open(tmp, "w") as f:
+        json.dump(catalog, f)
+    os.replace(tmp, cached)
+    return catalog
+
+
+def get_rules(decks, skip_sections=()):
+    """
+    Returns the rules of the given decks in deck order, one entry per `.output` statement.
+
+    :param decks: A list of rule deck paths
+    :param skip_sections: Section names whose rules are left out, e.g. ("GEOMETRY RULES",)
+    :return: A list of rule dicts.
+    """
+    rules = []
+    for deck in decks:
+        rules += [r for r in load_deck(deck)["rules"] if r["section"] not in skip_sections]
+    return rules
+
+
+def rule_names(decks, skip_sections=()):
+    """
+    Returns the unique rule names of the given decks in deck order.
+
+    :param decks: A list of rule deck paths
+    :param skip_sections: Section names whose rules are left out
+    :return: A list of rule names.
+    """
+    names = []
+    seen = set()
+    for rule in get_rules(decks, skip_sections):
+        if rule["name"] not in seen:
+            seen.add(rule["name"])
+            names.append(rule["name"])
+    return names
+
+
+def switch_values(switches):
+    """
+    Returns the values of the deck switch constants for the given klayout variables,
+    as set in the SWITCHES sections of the decks.
+
+    :param switches: A dict of the -rd variables, e.g. {"feol": "true", "metal_top": "9K"}
+    :return: A dict of {constant: value}.
+    """
+    return {"FEOL": switches.get("feol") != "false",
+            "BEOL": switches.get("beol") != "false",
+            "CONNECTIVITY_RULES": switches.get("conn_drc") == "true",
+            "OFFGRID": switches.get("offgrid") != "false",
+            "METAL_TOP": switches.get("metal_top", "9K"),
+            "METAL_LEVEL": switches.get("metal_level", "6LM"),
+            "MIM_OPTION": switches.get("mim_option", "Nan"),
+            "WEDGE": switches.get("wedge", "true"),
+            "BALL": switches.get("ball", "true"),
+            "GOLD": switches.get("gold", "true")}
+
+
+def guard_enabled(guards, switches):
+    """
+    Evaluates the switch guards of a rule.
+
+    Guards that can't be evaluated from the switches alone (e.g. data dependent
+    conditions) count as enabled.
+
+    :param guards: The guards of a rule, e.g. ["BEOL", 'METAL_TOP == "6K"']
+    :param switches: A dict of the -rd variables
+    :return: True if the rule runs with these switches.
+    """
+    env = switch_values(switches)
+    for name, value in switches.items():
+        env[f"_rd_{name}"] = value
+
+    for guard in guards:
+        expr = re.sub(r"\$(\w+)", lambda m: f"_rd_{m.group(1)}", guard)
+        expr = expr.replace("||", " or ").replace("&&", " and ").replace("!(", " not (")
+        try:
+            if not eval(expr, {"__builtins__": {}}, dict(env, **{"nil": None, "true": True, "false": False})):
+                return False
+        except Exception:
+            continue
+    return True
+
+
+def needed_layers(decks, switches):
+    """
+    Returns the GDS layers read by the rules and connectivity enabled with the given switches.
+
+    :param decks: A list of rule deck paths
+    :param switches: A dict of the -rd variables
+    :return: A sorted list of (layer, datatype) tuples.
+    """
+    needed = set()
+    for deck in decks:
+        catalog = load_deck(deck)
+        layers = catalog["layers"]
+        for item in catalog["rules"] + catalog["connects"]:
+            if guard_enabled(item["guards"], switches):
+                needed |= {tuple(layers[n]) for n in item["inputs"]}
+    return sorted(needed)
+
+
+def parse_switches(switches):
+    """
+    Converts a klayout switches string into a dict of its variables.
+
+    :param switches: The switches string, e.g. "-rd feol=true -rd beol=false"
+    :return: A dict of {name: value}.
+    """
+    return dict(SWITCH.findall(switches))
+
+
+def layers_switch(decks, switches):
+    """
+    Returns the klayout switch loading only the layers needed by the decks with these switches.
+
+    :param decks: A list of rule deck paths
+    :param switches: The switches string passed to the decks
+    :return: The switch string, e.g. "-rd layers=22/0,34/0 ", empty if no layer is needed.
+    """
+    layers = needed_layers(decks, parse_switches(switches))
+    if not layers:
+        return ""
+    return "-rd layers=" + ",".join(f"{l}/{d}" for l, d in layers) + " "
+
+
+def undefined_reads(deck_path, names):
+    """
+    Returns the names a rule deck reads without ever defining them, e.g. after a wrong prune.
+
+    :param deck_path: The path to the rule deck
+    :param names: The names to check, e.g. the derived and base layers of the unpruned deck
+    :return: A dict of {name: first line reading it}.
+    """
+    with open(deck_path, "r") as f:
+        lines = f.read().split("\n")
+
+    defined = set()
+    reads = {}
+    for num, line in enumerate(lines, 1):
+        code = _code(line)
+        block = BLOCK_VARS.search(code)
+        if block:
+            defined |= {v.strip() for v in block.group(1).split(",")}
+        assign = ASSIGN.match(code)
+        if assign:
+            defined |= {v.strip() for v in assign.group(1).split(",")}
+            code = assign.group(2)
+        for name in IDENT.findall(code):
+            if name in names:
+                reads.setdefault(name, num)
+    return {name: num for name, num in reads.items() if name not in defined}
+
+
+def prune_deck(deck_path, keep, output, prune_layers=False):
+    """
+    Writes a copy of a rule deck running only some of its rules.
+
+    The blocks of the other rules are left out, and so are the derivations (and their
+    forget statements) that no remaining line reads anymore.
+
+    :param deck_path: The path to the rule deck
+    :param keep: The names of the rules to keep
+    :param output: The path of the pruned deck
+    :param prune_layers: Also leave out the layer reads no remaining line uses, with their polygon counts
+    :return: The names of the left out rules.
+    """
+    catalog = load_deck(deck_path)
+    with open(deck_path, "r") as f:
+        lines = f.read().split("\n")
+
+    drop = set()
+    skipped = []
+    for rule in catalog["rules"]:
+        if rule["name"] not in keep:
+            drop |= set(range(rule["lines"][0], rule["lines"][1] + 1))
+            if rule["name"] not in skipped:
+                skipped.append(rule["name"])
+
+    defined = dict(catalog["derived"])
+    if prune_layers:
+        for num, line in enumerate(lines, 1):
+            base = BASE_LAYER.match(_code(line))
+            if base:
+                defined.setdefault(base.group(1), []).append(num)
+
+    # Lines reading each defined layer, apart from its definitions and forget statements
+    line_names = {}
+    for name, def_lines in defined.items():
+        for num in def_lines:
+            line_names.setdefault(num, set()).add(name)
+    reads = {}
+    forgets = {}
+    counts = {}
+    for num, line in enumerate(lines, 1):
+        code = _code(line)
+        if FORGET.match(code):
+            forgets.setdefault(code.split(".")[0].strip(), []).append(num)
+            continue
+        # Polygon count totals (total = total + layer_count) only log, they don't keep a layer count
+        count = COUNT_SUM.match(code)
+        if count and prune_layers:
+            counts[num] = count.group(2)
+            continue
+        # Whole line, names read in string interpolations or only named in comments are kept.
+        # Inserting into a layer (x.data.insert) needs it defined, so it reads it too.
+        inserted = set(INSERT.findall(code))
+        names = {n for n in re.findall(r"\w+", line) if n in defined and (num not in defined[n] or n in inserted)}
+        if names:
+            reads[num] = names
+    live = {name: 0 for name in defined}
+    for num, names in reads.items():
+        if num not in drop:
+            for name in names:
+                live[name] += 1
+
+    # Definitions in left out rule blocks that are still read further down are kept
+    todo = [num for num, names in line_names.items() if num in drop and any(live[n] for n in names)]
+    while todo:
+        num = todo.pop()
+        if num not in drop:
+            continue
+        drop.discard(num)
+        for name in reads.get(num, ()):
+            live[name] += 1
+            todo += [n for n in defined[name] if n in drop]
+
+    # Derivations read by no remaining line go too, which may free the layers they read
+    def droppable(num):
+        code = _code(lines[num - 1])
+        # Only layers, the switch constants are read in guards
+        return (num not in drop and (ASSIGN.match(code) or BASE_LAYER.match(code))
+                and not re.search(r"\bdo\b|[(\[{,]\s*$", code)
+                and all(IDENT.fullmatch(n) and not live[n] for n in line_names[num]))
+
+    todo = list(line_names)
+    while todo:
+        num = todo.pop()
+        if not droppable(num):
+            continue
+        drop.add(num)
+        for name in reads.get(num, ()):
+            live[name] -= 1
+            if live[name] == 0:
+                todo += defined[name]
+
+    dropped = {name for name, def_lines in defined.items() if set(def_lines) <= drop}
+    for name in dropped:
+        drop |= set(forgets.get(name, ()))
+    drop |= {num for num, name in counts.items() if name in dropped}
+
+    with open(output, "w") as f:
+        f.write("\n".join(line for num, line in enumerate(lines, 1) if num not in drop))
+    return skipped
@@ -0,0 +1,254 @@
+# Copyright 2022 GlobalFoundries PDK Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compare two GlobalFoundries 180nm MCU DRC results.
+
+Usage:
+    drc_diff.py (--help| -h)
+    drc_diff.py (--old=<old_lyrdb>) (--new=<new_lyrdb>) [--output=<output_name>] [--tolerance=<tolerance>] [--grid=<grid>] [--keep_unchanged]
+
+Options:
+    --help -h                           Print this help message.
+    --old=<old_lyrdb>                   The lyrdb of the previous (baseline) DRC run.
+    --new=<new_lyrdb>                   The lyrdb of the current DRC run.
+    --output=<output_name>              Output name of the diff lyrdb and summary csv. [default: drc_diff]
+    --tolerance=<tolerance>             Max. shift in um of each marker bbox edge to be considered unchanged. [default: 0]
+    --grid=<grid>                       Bucket size in um of the spatial index. [default: 10]
+    --keep_unchanged                    Write unchanged markers to the diff lyrdb too.
+"""
+
+from docopt import docopt
+import os
+import csv
+import math
+import logging
+
+from drc_lyrdb import read_header, iter_items, value_bbox, LyrdbWriter
+
+# Float slack for coordinates written with limited precision
+EPS = 1e-6
+
+
+class MarkerIndex:
+    """
+    Per rule and cell grid hash of marker bounding boxes.
+
+    Every marker is stored in the bucket of its bbox center, a query within the
+    tolerance only has to look at the neighbouring buckets. Consumed markers are
+    dropped from their buckets, so matching stays linear in the number of markers.
+    Markers without geometry only match markers with the same values.
+
+    :param grid: The bucket size in um
+    :param tolerance: The max. shift in um of each bbox edge for a match
+    """
+
+    def __init__(self, grid, tolerance):
+        self.grid = max(grid, 2 * tolerance, EPS)
+        self.tolerance = tolerance + EPS
+        self.reach = int(math.ceil(self.tolerance / self.grid))
+        # Buckets are dicts used as ordered sets of marker indices
+        self.buckets = {}
+        self.exact = {}
+        self.markers = []
+        self.remaining = []
+
+    def _key(self, rule, cell, bbox):
+        return rule, cell, int((bbox[0] + bbox[2]) / 2 // self.grid), int((bbox[1] + bbox[3]) / 2 // self.grid)
+
+    def add(self, rule, cell, values, bbox, multiplicity=1):
+        """
+        Adds one marker item to the index, bbox is None for markers without geometry.
+        """
+        i = len(self.markers)
+        self.exact.setdefault((rule, cell, tuple(values)), {})[i] = None
+        if bbox is not None:
+            self.buckets.setdefault(self._key(rule, cell, bbox), {})[i] = None
+        self.markers.append((rule, cell, values, bbox))
+        self.remaining.append(multiplicity)
+
+    @staticmethod
+    def _drop(table, key, i):
+        entries = table[key]
+        del entries[i]
+        if not entries:
+            del table[key]
+
+    def _take(self, i, wanted):
+        count = min(self.remaining[i], wanted)
+        self.remaining[i] -= count
+        if self.remaining[i] == 0:
+            rule, cell, values, bbox = self.markers[i]
+            self._drop(self.exact, (rule, cell, tuple(values)), i)
+            if bbox is not None:
+                self._drop(self.buckets, self._key(rule, cell, bbox), i)
+        return count
+
+    def _near(self, rule, cell, bbox):
+        _, _, kx, ky = self._key(rule, cell, bbox)
+        for dx in range(-self.reach, self.reach + 1):
+            for dy in range(-self.reach, self.reach + 1):
+                for i in self.buckets.get((rule, cell, kx + dx, ky + dy), ()):
+                    obox = self.markers[i][3]
+                    if all(abs(a - b) <= self.tolerance for a, b in zip(obox, bbox)):
+                        yield i
+
+    def match(self, rule, cell, values, bbox, multiplicity=1):
+        """
+        Consumes unmatched markers of the same rule and cell within the tolerance, exact values first.
+
+        :return: The number of markers of the item that were matched, at most multiplicity.
+        """
+        matched = 0
+        for i in list(self.exact.get((rule, cell, tuple(values)), ())):
+            if matched == multiplicity:
+                break
+            matched += self._take(i, multiplicity - matched)
+
+        if matched == multiplicity or bbox is None:
+            return matched
+
+        # Consumed markers leave the buckets, so collect the hits before taking them
+        hits = []
+        wanted = multiplicity - matched
+        for i in self._near(rule, cell, bbox):
+            hits.append(i)
+            wanted -= self.remaining[i]
+            if wanted <= 0:
+                break
+        for i in hits:
+            matched += self._take(i, multiplicity - matched)
+        return matched
+
+    def unmatched(self):
+        """
+        Yields the (rule, cell, values, multiplicity) of the markers left unmatched.
+        """
+        for i, remaining in enumerate(self.remaining):
+            if remaining > 0:
+                rule, cell, values, _ = self.markers[i]
+                yield rule, cell, values, remaining
+
+
+def marker_bbox(values):
+    """
+    Returns the union bbox of all geometric values of a marker.
+    """
+    boxes = [b for b in (value_bbox(v) for v in values) if b is not None]
+    if not boxes:
+        return None
+    return min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes)
+
+
+def diff_results(old_lyrdb, new_lyrdb, output, tolerance, grid, keep_unchanged):
+    """
+    Classifies the markers of new_lyrdb against old_lyrdb as new, fixed or unchanged.
+
+    :param old_lyrdb: The path to the baseline lyrdb
+    :param new_lyrdb: The path to the current lyrdb
+    :param output: The output name of the diff lyrdb and summary csv
+    :param tolerance: The max. shift in um of each marker bbox edge
+    :param grid: The bucket size in um of the spatial index
+    :param keep_unchanged: Write unchanged markers to the diff lyrdb too
+    :return: A dict of {rule: [old, new, fixed, unchanged]} counts.
+    """
+    summary = {}
+    index = MarkerIndex(grid, tolerance)
+
+    old_header = read_header(old_lyrdb)
+    new_header = read_header(new_lyrdb)
+
+    # Index the baseline, the current run is streamed against it
+    for rule, cell, values, multiplicity in iter_items(old_lyrdb):
+        summary.setdefault(rule, [0, 0, 0, 0])[0] += multiplicity
+        index.add(rule, cell, values, marker_bbox(values), multiplicity)
+
+    logging.info(f"Indexed {len(index.markers)} markers of {old_lyrdb}")
+
+    descriptions = dict(old_header["categories"])
+    descriptions.update(dict(new_header["categories"]))
+    categories = []
+    for rule in sorted(descriptions):
+        categories.append((f"{rule}_new", f"{descriptions[rule]} (new)"))
+        categories.append((f"{rule}_fixed", f"{descriptions[rule]} (fixed)"))
+        if keep_unchanged:
+            categories.append((f"{rule}_unchanged", f"{descriptions[rule]} (unchanged)"))
+
+    cells = dict(old_header["cells"])
+    cells.update(new_header["cells"])
+
+    with LyrdbWriter(f"{output}.lyrdb", f"DRC diff of {new_lyrdb} against {old_lyrdb}",
+                     new_header["top_cell"] or old_header["top_cell"], categories, cells, "drc_diff.py") as writer:
+
+        for rule, cell, values, multiplicity in iter_items(new_lyrdb):
+            counts = summary.setdefault(rule, [0, 0, 0, 0])
+            counts[1] += multiplicity
+
+            matched = index.match(rule, cell, values, marker_bbox(values), multiplicity)
+            counts[3] += matched
+            if matched and keep_unchanged:
+                writer.add_item(f"{rule}_unchanged", cell, values, matched)
+            if matched < multiplicity:
+                writer.add_item(f"{rule}_new", cell, values, multiplicity - matched)
+
+        for rule, cell, values, remaining in index.unmatched():
+            summary[rule][2] += remaining
+            writer.add_item(f"{rule}_fixed", cell, values, remaining)
+
+    with open(f"{output}.csv", "w") as f:
+        writer = csv.writer(f, delimiter=",")
+        writer.writerow(["Rule_Name", "Old", "Current", "New", "Fixed", "Unchanged"])
+        for rule in sorted(summary):
+            old, current, fixed, unchanged = summary[rule]
+            writer.writerow([rule, old, current, current - unchanged, fixed, unchanged])
+
+    return summary
+
+
+def main():
+
+    for path in (arguments["--old"], arguments["--new"]):
+        if not os.path.exists(path):
+            logging.error(f"The lyrdb file {path} doesn't exist, please recheck.")
+            exit()
+
+    summary = diff_results(arguments["--old"], arguments["--new"], arguments["--output"],
+                           float(arguments["--tolerance"]), float(arguments["--grid"]), arguments["--keep_unchanged"])
+
+    new_total = sum(c[1] - c[3] for c in summary.values())
+    fixed_total = sum(c[2] for c in summary.values())
+    unchanged_total = sum(c[3] for c in summary.values())
+    changed = sorted(r for r, c in summary.items() if c[1] - c[3] > 0)
+
+    logging.info(f"New markers: {new_total}, fixed markers: {fixed_total}, unchanged markers: {unchanged_total}")
+    if changed:
+        logging.error(f"Rules with new violations are : {changed}")
+    else:
+        logging.info("No new DRC violations since the previous run.")
+    logging.info(f"Diff database at {arguments['--output']}.lyrdb, summary at {arguments['--output']}.csv")
+
+# ================================================================
+# -------------------------- MAIN --------------------------------
+# ================================================================
+
+if __name__ == "__main__":
+
+    # logs format
+    logging.basicConfig(level=logging.DEBUG, format=f"%(asctime)s | %(levelname)-7s | %(message)s", datefmt='%d-%b-%Y %H:%M:%S')
+
+    # arguments
+    arguments = docopt(__doc__, version='DRC DIFF: 0.1')
+
+    # Calling main function
+    main()
@@ -0,0 +1,371 @@
+# Copyright 2022 GlobalFoundries PDK Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Timing history and cost estimates of the GlobalFoundries 180nm MCU DRC rule decks.
+
+Every klayout run of the runners is recorded with the wall time, the peak RSS, the
+thread count and the run mode, next to the layers the deck read. The census of the layout
+(shape counts per layer, see utils/layout_census.rb) is only counted when an estimate needs
+it, the shape counts of the runs are filled in from it then. The estimates fit, per deck and
+run mode,
+
+    log(t) = c0 + c1 * log(shapes) + c2 * log(threads)
+
+over the history with least squares, where shapes are the flat shapes (the hierarchical
+shapes in deep mode) of the layers the deck reads. The same fit is done for the peak RSS.
+The confidence band is the prediction interval of the fit.
+
+The runs of the main deck also record the time of each rule, from the "Executing rule"
+log lines of the deck, and the rules that had violations. The quick profile picks the
+rules catching the most recorded violations per second of run time within a budget.
+"""
+
+import os
+import re
+import json
+import time
+import calendar
+import subprocess
+import numpy as np
+
+from drc_catalog import cache_dir, file_hash, needed_layers, parse_switches
+
+# Bump when utils/layout_census.rb output changes, old cached census are then ignored
+CENSUS_VERSION = 2
+
+# Records needed before a deck is estimated
+MIN_SAMPLES = 3
+
+# Two sided 90% band of the normal distribution
+BAND_Z = 1.645
+
+# Log line of the rule decks, e.g. "2022-11-10 12:00:01 +0000: Memory Usage (1234K) : Executing rule CO.1"
+LOG_LINE = re.compile(r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)(?: [+-]\d{4})?: Memory Usage .*?: (.*)$")
+EXECUTING = re.compile(r"^Executing rule (\S+)")
+
+
+def history_path():
+    return os.path.join(cache_dir("history"), "runs.jsonl")
+
+
+def rule_history_path():
+    return os.path.join(cache_dir("history"), "rules.jsonl")
+
+
+def census_key(gds_path, topcell=None):
+    return f"{file_hash(gds_path)}_{topcell or ''}_{CENSUS_VERSION}"
+
+
+def cached_census(key):
+    """
+    Returns the cached census of a census key, None if the layout wasn't counted yet.
+    """
+    cached = os.path.join(cache_dir("census"), f"{key}.json")
+    if not os.path.exists(cached):
+        return None
+    with open(cached, "r") as f:
+        return json.load(f)
+
+
+def layout_census(gds_path, topcell=None):
+    """
+    Returns the census of a layout, cached by the layout hash.
+
+    :param gds_path: The path to the GDS file
+    :param topcell: The top cell to count, default is the top cell of the layout
+    :return: The census dict of utils/layout_census.rb, None if klayout failed.
+    """
+    key = census_key(gds_path, topcell)
+    census = cached_census(key)
+    if census is not None:
+        return census
+    cached = os.path.join(cache_dir("census"), f"{key}.json")
+
+    pdk_root = os.environ['PDK_ROOT']
+    pdk      = os.environ['PDK']
+    cmd = ['klayout', '-b', '-r', f"{pdk_root}/{pdk}/utils/layout_census.rb", "-rd", f"infile={gds_path}"]
+    if topcell:
+        cmd += ["-rd", f"topcell={topcell}"]
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    try:
+        census = json.loads(proc.stdout.strip().splitlines()[-1])
+    except (IndexError, ValueError):
+        return None
+
+    with open(cached, "w") as f:
+        json.dump(census, f)
+    return census
+
+
+def deck_layers(deck, switches):
+    """
+    Returns the "layer/datatype" names of the layers read by a deck with the given switches.
+    """
+    return sorted(f"{l}/{d}" for l, d in needed_layers([deck], parse_switches(switches)))
+
+
+def layer_shapes(census, layers, run_mode):
+    """
+    Returns the shape count of some layers of a census, hierarchical in deep mode and flat otherwise.
+    """
+    layers = set(layers)
+    field = "shapes" if run_mode == "deep" else "flat_shapes"
+    return sum(v[field] for k, v in census["layers"].items() if k in layers)
+
+
+def deck_shapes(census, deck, switches, run_mode):
+    """
+    Returns the shape count of the layers read by a deck, the size feature of the fits.
+    """
+    return layer_shapes(census, deck_layers(deck, switches), run_mode)
+
+
+def layout_entry(gds_path, deck, switches, run_mode, topcell):
+    """
+    Returns the layout fields of a history entry.
+
+    The census of the layout isn't counted here, that would start a second klayout process on
+    every run. The entry keeps the census key and the layers read by the deck instead, the shape
+    count is filled in from the census when an estimate reads the history (see with_shapes).
+    """
+    entry = {"layout": os.path.abspath(gds_path), "topcell": topcell, "census": census_key(gds_path, topcell),
+             "layers": deck_layers(deck, switches)}
+    census = cached_census(entry["census"])
+    if census is not None:
+        entry.update({"shapes": layer_shapes(census, entry["layers"], run_mode), "area_um2": census["area_um2"],
+                      "cells": census["cells"]})
+    return entry
+
+
+def with_shapes(runs):
+    """
+    Returns the recorded runs with their shape counts.
+
+    Runs recorded before their layout was counted get it from the census cache, or from a census
+    of the layout if it still exists unchanged. Runs whose layout is gone are left out.
+    """
+    counted = []
+    for h in runs:
+        if "shapes" not in h:
+            census = cached_census(h["census"])
+            if census is None and os.path.exists(h["layout"]) and census_key(h["layout"], h["topcell"]) == h["census"]:
+                census = layout_census(h["layout"], h["topcell"])
+            if census is None:
+                continue
+            h = dict(h, shapes=layer_shapes(census, h["layers"], h["run_mode"]))
+        counted.append(h)
+    return counted
+
+
+def run_measured(cmd, rule_times=None):
+    """
+    Runs one shell command and measures it.
+
+    :param cmd: The shell command
+    :param rule_times: A dict filled with the seconds spent in each rule of the deck log, the
+                       output is then read through a pipe and echoed
+    :return: A tuple of (wall time in seconds, peak RSS in MB of the largest process, exit status).
+    """
+    t0 = time.time()
+    if rule_times is None:
+        proc = subprocess.Popen(cmd, shell=True)
+    else:
+        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, universal_newlines=True)
+        current = None
+        for line in proc.stdout:
+            print(line, end="")
+            match = LOG_LINE.match(line)
+            if not match:
+                continue
+            # Each log line ends the rule started by the previous "Executing rule" line
+            stamp = calendar.timegm(time.strptime(match.group(1), "%Y-%m-%d %H:%M:%S"))
+            if current:
+                rule_times[current[0]] = rule_times.get(current[0], 0) + stamp - current[1]
+            executing = EXECUTING.match(match.group(2))
+            current = (executing.group(1), stamp) if executing else None
+    # wait4 includes the klayout process the shell waited for
+    _, status, usage = os.wait4(proc.pid, 0)
+    return time.time() - t0, usage.ru_maxrss / 1024, os.waitstatus_to_exitcode(status)
+
+
+def record(gds_path, deck, switches, run_mode, threads, wall, rss_mb, topcell=None):
+    """
+    Appends one klayout run to the history.
+
+    :param gds_path: The path to the checked GDS file
+    :param deck: The rule deck path
+    :param switches: The switches passed to the deck
+    :param run_mode: The klayout mode of the run
+    :param threads: The thread count of the run
+    :param wall: The wall time in seconds
+    :param rss_mb: The peak RSS in MB
+    :param topcell: The checked top cell
+    """
+    entry = {"date": time.strftime("%Y-%m-%d %H:%M:%S"), "deck": os.path.basename(deck), "run_mode": run_mode,
+             "threads": threads, "wall": wall, "max_rss_mb": rss_mb}
+    entry.update(layout_entry(gds_path, deck, switches, run_mode, topcell))
+    with open(history_path(), "a") as f:
+        f.write(json.dumps(entry) + "\n")
+
+
+def record_rules(gds_path, deck, switches, run_mode, wall, rule_times, hits, topcell=None):
+    """
+    Appends the rule times and violations of one klayout run to the rule history.
+
+    :param gds_path: The path to the checked GDS file
+    :param deck: The rule deck path
+    :param switches: The switches passed to the deck
+    :param run_mode: The klayout mode of the run
+    :param wall: The wall time in seconds
+    :param rule_times: A dict of {rule: seconds}
+    :param hits: A dict of {rule: markers} of the violated rules
+    :param topcell: The checked top cell
+    """
+    if not rule_times:
+        return
+    entry = {"date": time.strftime("%Y-%m-%d %H:%M:%S"), "deck": os.path.basename(deck), "run_mode": run_mode,
+             "overhead": max(0, wall - sum(rule_times.values())), "times": rule_times, "hits": hits}
+    entry.update(layout_entry(gds_path, deck, switches, run_mode, topcell))
+    with open(rule_history_path(), "a") as f:
+        f.write(json.dumps(entry) + "\n")
+
+
+def load_history(path=None):
+    """
+    Returns the recorded runs as a list of dicts.
+
+    :param path: The history file, default the deck run history
+    """
+    path = path or history_path()
+    if not os.path.exists(path):
+        return []
+    entries = []
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+    return entries
+
+
+def fit_loglog(samples):
+    """
+    Fits log(y) = c0 + c1 * log(shapes) + c2 * log(threads) with least squares.
+
+    :param samples: A list of (shapes, threads, y)
+    :return: A tuple of (coefficients, pseudo inverse of X^T X, residual std), None without enough samples.
+    """
+    if len(samples) < MIN_SAMPLES:
+        return None
+    x = np.array([[1.0, np.log(max(s, 1)), np.log(max(n, 1))] for s, n, _ in samples])
+    y = np.log(np.array([max(v, 1e-3) for _, _, v in samples]))
+    coef, *_ = np.linalg.lstsq(x, y, rcond=None)
+    dof = max(1, len(samples) - np.linalg.matrix_rank(x))
+    sigma = float(np.sqrt(np.sum((y - x @ coef) ** 2) / dof))
+    return coef, np.linalg.pinv(x.T @ x), sigma
+
+
+def predict(fit, shapes, threads):
+    """
+    Returns the (estimate, low, high) of a fit for a layout size and thread count.
+    """
+    coef, xtx_inv, sigma = fit
+    x = np.array([1.0, np.log(max(shapes, 1)), np.log(max(threads, 1))])
+    mean = float(x @ coef)
+    # Prediction interval, wider away from the recorded layouts
+    half = BAND_Z * sigma * float(np.sqrt(1 + x @ xtx_inv @ x))
+    return float(np.exp(mean)), float(np.exp(mean - half)), float(np.exp(mean + half))
+
+
+def estimate(census, deck, switches, run_mode, threads, history=None):
+    """
+    Estimates the wall time and peak RSS of one deck run.
+
+    :param census: The census of the layout
+    :param deck: The rule deck path
+    :param switches: The switches passed to the deck
+    :param run_mode: The klayout mode
+    :param threads: The thread count
+    :param history: The recorded runs, loaded when not given
+    :return: A dict with the "wall" and "max_rss_mb" (estimate, low, high) tuples, the
+             number of "samples" and whether other run modes were "pooled", None without history.
+    """
+    history = load_history() if history is None else history
+    name = os.path.basename(deck)
+    runs = [h for h in history if h["deck"] == name and h["run_mode"] == run_mode]
+    pooled = len(runs) < MIN_SAMPLES
+    if pooled:
+        # Too few runs of this mode, the other modes give at least the size trend
+        runs = [h for h in history if h["deck"] == name]
+    runs = with_shapes(runs)
+
+    wall_fit = fit_loglog([(h["shapes"], h["threads"], h["wall"]) for h in runs])
+    rss_fit = fit_loglog([(h["shapes"], h["threads"], h["max_rss_mb"]) for h in runs])
+    if wall_fit is None or rss_fit is None:
+        return None
+
+    shapes = deck_shapes(census, deck, switches, run_mode)
+    return {"wall": predict(wall_fit, shapes, threads), "max_rss_mb": predict(rss_fit, shapes, threads),
+            "samples": len(runs), "pooled": pooled, "shapes": shapes}
+
+
+def select_rules(census, deck, switches, run_mode, rules, budget, history=None):
+    """
+    Picks the rules catching the most recorded violations within a time budget.
+
+    The time of each rule is the mean of its recorded times, scaled by the shape count of
+    the layout; its value is the share of recorded runs in which it had violations. Rules
+    are taken by value per second until the budget, less the mean time spent outside of
+    the rules (loading, derivations), is spent. Rules without history are costed at the
+    median rule time and have no value.
+
+    :param census: The census of the layout
+    :param deck: The rule deck path
+    :param switches: The switches passed to the deck
+    :param run_mode: The klayout mode
+    :param rules: The enabled rule names of the deck
+    :param budget: The time budget in seconds
+    :param history: The recorded rule runs, loaded when not given
+    :return: A tuple of (selected rule names, {rule: (estimated seconds, hit rate)} of all rules).
+    """
+    history = load_history(rule_history_path()) if history is None else history
+    name = os.path.basename(deck)
+    runs = [h for h in history if h["deck"] == name and h["run_mode"] == run_mode] or \
+           [h for h in history if h["deck"] == name]
+    runs = with_shapes(runs)
+    shapes = max(deck_shapes(census, deck, switches, run_mode), 1)
+
+    costs = {}
+    rates = {}
+    for rule in rules:
+        timed = [h for h in runs if rule in h["times"]]
+        if timed:
+            costs[rule] = float(np.mean([h["times"][rule] * shapes / max(h["shapes"], 1) for h in timed]))
+            rates[rule] = sum(1 for h in timed if h["hits"].get(rule, 0) > 0) / len(timed)
+    default_cost = float(np.median(list(costs.values()))) if costs else 1.0
+    overhead = float(np.mean([h["overhead"] * shapes / max(h["shapes"], 1) for h in runs])) if runs else 0.0
+
+    stats = {rule: (costs.get(rule, default_cost), rates.get(rule, 0.0)) for rule in rules}
+    # Cheap rules first among equal value, so rules without hits still fill the budget left
+    order = sorted(rules, key=lambda r: (-stats[r][1] / max(stats[r][0], 1e-3), stats[r][0]))
+
+    selected = []
+    spent = overhead
+    for rule in order:
+        if spent + stats[rule][0] <= budget:
+            selected.append(rule)
+            spent += stats[rule][0]
+    return selected, stats
@@ -0,0 +1,89 @@
+# Copyright 2022 GlobalFoundries PDK Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Admission control for concurrent klayout jobs sharing one thread budget.
+
+Each job asks for a number of threads and is only started once they are free,
+so the sum of `-rd thr=` over all running klayout processes never exceeds the
+budget. A job asking for more than the whole budget runs alone.
+"""
+
+import threading
+import logging
+import concurrent.futures
+
+
+class ThreadBudget:
+    """
+    Counting semaphore over threads.
+
+    :param total: The total number of threads that may be used at once
+    """
+
+    def __init__(self, total):
+        self.total = max(1, int(total))
+        self.free = self.total
+        self.cond = threading.Condition()
+
+    def acquire(self, threads):
+        threads = min(max(1, int(threads)), self.total)
+        with self.cond:
+            self.cond.wait_for(lambda: self.free >= threads)
+            self.free -= threads
+        return threads
+
+    def release(self, threads):
+        with self.cond:
+            self.free += threads
+            self.cond.notify_all()
+
+
+def _run_job(budget, name, threads, function, args):
+    granted = budget.acquire(threads)
+    try:
+        return function(*args)
+    finally:
+        budget.release(granted)
+
+
+def run_jobs(jobs, thr_budget):
+    """
+    Runs jobs concurrently without exceeding the thread budget.
+
+    :param jobs: A list of (name, threads, function, args) tuples, function is called as function(*args)
+    :param thr_budget: The total number of threads or a shared ThreadBudget object
+    :return: A dict of {name: return value of function}, None for failed jobs.
+    """
+    budget = thr_budget if isinstance(thr_budget, ThreadBudget) else ThreadBudget(thr_budget)
+    results = {}
+
+    if not jobs:
+        return results
+
+    # Every job holds at least one thread of the budget, more workers would only wait
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(jobs), budget.total)) as executor:
+        futures = {}
+        for name, threads, function, args in jobs:
+            futures[executor.submit(_run_job, budget, name, threads, function, args)] = name
+
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                logging.error(f"Job {name} failed: {e}")
+                results[name] = None
+
+    return results
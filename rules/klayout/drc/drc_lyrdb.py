@@ -0,0 +1,237 @@
+# Copyright 2022 GlobalFoundries PDK Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Streaming reader and writer for KLayout report databases (lyrdb).
+
+The DRC runsets write one lyrdb per run, which can hold millions of markers.
+These helpers never build the whole XML tree in memory: items are yielded one
+by one while parsing and written one by one while writing.
+"""
+
+import re
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+COORD_PAIR = re.compile(r"(-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?),(-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)")
+
+# Value types of marker geometries, klayout writes the text markers as "label" values
+GEOMETRY_TYPES = ("polygon", "box", "edge", "edge-pair", "path", "label")
+
+# Suffix of the category description of rules capped by utils/bounded_output.rb
+CAPPED = re.compile(r"\[(\d+) of (\d+) markers kept\]\s*$")
+
+
+def clean_category(text):
+    """
+    Returns the rule name of an item category, KLayout quotes names with dots.
+
+    :param text: The category text of an item, e.g. "'DN.1'"
+    :return: The plain rule name, e.g. "DN.1"
+    """
+    if text is None:
+        return ""
+    text = text.strip()
+    if len(text) > 1 and text[0] == text[-1] and text[0] in "'\"":
+        text = text[1:-1]
+    return text
+
+
+def value_bbox(value):
+    """
+    Returns the bounding box of a marker value in microns.
+
+    :param value: The value text of an item, e.g. "polygon: (0,0;0,1;1,1;1,0)"
+    :return: A tuple (left, bottom, right, top) or None for non geometric values.
+    """
+    vtype = value.split(":", 1)[0].strip()
+    if vtype not in GEOMETRY_TYPES:
+        return None
+
+    xs = []
+    ys = []
+    for x, y in COORD_PAIR.findall(value):
+        xs.append(float(x))
+        ys.append(float(y))
+
+    if not xs:
+        return None
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def read_header(lyrdb):
+    """
+    Reads everything in a lyrdb before the items section.
+
+    :param lyrdb: The path to the lyrdb file
+    :return: A dict with description, generator, top_cell, categories [(name, description)]
+             and cells {name: [(parent, trans)]}.
+    """
+    header = {"description": "", "generator": "", "top_cell": "", "categories": [], "cells": {}}
+    depth = 0
+
+    for event, elem in ET.iterparse(lyrdb, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if elem.tag == "items":
+                break
+            continue
+
+        depth -= 1
+        if depth == 1 and elem.tag in ("description", "generator", "top-cell"):
+            header[elem.tag.replace("-", "_")] = elem.text or ""
+        elif elem.tag == "category" and elem.find("name") is not None:
+            header["categories"].append((elem.findtext("name", ""), elem.findtext("description", "")))
+        elif elem.tag == "cell" and elem.find("name") is not None:
+            refs = [(r.findtext("parent", ""), r.findtext("trans", "")) for r in elem.iter("ref")]
+            header["cells"][elem.findtext("name", "")] = refs
+
+    return header
+
+
+def capped_counts(lyrdb):
+    """
+    Returns the rules of a lyrdb whose markers were capped by --max_markers_per_rule.
+
+    :param lyrdb: The path to the lyrdb file
+    :return: A dict of {rule: (kept markers, total markers)}.
+    """
+    capped = {}
+    for name, desc in read_header(lyrdb)["categories"]:
+        m = CAPPED.search(desc or "")
+        if m:
+            capped[clean_category(name)] = (int(m.group(1)), int(m.group(2)))
+    return capped
+
+
+def iter_items(lyrdb):
+    """
+    Yields the items of a lyrdb one by one without keeping them in memory.
+
+    :param lyrdb: The path to the lyrdb file
+    :return: A generator of (category, cell, values, multiplicity) tuples.
+    """
+    items = None
+
+    for event, elem in ET.iterparse(lyrdb, events=("start", "end")):
+        if event == "start":
+            if elem.tag == "items":
+                items = elem
+            continue
+
+        if items is None:
+            continue
+
+        if elem.tag == "item":
+            category = clean_category(elem.findtext("category"))
+            cell = elem.findtext("cell", "")
+            values = [v.text for v in elem.iter("value") if v.text]
+            multiplicity = int(elem.findtext("multiplicity", "1") or 1)
+            items.remove(elem)
+            yield category, cell, values, multiplicity
+        elif elem.tag == "items":
+            items = None
+
+
+class LyrdbWriter:
+    """
+    Writes a lyrdb item by item, the header is written when the file is opened.
+
+    :param path: The output lyrdb path
+    :param description: The report description
+    :param top_cell: The name of the top cell
+    :param categories: A list of (name, description) tuples
+    :param cells: A dict of {cell name: [(parent, trans)]} references
+    :param generator: The generator string saved in the report
+    """
+
+    def __init__(self, path, description, top_cell, categories, cells, generator=""):
+        self.count = 0
+        self.file = open(path, "w", encoding="utf-8")
+        self.file.write('<?xml version="1.0" encoding="utf-8"?>\n<report-database>\n')
+        self.file.write(f" <description>{escape(description)}</description>\n")
+        self.file.write(" <original-file/>\n")
+        self.file.write(f" <generator>{escape(generator)}</generator>\n")
+        self.file.write(f" <top-cell>{escape(top_cell)}</top-cell>\n")
+        self.file.write(" <tags>\n </tags>\n <categories>\n")
+        for name, desc in categories:
+            self.file.write(f"  <category>\n   <name>{escape(name)}</name>\n   <description>{escape(desc)}</description>\n   <categories>\n   </categories>\n  </category>\n")
+        self.file.write(" </categories>\n <cells>\n")
+        for name, refs in cells.items():
+            self.file.write(f"  <cell>\n   <name>{escape(name)}</name>\n   <variant/>\n   <references>\n")
+            for parent, trans in refs:
+                self.file.write(f"    <ref>\n     <parent>{escape(parent)}</parent>\n     <trans>{escape(trans)}</trans>\n    </ref>\n")
+            self.file.write("   </references>\n  </cell>\n")
+        self.file.write(" </cells>\n <items>\n")
+
+    def add_item(self, category, cell, values, multiplicity=1):
+        """
+        Appends one marker to the items section.
+
+        :param category: The rule name of the marker
+        :param cell: The cell the marker belongs to
+        :param values: A list of value strings, e.g. ["polygon: (0,0;0,1;1,1;1,0)"]
+        :param multiplicity: The number of markers represented by this item
+        """
+        self.file.write(f"  <item>\n   <tags/>\n   <category>'{escape(category)}'</category>\n   <cell>{escape(cell)}</cell>\n")
+        self.file.write(f"   <visited>false</visited>\n   <multiplicity>{multiplicity}</multiplicity>\n   <image/>\n   <values>\n")
+        for value in values:
+            self.file.write(f"    <value>{escape(value)}</value>\n")
+        self.file.write("   </values>\n  </item>\n")
+        self.count += 1
+
+    def close(self):
+        self.file.write(" </items>\n</report-database>\n")
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def merge_lyrdbs(inputs, output, transform=None, description=None):
+    """
+    Merges several lyrdbs into one, categories and cells are united.
+
+    :param inputs: A list of lyrdb paths
+    :param output: The merged lyrdb path
+    :param transform: Optional function(index, category, cell, values) returning the values to keep
+                      for an item of inputs[index], or None to drop the item.
+    :param description: The description of the merged report, default is the first one.
+    :return: The number of items written.
+    """
+    headers = [read_header(path) for path in inputs]
+
+    categories = {}
+    cells = {}
+    for header in headers:
+        for name, desc in header["categories"]:
+            categories.setdefault(name, desc)
+        for name, refs in header["cells"].items():
+            cells.setdefault(name, refs)
+
+    first = headers[0] if headers else {"description": "", "top_cell": "", "generator": ""}
+    with LyrdbWriter(output, description or first["description"], first["top_cell"], list(categories.items()),
+                     cells, first["generator"]) as writer:
+        for i, path in enumerate(inputs):
+            for category, cell, values, multiplicity in iter_items(path):
+                if transform is not None:
+                    values = transform(i, category, cell, values)
+                    if values is None:
+                        continue
+                writer.add_item(category, cell, values, multiplicity)
+
+    return writer.count
@@ -0,0 +1,124 @@
+# Copyright 2022 GlobalFoundries PDK Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per cell master roll-up of deep mode DRC results.
+
+Deep mode reports each marker once in the cell it was found in. The roll-up attaches
+the number of placements of that cell under the top cell to its markers and sums the
+markers per cell, so a violation of a library cell placed a million times shows up
+as one marker with its instance count. The markers are only expanded to every
+placement on request, see utils/expand_lyrdb.rb.
+"""
+
+import os
+import csv
+import logging
+import subprocess
+
+from drc_lyrdb import read_header, iter_items, LyrdbWriter
+from drc_history import layout_census
+
+
+def cell_placements(gds_path, topcells):
+    """
+    Returns the number of flat placements of each cell under the given top cells.
+
+    :param gds_path: The path to the GDS file
+    :param topcells: The checked top cells
+    :return: A dict of {cell name: placements}.
+    """
+    placements = {}
+    for topcell in topcells:
+        census = layout_census(gds_path, topcell)
+        if census is None:
+            continue
+        for cell, n in census["placements"].items():
+            placements[cell] = placements.get(cell, 0) + n
+    return placements
+
+
+def rollup_lyrdb(lyrdb_path, placements):
+    """
+    Attaches the instance count of their cell to the markers of a lyrdb, in place.
+
+    :param lyrdb_path: The path to the lyrdb file
+    :param placements: A dict of {cell name: placements}
+    :return: The per cell summary {cell: {"markers": n, "instances": n, "rules": {rule: n}}}.
+    """
+    header = read_header(lyrdb_path)
+    summary = {}
+    tmp = f"{lyrdb_path}.rollup"
+
+    with LyrdbWriter(tmp, header["description"], header["top_cell"], header["categories"], header["cells"],
+                     header["generator"]) as writer:
+        for category, cell, values, multiplicity in iter_items(lyrdb_path):
+            # Cell variants are written as name:variant
+            instances = placements.get(cell.split(":")[0], 1)
+            entry = summary.setdefault(cell, {"markers": 0, "instances": instances, "rules": {}})
+            entry["markers"] += multiplicity
+            entry["rules"][category] = entry["rules"].get(category, 0) + multiplicity
+            writer.add_item(category, cell, values + [f"text: 'instances={instances}'"], multiplicity)
+
+    os.replace(tmp, lyrdb_path)
+    return summary
+
+
+def write_cell_summary(summary, csv_path):
+    """
+    Writes the per cell summary as csv, cells with the most flat markers first.
+    """
+    rows = sorted(summary.items(), key=lambda kv: -kv[1]["markers"] * kv[1]["instances"])
+    with open(csv_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["cell", "instances", "markers", "flat_markers", "rules"])
+        for cell, entry in rows:
+            rules = " ".join(f"{r}:{n}" for r, n in sorted(entry["rules"].items()))
+            writer.writerow([cell, entry["instances"], entry["markers"], entry["markers"] * entry["instances"], rules])
+
+
+def log_cell_summary(summary, limit=20):
+    """
+    Logs the cells with the most flat markers.
+    """
+    rows = sorted(summary.items(), key=lambda kv: -kv[1]["markers"] * kv[1]["instances"])
+    if not rows:
+        return
+    logging.info(f"Violations per cell master ({len(rows)} cells):")
+    print(f"{'cell':<50} {'instances':>10} {'markers':>8} {'flat markers':>13}  rules")
+    for cell, entry in rows[:limit]:
+        rules = ", ".join(sorted(entry["rules"]))
+        print(f"{cell:<50} {entry['instances']:>10} {entry['markers']:>8} {entry['markers'] * entry['instances']:>13}  {rules}")
+    if len(rows) > limit:
+        print(f"... {len(rows) - limit} more cells")
+
+
+def expand_lyrdb(gds_path, lyrdb_path, output, topcell=None):
+    """
+    Writes the markers of a rolled-up lyrdb at every placement of their cell, in top cell coordinates.
+
+    :return: The number of expanded markers, None if klayout failed.
+    """
+    pdk_root = os.environ['PDK_ROOT']
+    pdk      = os.environ['PDK']
+
+    cmd = ['klayout', '-b', '-r', f"{pdk_root}/{pdk}/utils/expand_lyrdb.rb", "-rd", f"infile={gds_path}",
+           "-rd", f"report={lyrdb_path}", "-rd", f"outfile={output}"]
+    if topcell:
+        cmd += ["-rd", f"topcell={topcell}"]
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+    try:
+        return int(proc.stdout.strip().splitlines()[-1])
+    except (IndexError, ValueError):
+        return None
@@ -0,0 +1,224 @@
+# Copyright 2022 GlobalFoundries PDK Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Client of the persistent GlobalFoundries 180nm MCU DRC/LVS server.
+
+Usage:
+    drc_server.py (--help| -h)
+    drc_server.py start [--socket=<socket>] [--max_layouts=<max_layouts>]
+    drc_server.py stop [--socket=<socket>]
+    drc_server.py status [--socket=<socket>]
+    drc_server.py drc (--path=<file_path>) (--gf180mcu=<combined_options>) [--topcell=<topcell_name>] [--thr=<thr>] [--run_mode=<run_mode>] [--no_feol] [--no_beol] [--connectivity] [--no_offgrid] [--socket=<socket>]
+    drc_server.py lvs (--design=<layout_path>) (--net=<netlist_path>) (--gf180mcu=<combined_options>) [--thr=<thr>] [--run_mode=<run_mode>] [--lvs_sub=<sub_name>] [--no_net_names] [--set_spice_comments] [--set_scale] [--set_verbose] [--set_schematic_simplify] [--set_net_only] [--set_top_lvl_pins] [--set_combine] [--set_purge] [--set_purge_nets] [--socket=<socket>]
+
+Options:
+    --help -h                           Print this help message.
+    --socket=<socket>                   The unix socket of the server. Default is /tmp/gf180mcu_drc_<uid>.sock
+    --max_layouts=<max_layouts>         Number of layouts kept loaded by the server. [default: 4]
+    --path=<file_path>                  The input GDS file path.
+    --design=<layout_path>              The input GDS file path of the LVS run.
+    --net=<netlist_path>                The input netlist file path of the LVS run.
+    --gf180mcu=<combined_options>       Select combined options of metal_top, mim_option, and metal_level. Allowed values (A, B, C).
+    --topcell=<topcell_name>            Topcell name to use.
+    --thr=<thr>                         The number of threads used in run.
+    --run_mode=<run_mode>               Select klayout mode Allowed modes (flat , deep, tiling).
+    --no_feol                           Turn off FEOL rules from running.
+    --no_beol                           Turn off BEOL rules from running.
+    --connectivity                      Turn on connectivity rules.
+    --no_offgrid                        Turn off OFFGRID checking rules.
+    --lvs_sub=<sub_name>                Assign the substrate name used in design.
+    --no_net_names                      Discard net names in extracted netlist.
+    --set_spice_comments                Set netlist comments in extracted netlist.
+    --set_scale                         Set scale of 1e6 in extracted netlist.
+    --set_verbose                       Set verbose mode.
+    --set_schematic_simplify            Set schematic simplification in input netlist.
+    --set_net_only                      Set netlist object creation only in extracted netlist.
+    --set_top_lvl_pins                  Set top level pins only in extracted netlist.
+    --set_combine                       Set netlist combine only in extracted netlist.
+    --set_purge                         Set netlist purge all only in extracted netlist.
+    --set_purge_nets                    Set netlist purge nets only in extracted netlist.
+
+The server is a klayout process running utils/drc_server.rb, it keeps the loaded layouts between
+runs so repeated runs on the same design skip klayout start-up and the layout load.
+"""
+
+from docopt import docopt
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import subprocess
+
+from run_drc import build_switches
+from drc_catalog import parse_switches
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lvs"))
+from run_lvs import build_switches as build_lvs_switches
+
+
+def default_socket():
+    return f"/tmp/gf180mcu_drc_{os.getuid()}.sock"
+
+
+def request(sock_path, req):
+    """
+    Sends one request to the server and yields its answers as they arrive.
+
+    :param sock_path: The unix socket of the server
+    :param req: The request dict
+    :return: A generator of answer dicts, the last one has "done" set.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(sock_path)
+        sock.sendall((json.dumps(req) + "\n").encode())
+        with sock.makefile("r") as f:
+            for line in f:
+                yield json.loads(line)
+
+
+def run_request(sock_path, req):
+    """
+    Sends one request and logs the streamed answers.
+
+    :return: The final answer dict.
+    """
+    done = {"ok": False, "error": "Server closed the connection"}
+    for answer in request(sock_path, req):
+        if "log" in answer:
+            print(answer["log"])
+        elif "rule" in answer:
+            logging.error(f"{answer['rule']}: {answer['count']} violations")
+        elif answer.get("done"):
+            done = answer
+    return done
+
+
+def server_alive(sock_path):
+    """
+    Returns True if a server accepts connections on the socket.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(sock_path)
+        except OSError:
+            return False
+    return True
+
+
+def start_server(sock_path, max_layouts, script=None):
+    """
+    Starts the server in the background and waits until it listens.
+
+    :param sock_path: The unix socket of the server
+    :param max_layouts: The number of layouts the server keeps loaded
+    :param script: The server script, default is utils/drc_server.rb of the PDK
+    :return: True if the server listens, False if it didn't start or another server already listens on the socket.
+    """
+    if os.path.exists(sock_path):
+        if server_alive(sock_path):
+            logging.error(f"A server already listens on {sock_path}, stop it first.")
+            return False
+        # Left behind by a server that crashed
+        logging.warning(f"Removing the stale socket {sock_path}")
+        os.remove(sock_path)
+
+    if script is None:
+        script = f"{os.environ['PDK_ROOT']}/{os.environ['PDK']}/utils/drc_server.rb"
+
+    with open(f"{sock_path}.log", "w") as log:
+        subprocess.Popen(['klayout', '-b', '-r', script, "-rd", f"socket={sock_path}",
+                          "-rd", f"max_layouts={max_layouts}"], stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+
+    for _ in range(600):
+        if os.path.exists(sock_path):
+            logging.info(f"DRC server started on {sock_path}, server log at {sock_path}.log")
+            return True
+        time.sleep(0.1)
+    logging.error(f"DRC server didn't start, please check {sock_path}.log")
+    return False
+
+
+def main():
+
+    sock_path = arguments["--socket"] or default_socket()
+
+    if arguments["start"]:
+        if not start_server(sock_path, int(arguments["--max_layouts"])):
+            exit(1)
+        return
+
+    if not os.path.exists(sock_path):
+        logging.error(f"No DRC server listens on {sock_path}, start it with: drc_server.py start")
+        exit()
+
+    pdk_root = os.environ['PDK_ROOT']
+    pdk      = os.environ['PDK']
+    thr = os.cpu_count()*2 if arguments["--thr"] == None else int(arguments["--thr"])
+    gf = arguments["--gf180mcu"]
+
+    if arguments["stop"] or arguments["status"]:
+        done = run_request(sock_path, {"cmd": "stop" if arguments["stop"] else "status"})
+        if arguments["status"]:
+            logging.info(f"Server pid {done.get('pid')}, loaded layouts: {done.get('layouts')}")
+        return
+
+    if arguments["drc"]:
+        path = os.path.abspath(arguments["--path"])
+        report = f"{path.replace('.gds', '')}_main_drc_gf{gf}.lyrdb"
+        switches = build_switches(dict(arguments, **{"--run_mode": arguments["--run_mode"] or "flat", "--density": False}))
+        req_vars = parse_switches(switches)
+        req_vars.update({"input": path, "report": report, "thr": str(thr)})
+        if arguments["--topcell"]:
+            req_vars["topcell"] = arguments["--topcell"]
+        req = {"cmd": "drc", "deck": f"{pdk_root}/{pdk}/gf180mcu.drc", "vars": req_vars}
+    else:
+        path = os.path.abspath(arguments["--design"])
+        net = os.path.abspath(arguments["--net"])
+        name = os.path.splitext(net)[0]
+        switches = build_lvs_switches(dict(arguments, **{"--run_mode": arguments["--run_mode"] or "deep"}))
+        req_vars = parse_switches(switches)
+        req_vars.update({"input": path, "report": f"{name}.lyrdb", "schematic": net,
+                         "target_netlist": f"{os.path.dirname(name)}/extracted_netlist_{os.path.basename(name)}.cir", "thr": str(thr)})
+        req = {"cmd": "lvs", "deck": f"{pdk_root}/{pdk}/gf180mcu.lvs", "vars": req_vars}
+
+    if not os.path.exists(path):
+        logging.error("The input GDS file path doesn't exist, please recheck.")
+        exit()
+
+    done = run_request(sock_path, req)
+    cached = "cached layout" if done.get("cached") else "layout loaded"
+    if not done.get("ok"):
+        logging.error(f"Server run failed: {done.get('error')}")
+        exit(1)
+    logging.info(f"Run finished in {done.get('seconds', 0):.1f} seconds ({cached}), report at {done.get('report')}")
+    if done.get("violations"):
+        logging.error(f"Total # of DRC violations is {done['violations']}")
+
+# ================================================================
+# -------------------------- MAIN --------------------------------
+# ================================================================
+
+if __name__ == "__main__":
+
+    # logs format
+    logging.basicConfig(level=logging.DEBUG, format=f"%(asctime)s | %(levelname)-7s | %(message)s", datefmt='%d-%b-%Y %H:%M:%S')
+
+    # arguments
+    arguments = docopt(__doc__, version='DRC SERVER: 0.1')
+
+    # Calling main function
+    main()
@@ -0,0 +1,324 @@
+# Copyright 2022 GlobalFoundries PDK Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Fast checks of the GlobalFoundries 180nm MCU contact and via rules.
+
+Usage:
+    drc_via_check.py (--help| -h)
+    drc_via_check.py (--path=<file_path>) [--topcell=<topcell_name>] [--layer=<layer>]... [--output=<output>] [--compare=<lyrdb>] [--grid=<grid>]
+
+Options:
+    --help -h                           Print this help message.
+    --path=<file_path>                  The input GDS file path.
+    --topcell=<topcell_name>            Topcell name to use.
+    --layer=<layer>                     Via layer to check: contact, via1, via2, via3, via4 or via5. Default all of them.
+    --output=<output>                   Output lyrdb of the markers, default <design>_vias.lyrdb next to the layout.
+    --compare=<lyrdb>                   Cross-check the markers against a flat run of the rule decks on the same layout.
+    --grid=<grid>                       Bucket size in um of the neighbour search. [default: 5]
+
+Contacts and vias are fixed size squares. Their flat merged shapes are dumped as rectangles
+(utils/dump_boxes.rb) and checked with numpy: the exact size with vectorized comparisons, the
+spacing with a grid bucketed neighbour search and the enclosure by the metal below and above
+as the coverage of the enlarged via by the rectangles of the metal. Vias that aren't rectangles
+are reported by the size rules only, and vias touching non manhattan metal are left to the
+rule decks, they are counted as undecided.
+"""
+
+from docopt import docopt
+import os
+import json
+import shutil
+import logging
+import tempfile
+import subprocess
+
+import numpy as np
+
+from drc_catalog import get_rules
+from drc_lyrdb import iter_items, value_bbox, LyrdbWriter
+
+# via layer: (layer/datatype, size rule, size um, space rule, space um, [(enclosure rule, metal layer/datatype, enclosure um)])
+VIA_RULES = {
+    "contact": ("33/0", "CO.1", 0.22, "CO.2a", 0.25, [("CO.6", "34/0", 0.005)]),
+    "via1": ("35/0", "V1.1", 0.26, "V1.2a", 0.26, [("V1.3a", "34/0", 0.0), ("V1.4a", "36/0", 0.01)]),
+    "via2": ("38/0", "V2.1", 0.26, "V2.2a", 0.26, [("V2.3b", "36/0", 0.01), ("V2.4a", "42/0", 0.01)]),
+    "via3": ("40/0", "V3.1", 0.26, "V3.2a", 0.26, [("V3.3b", "42/0", 0.01), ("V3.4a", "46/0", 0.01)]),
+    "via4": ("41/0", "V4.1", 0.26, "V4.2a", 0.26, [("V4.3b", "46/0", 0.01), ("V4.4a", "81/0", 0.01)]),
+    "via5": ("82/0", "V5.1", 0.26, "V5.2a", 0.26, [("V5.3b", "81/0", 0.01), ("V5.4a", "53/0", 0.01)]),
+}
+
+# Offset keeping the bucket coordinates positive in the packed bucket keys
+KEY_OFFSET = 1 << 30
+
+
+def dump_boxes(gds_path, topcell, vias, metals, outdir):
+    """
+    Dumps the merged shapes of the via and metal layers as rectangles with klayout.
+
+    :return: The database unit and the top cell name.
+    """
+    pdk_root = os.environ['PDK_ROOT']
+    pdk      = os.environ['PDK']
+
+    cmd = ['klayout', '-b', '-r', f"{pdk_root}/{pdk}/utils/dump_boxes.rb", "-rd", f"infile={gds_path}",
+           "-rd", f"vias={','.join(vias)}", "-rd", f"metals={','.join(metals)}", "-rd", f"outdir={outdir}"]
+    if topcell:
+        cmd += ["-rd", f"topcell={topcell}"]
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    info = json.loads(proc.stdout.strip().splitlines()[-1])
+    return info["dbu"], info["top_cell"]
+
+
+def load_boxes(outdir, layer, kind="boxes"):
+    """
+    Loads the rectangles of a dumped layer as an (n, 4) int64 array of (left, bottom, right, top) in dbu.
+    """
+    path = os.path.join(outdir, f"{layer.replace('/', '_')}.{kind}")
+    return np.fromfile(path, dtype="<i4").astype(np.int64).reshape(-1, 4)
+
+
+def _bucket_entries(boxes, grid):
+    # One entry per grid bucket touched by each box
+    ix1, iy1 = boxes[:, 0] // grid, boxes[:, 1] // grid
+    nx = boxes[:, 2] // grid - ix1 + 1
+    ny = boxes[:, 3] // grid - iy1 + 1
+    counts = nx * ny
+    idx = np.repeat(np.arange(len(boxes)), counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    kx = ix1[idx] + k // ny[idx]
+    ky = iy1[idx] + k % ny[idx]
+    return idx, (kx + KEY_OFFSET) * (2 * KEY_OFFSET) + (ky + KEY_OFFSET)
+
+
+def touching_pairs(a, b, grid):
+    """
+    Returns the pairs of touching or overlapping boxes of two box arrays.
+
+    Both arrays are hashed into the grid buckets they touch, and a pair is kept only in the bucket
+    holding the lower left corner of the intersection of the two boxes, so each pair is found once.
+
+    :param a: An (n, 4) box array
+    :param b: An (m, 4) box array
+    :param grid: The bucket size in dbu
+    :return: Two index arrays (i, j) of the pairs a[i], b[j].
+    """
+    if len(a) == 0 or len(b) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    a_idx, a_keys = _bucket_entries(a, grid)
+    b_idx, b_keys = _bucket_entries(b, grid)
+    order = np.argsort(b_keys, kind="stable")
+    sorted_keys = b_keys[order]
+
+    lo = np.searchsorted(sorted_keys, a_keys, "left")
+    counts = np.searchsorted(sorted_keys, a_keys, "right") - lo
+    entry = np.repeat(np.arange(len(a_keys)), counts)
+    pos = np.repeat(lo, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    i = a_idx[entry]
+    j = b_idx[order[pos]]
+
+    x1 = np.maximum(a[i, 0], b[j, 0])
+    y1 = np.maximum(a[i, 1], b[j, 1])
+    keep = (x1 <= np.minimum(a[i, 2], b[j, 2])) & (y1 <= np.minimum(a[i, 3], b[j, 3]))
+    keep &= (x1 // grid + KEY_OFFSET) * (2 * KEY_OFFSET) + (y1 // grid + KEY_OFFSET) == a_keys[entry]
+    return i[keep], j[keep]
+
+
+def check_size(vias, size):
+    """
+    Returns the mask of the rectangles which aren't squares of the given size.
+    """
+    return (vias[:, 2] - vias[:, 0] != size) | (vias[:, 3] - vias[:, 1] != size)
+
+
+def check_space(vias, space, grid):
+    """
+    Returns the via pairs closer than the given euclidian space, with the box between the two vias.
+
+    :return: The index arrays (i, j) and an (n, 4) array of the gap boxes.
+    """
+    i, j = touching_pairs(vias + np.array([-space, -space, space, space]), vias, grid)
+    keep = i < j
+    i, j = i[keep], j[keep]
+    a, b = vias[i], vias[j]
+    dx = np.maximum(np.maximum(b[:, 0] - a[:, 2], a[:, 0] - b[:, 2]), 0)
+    dy = np.maximum(np.maximum(b[:, 1] - a[:, 3], a[:, 1] - b[:, 3]), 0)
+    close = dx * dx + dy * dy < space * space
+    i, j, a, b = i[close], j[close], a[close], b[close]
+
+    # Between the facing edges, or the overlap of the projections when the vias face each other
+    inner = np.maximum(a[:, :2], b[:, :2])
+    outer = np.minimum(a[:, 2:], b[:, 2:])
+    gaps = np.hstack([np.minimum(inner, outer), np.maximum(inner, outer)])
+    return i, j, gaps
+
+
+def check_enclosure(vias, metal, odd_metal, enclosure, grid):
+    """
+    Checks the enclosure of the vias by the rectangles of a metal layer.
+
+    The metal rectangles don't overlap, a via is enclosed when they cover the via enlarged
+    by the enclosure completely.
+
+    :return: The masks of the violating and of the undecided vias (touching non manhattan metal).
+    """
+    grown = vias + np.array([-enclosure, -enclosure, enclosure, enclosure])
+    i, j = touching_pairs(grown, metal, grid)
+    w = np.minimum(grown[i, 2], metal[j, 2]) - np.maximum(grown[i, 0], metal[j, 0])
+    h = np.minimum(grown[i, 3], metal[j, 3]) - np.maximum(grown[i, 1], metal[j, 1])
+    covered = np.bincount(i, weights=(w * h).astype(np.float64), minlength=len(vias))
+    area = ((grown[:, 2] - grown[:, 0]) * (grown[:, 3] - grown[:, 1])).astype(np.float64)
+
+    undecided = np.zeros(len(vias), dtype=bool)
+    undecided[touching_pairs(grown, odd_metal, grid)[0]] = True
+
+    violating = (covered < area) & ~undecided
+    return violating, undecided
+
+
+def check_vias(gds_path, topcell, layers, grid_um):
+    """
+    Runs the fast checks on the selected via layers.
+
+    :param gds_path: The path to the GDS file
+    :param topcell: The checked top cell, None for the top cell of the layout
+    :param layers: The via layers to check, names of VIA_RULES
+    :param grid_um: The bucket size in um of the neighbour search
+    :return: The database unit, the top cell name, the {via layer: via boxes} and the
+             {rule: {"markers": boxes, "flagged": via indexes, "via_layer": name, "undecided": n}} results.
+    """
+    vias = [VIA_RULES[l][0] for l in layers]
+    metals = sorted({m for l in layers for _, m, _ in VIA_RULES[l][5]})
+
+    tmp = tempfile.mkdtemp(prefix="gf180mcu_vias_")
+    try:
+        dbu, top_cell = dump_boxes(gds_path, topcell, vias, metals, tmp)
+        boxes = {spec: load_boxes(tmp, spec) for spec in vias + metals}
+        odd = {spec: load_boxes(tmp, spec, "other") for spec in vias + metals}
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    grid = int(round(grid_um / dbu))
+    results = {}
+    via_boxes = {}
+    for layer in layers:
+        spec, size_rule, size, space_rule, space, enclosures = VIA_RULES[layer]
+        rects = boxes[spec]
+        via_boxes[layer] = np.vstack([rects, odd[spec]])
+
+        # Odd vias (not rectangles) always violate the exact size
+        bad = np.flatnonzero(check_size(rects, int(round(size / dbu))))
+        bad = np.concatenate([bad, len(rects) + np.arange(len(odd[spec]))])
+        results[size_rule] = {"markers": via_boxes[layer][bad], "flagged": bad, "via_layer": layer,
+                              "undecided": 0}
+
+        i, j, gaps = check_space(rects, int(round(space / dbu)), grid)
+        results[space_rule] = {"markers": gaps, "flagged": np.unique(np.concatenate([i, j])), "via_layer": layer,
+                               "undecided": len(odd[spec])}
+
+        for rule, metal, enclosure in enclosures:
+            violating, undecided = check_enclosure(rects, boxes[metal], odd[metal], int(round(enclosure / dbu)), grid)
+            flagged = np.flatnonzero(violating)
+            results[rule] = {"markers": rects[flagged], "flagged": flagged, "via_layer": layer,
+                             "undecided": int(undecided.sum()) + len(odd[spec])}
+    return dbu, top_cell, via_boxes, results
+
+
+def write_lyrdb(results, output, top_cell, dbu):
+    """
+    Writes the markers of the fast checks as a lyrdb, with the rule descriptions of the main rule deck.
+    """
+    deck = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gf180mcu.drc")
+    descriptions = {r["name"]: r["description"] for r in get_rules([deck])}
+    categories = [(rule, descriptions.get(rule, rule)) for rule in results]
+
+    with LyrdbWriter(output, "GF180MCU fast via checks", top_cell, categories, {top_cell: []},
+                     "drc_via_check.py") as writer:
+        for rule, result in results.items():
+            for left, bottom, right, top in result["markers"] * dbu:
+                writer.add_item(rule, top_cell, [f"box: ({left:.3f},{bottom:.3f};{right:.3f},{top:.3f})"])
+    return output
+
+
+def compare_results(results, via_boxes, lyrdb_path, dbu, grid_um):
+    """
+    Cross-checks the fast checks against a flat rule deck run, via by via.
+
+    A via is flagged by the rule deck when a marker of the rule touches it.
+
+    :return: A dict of {rule: (fast flagged, deck flagged, both, fast only, deck only)}.
+    """
+    markers = {rule: [] for rule in results}
+    for category, _, values, _ in iter_items(lyrdb_path):
+        if category in markers:
+            markers[category] += [b for b in (value_bbox(v) for v in values) if b is not None]
+
+    grid = int(round(grid_um / dbu))
+    comparison = {}
+    for rule, result in results.items():
+        vias = via_boxes[result["via_layer"]]
+        deck_boxes = np.rint(np.array(markers[rule], dtype=np.float64).reshape(-1, 4) / dbu).astype(np.int64)
+        deck = set(np.unique(touching_pairs(vias, deck_boxes, grid)[0]).tolist())
+        fast = set(np.asarray(result["flagged"]).tolist())
+        comparison[rule] = (len(fast), len(deck), len(fast & deck), len(fast - deck), len(deck - fast))
+    return comparison
+
+
+def main():
+
+    gds_path = os.path.abspath(arguments["--path"])
+    layers = arguments["--layer"] or list(VIA_RULES)
+    for layer in layers:
+        if layer not in VIA_RULES:
+            logging.error(f"Unknown via layer {layer}, allowed: {', '.join(VIA_RULES)}")
+            exit(1)
+
+    output = arguments["--output"] or f"{os.path.splitext(gds_path)[0]}_vias.lyrdb"
+    dbu, top_cell, via_boxes, results = check_vias(gds_path, arguments["--topcell"], layers, float(arguments["--grid"]))
+    write_lyrdb(results, output, top_cell, dbu)
+
+    for layer in layers:
+        logging.info(f"{layer}: {len(via_boxes[layer])} vias checked")
+    for rule, result in results.items():
+        undecided = f", {result['undecided']} vias left to the rule decks" if result["undecided"] else ""
+        logging.info(f"{rule}: {len(result['markers'])} violations{undecided}")
+    logging.info(f"Fast via check results saved at: {output}")
+
+    if arguments["--compare"]:
+        comparison = compare_results(results, via_boxes, arguments["--compare"], dbu, float(arguments["--grid"]))
+        print(f"{'rule':<8} {'fast':>8} {'deck':>8} {'both':>8} {'fast only':>10} {'deck only':>10}")
+        mismatches = 0
+        for rule, (fast, deck, both, fast_only, deck_only) in comparison.items():
+            print(f"{rule:<8} {fast:>8} {deck:>8} {both:>8} {fast_only:>10} {deck_only:>10}")
+            mismatches += fast_only + deck_only
+        if mismatches:
+            logging.error(f"Fast via checks and rule decks disagree on {mismatches} vias.")
+            exit(1)
+        logging.info("Fast via checks agree with the rule decks.")
+
+# ================================================================
+# -------------------------- MAIN --------------------------------
+# ================================================================
+
+if __name__ == "__main__":
+
+    # logs format
+    logging.basicConfig(level=logging.DEBUG, format=f"%(asctime)s | %(levelname)-7s | %(message)s", datefmt='%d-%b-%Y %H:%M:%S')
+
+    # arguments
+    arguments = docopt(__doc__, version='DRC VIA CHECK: 0.1')
+
+    # Calling main function
+    main()
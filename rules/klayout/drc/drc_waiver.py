@@ -0,0 +1,226 @@
+# Copyright 2022 GlobalFoundries PDK Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Apply waivers to GlobalFoundries 180nm MCU DRC results.
+
+Usage:
+    drc_waiver.py (--help| -h)
+    drc_waiver.py (--lyrdb=<lyrdb>) (--waiver=<waiver_file>) [--output=<output_name>] [--batch=<batch>]
+
+Options:
+    --help -h                           Print this help message.
+    --lyrdb=<lyrdb>                     The lyrdb of the DRC run.
+    --waiver=<waiver_file>              The waiver csv file (Rule_Name, Cell, Left, Bottom, Right, Top, Comment).
+    --output=<output_name>              Output name of the split lyrdbs and hits csv. Default is the lyrdb name.
+    --batch=<batch>                     Number of markers filtered per vectorized batch. [default: 200000]
+
+Waiver file:
+    Each row waives the markers of one rule in one cell, use "*" as cell to waive the rule in all cells.
+    If Left, Bottom, Right and Top are given (in um), only the markers inside that region are waived.
+"""
+
+from docopt import docopt
+import os
+import csv
+import logging
+import numpy as np
+
+from drc_lyrdb import read_header, iter_items, value_bbox, LyrdbWriter
+
+# Bucket size in um of the region waivers index
+BUCKET = 50.0
+
+
+class WaiverSet:
+    """
+    Waivers indexed by (rule, cell), region waivers are further bucketed on a grid.
+
+    :param rows: A list of waiver dicts read from the waiver file
+    :param bucket: The bucket size in um of the region index
+    """
+
+    def __init__(self, rows, bucket=BUCKET):
+        self.rows = rows
+        self.bucket = bucket
+        self.hits = np.zeros(len(rows), dtype=np.int64)
+        self.full = {}
+        self.regions = {}
+
+        for i, row in enumerate(rows):
+            key = (row["rule"], row["cell"])
+            if row["region"] is None:
+                self.full.setdefault(key, i)
+                continue
+            left, bottom, right, top = row["region"]
+            buckets = self.regions.setdefault(key, {})
+            for bx in range(int(left // bucket), int(right // bucket) + 1):
+                for by in range(int(bottom // bucket), int(top // bucket) + 1):
+                    buckets.setdefault((bx, by), []).append(i)
+
+        self.boxes = np.array([r["region"] or (0, 0, 0, 0) for r in rows], dtype=np.float64).reshape(-1, 4)
+
+    def keys(self, rule, cell):
+        return (rule, cell), (rule, "*")
+
+    def filter(self, rule, cell, bboxes):
+        """
+        Finds the waiver of each marker of one (rule, cell) batch.
+
+        :param rule: The rule name of the batch
+        :param cell: The cell name of the batch
+        :param bboxes: A (n, 4) array of marker bboxes
+        :return: An array of n waiver indices, -1 for unwaived markers.
+        """
+        n = len(bboxes)
+        waiver = np.full(n, -1, dtype=np.int64)
+
+        for key in self.keys(rule, cell):
+            if key in self.full:
+                waiver[waiver < 0] = self.full[key]
+                self.hits[self.full[key]] += n
+                return waiver
+
+        region_keys = [key for key in self.keys(rule, cell) if self.regions.get(key)]
+        if not region_keys:
+            return waiver
+
+        # The bucket of the marker center holds every region that may contain the marker,
+        # the markers are grouped by bucket once and each group is only tested against its bucket
+        with np.errstate(invalid="ignore"):
+            centers = np.floor((bboxes[:, 0:2] + bboxes[:, 2:4]) / 2 / self.bucket)
+        valid = np.nonzero(np.isfinite(centers).all(axis=1))[0]
+        cells, inverse = np.unique(centers[valid].astype(np.int64), axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        order = np.argsort(inverse, kind="stable")
+        groups = np.split(valid[order], np.cumsum(np.bincount(inverse, minlength=len(cells)))[:-1])
+
+        for key in region_keys:
+            buckets = self.regions[key]
+            for (kx, ky), members in zip(cells.tolist(), groups):
+                candidates = buckets.get((kx, ky))
+                if candidates is None:
+                    continue
+                sel = members[waiver[members] < 0]
+                if len(sel) == 0:
+                    continue
+                regions = self.boxes[candidates]
+                boxes = bboxes[sel]
+                inside = ((boxes[:, None, 0] >= regions[None, :, 0]) & (boxes[:, None, 1] >= regions[None, :, 1]) &
+                          (boxes[:, None, 2] <= regions[None, :, 2]) & (boxes[:, None, 3] <= regions[None, :, 3]))
+                found = inside.any(axis=1)
+                first = np.asarray(candidates)[inside.argmax(axis=1)]
+                waiver[sel[found]] = first[found]
+
+        np.add.at(self.hits, waiver[waiver >= 0], 1)
+        return waiver
+
+
+def read_waivers(waiver_file):
+    """
+    Reads the waiver csv file.
+
+    :param waiver_file: The path to the waiver file
+    :return: A list of waiver dicts with rule, cell, region and comment.
+    """
+    rows = []
+    with open(waiver_file, "r") as f:
+        for row in csv.DictReader(f):
+            coords = [row.get(c, "") or "" for c in ("Left", "Bottom", "Right", "Top")]
+            region = tuple(float(c) for c in coords) if all(c.strip() for c in coords) else None
+            rows.append({"rule": row["Rule_Name"].strip(), "cell": (row.get("Cell") or "*").strip(),
+                         "region": region, "comment": row.get("Comment", "")})
+    return rows
+
+
+def apply_waivers(lyrdb, waiver_file, output=None, batch=200000):
+    """
+    Splits a lyrdb into waived and unwaived markers and counts the hits of each waiver.
+
+    :param lyrdb: The path to the lyrdb of the DRC run
+    :param waiver_file: The path to the waiver file
+    :param output: Output name of the split lyrdbs and hits csv
+    :param batch: Number of markers filtered per vectorized batch
+    :return: The paths of the unwaived lyrdb and the hits csv.
+    """
+    if output is None:
+        output = lyrdb.replace(".lyrdb", "")
+
+    waivers = WaiverSet(read_waivers(waiver_file))
+    header = read_header(lyrdb)
+
+    def flush(pending, waived, unwaived):
+        for (rule, cell), markers in pending.items():
+            bboxes = np.array([m[1] for m in markers], dtype=np.float64).reshape(-1, 4)
+            for marker, waiver in zip(markers, waivers.filter(rule, cell, bboxes)):
+                if waiver >= 0:
+                    waived.add_item(rule, cell, marker[0], marker[2])
+                else:
+                    unwaived.add_item(rule, cell, marker[0], marker[2])
+        pending.clear()
+
+    args = (header["description"], header["top_cell"], header["categories"], header["cells"], header["generator"])
+    with LyrdbWriter(f"{output}_waived.lyrdb", *args) as waived, LyrdbWriter(f"{output}_unwaived.lyrdb", *args) as unwaived:
+        pending = {}
+        count = 0
+        for rule, cell, values, multiplicity in iter_items(lyrdb):
+            boxes = [b for b in (value_bbox(v) for v in values) if b is not None]
+            if boxes:
+                bbox = (min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes))
+            else:
+                bbox = (np.inf, np.inf, -np.inf, -np.inf)
+            pending.setdefault((rule, cell), []).append((values, bbox, multiplicity))
+            count += 1
+            if count % batch == 0:
+                flush(pending, waived, unwaived)
+        flush(pending, waived, unwaived)
+
+    with open(f"{output}_waiver_hits.csv", "w") as f:
+        writer = csv.writer(f, delimiter=",")
+        writer.writerow(["Rule_Name", "Cell", "Left", "Bottom", "Right", "Top", "Comment", "Hits"])
+        for row, hits in zip(waivers.rows, waivers.hits):
+            region = list(row["region"]) if row["region"] else ["", "", "", ""]
+            writer.writerow([row["rule"], row["cell"]] + region + [row["comment"], int(hits)])
+
+    stale = [f"{r['rule']}:{r['cell']}" for r, h in zip(waivers.rows, waivers.hits) if h == 0]
+    logging.info(f"Waived {waived.count} of {count} markers in {lyrdb}, unwaived markers at {output}_unwaived.lyrdb")
+    if stale:
+        logging.warning(f"{len(stale)} waivers didn't match any marker, check {output}_waiver_hits.csv")
+
+    return f"{output}_unwaived.lyrdb", f"{output}_waiver_hits.csv"
+
+
+def main():
+
+    for path in (arguments["--lyrdb"], arguments["--waiver"]):
+        if not os.path.exists(path):
+            logging.error(f"The file {path} doesn't exist, please recheck.")
+            exit()
+
+    apply_waivers(arguments["--lyrdb"], arguments["--waiver"], arguments["--output"], int(arguments["--batch"]))
+
+# ================================================================
+# -------------------------- MAIN --------------------------------
+# ================================================================
+
+if __name__ == "__main__":
+
+    # logs format
+    logging.basicConfig(level=logging.DEBUG, format=f"%(asctime)s | %(levelname)-7s | %(message)s", datefmt='%d-%b-%Y %H:%M:%S')
+
+    # arguments
+    arguments = docopt(__doc__, version='DRC WAIVER: 0.1')
+
+    # Calling main function
+    main()
@@ -0,0 +1,244 @@
+# Copyright 2022 GlobalFoundries PDK Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Generate the GlobalFoundries 180nm MCU rule deck shards from the main rule deck.
+
+Usage:
+    gen_rule_decks.py (--help| -h)
+    gen_rule_decks.py [--deck=<deck>] [--output=<output_dir>] [--by_cost=<shards>] [--run_mode=<run_mode>]
+    gen_rule_decks.py (--check=<shards_dir>) [--deck=<deck>]
+
+Options:
+    --help -h                           Print this help message.
+    --deck=<deck>                       The main rule deck to split. [default: gf180mcu.drc]
+    --output=<output_dir>               Output directory of the shards. [default: rule_decks_gen]
+    --by_cost=<shards>                  Split into this many shards of balanced recorded rule time, instead of one shard per rule group.
+    --run_mode=<run_mode>               Run mode of the recorded rule times used by --by_cost. [default: flat]
+    --check=<shards_dir>                Check that the shards of a directory are equivalent to the main rule deck.
+
+Each shard is a copy of the main deck with the rules of the other shards left out, together
+with the derivations and layer reads that no rule of the shard uses (drc_catalog.prune_deck).
+The prologue (file setup, switches, connectivity, functions) is shared verbatim. By default
+there is one shard per rule group of the main deck (its banner sections, e.g. VIA1), otherwise
+the rules are packed into shards of about equal recorded run time (see drc_history.py).
+
+The check is structural: every rule of the main deck is in exactly one shard, each shard rule
+runs the same code as in the main deck (its lines and the definitions it depends on, under the
+same switch guards), every code line of a shard is a line of the main deck, and every layer a
+shard reads is defined in it. It doesn't run klayout, so it catches pruning mistakes but isn't
+a proof that the shard outputs add up to the main deck output.
+"""
+
+from docopt import docopt
+import os
+import logging
+
+import numpy as np
+
+from drc_catalog import load_deck, prune_deck, undefined_reads, _code
+import drc_history
+
+GENERATED_NOTE = "# Generated by gen_rule_decks.py from {deck}, edit the main rule deck and regenerate instead."
+
+
+def shard_name(section):
+    """
+    Returns the shard file name of a rule group, e.g. "P+ POLY RESISTOR" gives "p+_poly_resistor.drc".
+    """
+    return section.lower().replace(" ", "_") + ".drc"
+
+
+def shards_by_group(catalog):
+    """
+    Returns one shard per rule group (banner section) of the deck.
+
+    :return: A dict of {shard file name: [rule names]} in deck order.
+    """
+    shards = {}
+    for rule in catalog["rules"]:
+        names = shards.setdefault(shard_name(rule["section"]), [])
+        if rule["name"] not in names:
+            names.append(rule["name"])
+    return shards
+
+
+def shards_by_cost(catalog, count, run_mode):
+    """
+    Packs the rules into shards of about equal recorded run time.
+
+    Rules are placed from the most expensive one to the shard with the least time so far.
+    Rules without recorded time cost the median rule time.
+
+    :return: A dict of {shard file name: [rule names]}, the rules of each shard in deck order.
+    """
+    history = drc_history.load_history(drc_history.rule_history_path())
+    runs = [h for h in history if h["deck"] == catalog["deck"] and h["run_mode"] == run_mode] or \
+           [h for h in history if h["deck"] == catalog["deck"]]
+
+    names = []
+    for rule in catalog["rules"]:
+        if rule["name"] not in names:
+            names.append(rule["name"])
+
+    costs = {}
+    for name in names:
+        times = [h["times"][name] for h in runs if name in h["times"]]
+        if times:
+            costs[name] = float(np.mean(times))
+    default_cost = float(np.median(list(costs.values()))) if costs else 1.0
+
+    loads = [0.0] * count
+    members = [set() for _ in range(count)]
+    for name in sorted(names, key=lambda n: -costs.get(n, default_cost)):
+        i = loads.index(min(loads))
+        loads[i] += costs.get(name, default_cost)
+        members[i].add(name)
+
+    for i, load in enumerate(loads):
+        logging.info(f"Shard {i}: {len(members[i])} rules, {load:.1f}s of recorded rule time")
+    return {f"shard_{i}.drc": [n for n in names if n in members[i]] for i in range(count) if members[i]}
+
+
+def write_shards(deck, shards, output_dir):
+    """
+    Writes one pruned copy of the deck per shard, with a generated note after the license header.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    note = GENERATED_NOTE.format(deck=os.path.basename(deck))
+
+    # Shards of an earlier split would break the check
+    for name in os.listdir(output_dir):
+        path = os.path.join(output_dir, name)
+        if name.endswith(".drc"):
+            with open(path, "r") as f:
+                if "Generated by gen_rule_decks.py" in f.read():
+                    os.remove(path)
+    for name, rules in shards.items():
+        path = os.path.join(output_dir, name)
+        prune_deck(deck, set(rules), path, prune_layers=True)
+        with open(path, "r") as f:
+            lines = f.read().split("\n")
+        header = next((i for i, line in enumerate(lines) if not line.startswith("#")), 0)
+        lines.insert(header, f"\n{note}")
+        with open(path, "w") as f:
+            f.write("\n".join(lines))
+        logging.info(f"{name}: {len(rules)} rules")
+
+
+def rule_code(catalog, lines, rule):
+    """
+    Returns the code a rule runs: its block and the definitions it depends on, without comments and blanks.
+    """
+    numbers = sorted(set(range(rule["lines"][0], rule["lines"][1] + 1)) | set(rule["dep_lines"]))
+    return tuple(c for c in (_code(lines[n - 1]).strip() for n in numbers) if c)
+
+
+def check_shards(deck, shards_dir):
+    """
+    Checks that a directory of shards is equivalent to the main deck, and that each shard defines the layers it reads.
+
+    :return: A list of problem descriptions, empty if the shards are equivalent.
+    """
+    main = load_deck(deck)
+    with open(deck, "r") as f:
+        main_lines = f.read().split("\n")
+    main_code = {c for c in (_code(l).strip() for l in main_lines) if c}
+    main_names = set(main["derived"]) | set(main["layers"])
+
+    main_rules = {}
+    for rule in main["rules"]:
+        main_rules.setdefault(rule["name"], []).append((rule["guards"], rule_code(main, main_lines, rule)))
+
+    problems = []
+    owner = {}
+    for name in sorted(f for f in os.listdir(shards_dir) if f.endswith(".drc")):
+        path = os.path.join(shards_dir, name)
+        shard = load_deck(path)
+        with open(path, "r") as f:
+            lines = f.read().split("\n")
+
+        extra = [n for n, l in enumerate(lines, 1) if _code(l).strip() and _code(l).strip() not in main_code]
+        if extra:
+            problems.append(f"{name}: {len(extra)} code lines aren't in {os.path.basename(deck)}, first at line {extra[0]}")
+
+        # A layer read but never defined fails the whole shard with a NameError
+        for layer, num in sorted(undefined_reads(path, main_names).items(), key=lambda item: item[1]):
+            problems.append(f"{name}: {layer} is read at line {num} but never defined")
+
+        shard_rules = {}
+        for rule in shard["rules"]:
+            shard_rules.setdefault(rule["name"], []).append((rule["guards"], rule_code(shard, lines, rule)))
+
+        for rule, versions in shard_rules.items():
+            if rule in owner:
+                problems.append(f"{rule}: in {owner[rule]} and {name}")
+                continue
+            owner[rule] = name
+            if rule not in main_rules:
+                problems.append(f"{rule}: in {name} but not in {os.path.basename(deck)}")
+            elif versions != main_rules[rule]:
+                problems.append(f"{rule}: the code in {name} differs from {os.path.basename(deck)}")
+
+    for rule in main_rules:
+        if rule not in owner:
+            problems.append(f"{rule}: in no shard")
+    return problems
+
+
+def main():
+
+    deck = arguments["--deck"]
+    if not os.path.exists(deck):
+        logging.error(f"The rule deck {deck} doesn't exist, please recheck.")
+        exit(1)
+
+    if arguments["--check"]:
+        problems = check_shards(deck, arguments["--check"])
+        for problem in problems:
+            logging.error(problem)
+        if problems:
+            logging.error(f"The shards of {arguments['--check']} aren't equivalent to {deck}: {len(problems)} problems.")
+            exit(1)
+        logging.info(f"The shards of {arguments['--check']} are equivalent to {deck}.")
+        return
+
+    catalog = load_deck(deck)
+    if arguments["--by_cost"]:
+        shards = shards_by_cost(catalog, int(arguments["--by_cost"]), arguments["--run_mode"])
+    else:
+        shards = shards_by_group(catalog)
+
+    write_shards(deck, shards, arguments["--output"])
+    problems = check_shards(deck, arguments["--output"])
+    for problem in problems:
+        logging.error(problem)
+    if problems:
+        exit(1)
+    logging.info(f"{len(shards)} shards written to {arguments['--output']} and checked against {deck}.")
+
+# ================================================================
+# -------------------------- MAIN --------------------------------
+# ================================================================
+
+if __name__ == "__main__":
+
+    # logs format
+    logging.basicConfig(level=logging.DEBUG, format=f"%(asctime)s | %(levelname)-7s | %(message)s", datefmt='%d-%b-%Y %H:%M:%S')
+
+    # arguments
+    arguments = docopt(__doc__, version='GEN RULE DECKS: 0.1')
+
+    # Calling main function
+    main()
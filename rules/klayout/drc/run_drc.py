@@ -17,7 +17,7 @@ Run GlobalFoundries 180nm MCU DRC.
 
 Usage:
     run_drc.py (--help| -h)
-    run_drc.py (--path=<file_path>) (--gf180mcu=<combined_options>) [--topcell=<topcell_name>] [--thr=<thr>] [--run_mode=<run_mode>] [--no_feol] [--no_beol] [--connectivity] [--density] [--density_only] [--antenna] [--antenna_only] [--no_offgrid]
+    run_drc.py (--path=<file_path>) (--gf180mcu=<combined_options>) [--topcell=<topcell_name>] [--thr=<thr>] [--run_mode=<run_mode>] [--no_feol] [--no_beol] [--connectivity] [--density] [--density_only] [--antenna] [--antenna_only] [--no_offgrid] [--all_layers] [--no_cache] [--clear_cache] [--estimate] [--cell_rollup] [--expand_cells] [--max_markers_per_rule=<n>] [--profile=<profile>] [--budget=<budget>] [--waiver=<waiver_file>]
 
 Options:
     --help -h                           Print this help message.
@@ -37,17 +37,40 @@ Options:
     --antenna                           Turn on Antenna checks.
     --antenna_only                      Turn on Antenna checks only.
     --no_offgrid                        Turn off OFFGRID checking rules.
+    --all_layers                        Load all layers of the layout, by default only the layers read by the enabled rules are loaded.
+    --no_cache                          Always run klayout, don't reuse or store the reports of identical runs.
+    --clear_cache                       Drop all cached runs before running.
+    --estimate                          Print the estimated run time and peak memory of each run mode and thread count, without running any rule.
+    --cell_rollup                       Report deep mode markers once per cell master with its instance count, and summarize the violations per cell.
+    --expand_cells                      With --cell_rollup, also write the markers at every placement of their cell.
+    --max_markers_per_rule=<n>          Write at most this many markers (a random sample) per rule, the exact counts are kept.
+    --profile=<profile>                 Select the rules of the main runset: full runs all of them, quick only the rules catching the most recorded violations within --budget. [default: full]
+    --budget=<budget>                   Time budget of the quick profile, in seconds or with a s, m or h unit. [default: 300s]
+    --waiver=<waiver_file>              Apply the waivers of the given csv file to the results.
 """
 
 from docopt import docopt
 import os
 import xml.etree.ElementTree as ET
+import csv
+import hashlib
 import logging
 import subprocess
 
-def get_results(rule_deck,rules,lyrdb, type):
+from drc_waiver import apply_waivers
+from drc_jobs import run_jobs
+from drc_lyrdb import merge_lyrdbs, capped_counts, iter_items
+from drc_catalog import rule_names, layers_switch, get_rules, guard_enabled, parse_switches, prune_deck, cache_dir, file_hash
+from drc_autotune import tuned_threads
+import drc_cache
+import drc_history
+import drc_rollup
 
-    mytree = ET.parse(f"{lyrdb}_{type}_gf{arguments['--gf180mcu']}.lyrdb")
+def get_results(rule_deck,rules,lyrdb_path,gf=None):
+
+    gf = arguments['--gf180mcu'] if gf is None else gf
+
+    mytree = ET.parse(lyrdb_path)
     myroot = mytree.getroot()
 
     violated = []
@@ -59,14 +82,18 @@ def get_results(rule_deck,rules,lyrdb, type):
                 violated.append(lrule)
                 break
 
-    lyrdb_clean = lyrdb.split("/") [-1]
+    lyrdb_clean = lyrdb_path.split("/") [-1]
 
     if len(violated) > 0:
-        logging.error(f"\nTotal # of DRC violations in {rule_deck}.drc is {len(violated)}. Please check {lyrdb_clean}_{type}_gf{arguments['--gf180mcu']}.lyrdb file For more details")
+        logging.error(f"\nTotal # of DRC violations in {rule_deck}.drc is {len(violated)}. Please check {lyrdb_clean} file For more details")
         logging.info("Klayout GDS DRC Not Clean")
         logging.info(f"Violated rules are : {violated}\n")
+        capped = capped_counts(lyrdb_path)
+        if capped:
+            logging.warning(f"Markers of {len(capped)} rules were capped, kept / total markers: " +
+                            ", ".join(f"{r}: {kept} / {total}" for r, (kept, total) in sorted(capped.items())))
     else:
-        logging.info(f"\nCongratulations !!. No DRC Violations found in {lyrdb_clean} for {rule_deck}.drc rule deck with switch gf{arguments['--gf180mcu']}")
+        logging.info(f"\nCongratulations !!. No DRC Violations found in {lyrdb_clean} for {rule_deck}.drc rule deck with switch gf{gf}")
         logging.info("Klayout GDS DRC Clean\n")
 
 def get_top_cell_names(gds_path):
@@ -94,7 +121,7 @@ def clean_gds_from_many_top_cells(gds_path, topcell):
     basename = os.path.basename(gds_path)
     dirname = os.path.dirname(gds_path)
     main_file_name = basename.split(".")[0]
-    output_file_path = os.path.join(dirname, "{}_single_top.gds.gz".format(main_file_name))
+    output_file_path = os.path.join(dirname, "{}_{}.gds.gz".format(main_file_name, topcell))
 
     proc = subprocess.Popen(['klayout','-b', '-r', f"{pdk_root}/{pdk}/utils/keep_single_top_cell.rb", "-rd", "infile={}".format(gds_path), "-rd", "topcell={}".format(topcell), "-rd", "outfile={}".format(output_file_path)], stdout=subprocess.PIPE)
 
@@ -105,31 +132,13 @@ def clean_gds_from_many_top_cells(gds_path, topcell):
         print(line.strip())
     return output_file_path
 
-def main():
-
-    # check gds file existance
-    if os.path.exists(arguments["--path"]):
-        pass
-    else:
-        logging.error("The input GDS file path doesn't exist, please recheck.")
-        exit()
-
-    # Env. variables
-    pdk_root = os.environ['PDK_ROOT']
-    pdk      = os.environ['PDK']
-
-    # ======= Checking Klayout version =======
-    klayout_v_ = os.popen("klayout -v").read()
-    klayout_v_ = klayout_v_.split("\n")[0]
-    klayout_v  = int (klayout_v_.split(".") [-1])
+def build_switches(arguments):
+    """
+    It builds the klayout switches of the rule decks from the script arguments.
 
-    logging.info(f"Your Klayout version is: {klayout_v_}"  )
-
-    if klayout_v < 8:
-        logging.info(f"Prerequisites at a minimum: KLayout 0.27.8")
-        logging.error("Using this klayout version has not been assesed in this development. Limits are unknown")
-
-    # Switches used in run
+    :param arguments: The docopt arguments of the script
+    :return: The switches string passed to klayout.
+    """
     switches = ''
 
     if arguments["--run_mode"] in ["flat" , "deep", "tiling"]:
@@ -160,6 +169,311 @@ def main():
     if arguments["--density"]:      switches = switches + '-rd density=true '
     else:                           switches = switches + '-rd density=false '
 
+    if arguments.get("--max_markers_per_rule"):
+        switches = switches + f'-rd max_markers_per_rule={int(arguments["--max_markers_per_rule"])} '
+
+    return switches
+
+# Rule deck and log label of each report
+RUNSETS = {"main_drc": ("gf180mcu.drc",         "main Global Foundries 180nm MCU runset"),
+           "antenna":  ("gf180mcu_antenna.drc", "Global Foundries 180nm MCU antenna checks"),
+           "density":  ("gf180mcu_density.drc", "Global Foundries 180nm MCU density checks")}
+
+# Pruned rule decks replacing the full ones, see --profile
+PROFILE_DECKS = {}
+
+def runset_deck(runset):
+    """
+    It returns the path of the rule deck run for a report, the pruned deck of the selected profile if any.
+    """
+    return PROFILE_DECKS.get(runset, f"{os.environ['PDK_ROOT']}/{os.environ['PDK']}/{RUNSETS[runset][0]}")
+
+def selected_runsets(arguments):
+    """
+    It returns the reports selected by the script arguments, in run order.
+
+    :param arguments: The docopt arguments of the script
+    :return: A list of RUNSETS keys.
+    """
+    if arguments["--antenna_only"] or arguments["--density_only"]:
+        return [r for r, opt in [("antenna", "--antenna_only"), ("density", "--density_only")] if arguments[opt]]
+    return ["main_drc"] + [r for r, opt in [("antenna", "--antenna"), ("density", "--density")] if arguments[opt]]
+
+def run_drc_decks(path, topcell_name, name_clean_, thr, switches):
+    """
+    It runs the selected rule decks on one top cell of the design.
+
+    :param path: The path to the GDS file
+    :param topcell_name: The top cell to check
+    :param name_clean_: The path prefix of the output lyrdb files
+    :param thr: Number of threads used by each klayout run
+    :param switches: The switches passed to the rule decks
+    :return: A dict of {runset: klayout exit status}.
+    """
+    name_clean = name_clean_.split("/")[-1]
+    gf = arguments['--gf180mcu']
+    switches = switches + f'-rd topcell={topcell_name}'
+    deck_dir = f"{os.environ['PDK_ROOT']}/{os.environ['PDK']}"
+    statuses = {}
+
+    # Running DRC using klayout
+    for runset in selected_runsets(arguments):
+        deck, label = RUNSETS[runset]
+
+        # Without --thr, each deck uses its tuned thread count (see drc_autotune.py) within thr
+        deck_thr = min(thr, tuned_threads(deck, path, thr)) if arguments["--thr"] == None else thr
+
+        # Each deck loads only the layers read by its enabled rules, see drc_catalog.needed_layers
+        layers = "" if arguments["--all_layers"] else layers_switch([f"{deck_dir}/{deck}"], switches)
+
+        # The connectivity rules load the nets saved by an earlier run on the same layout, or save theirs
+        l2n = l2n_file = ""
+        if runset == "main_drc" and arguments["--connectivity"] and not arguments["--no_cache"]:
+            l2n_file = drc_cache.l2n_path(path, topcell_name, f"{deck_dir}/{deck}")
+            if os.path.exists(l2n_file):
+                os.utime(l2n_file)
+                l2n = f"-rd l2n_in={l2n_file} "
+            else:
+                l2n = f"-rd l2n_out={l2n_file}.tmp "
+
+        # The rule times of the main runset feed the quick profile
+        report = f"{name_clean_}_{runset}_gf{gf}.lyrdb"
+        rule_times = {} if runset == "main_drc" else None
+
+        logging.info(f"Running {label} on design {name_clean} on cell {topcell_name}:")
+        wall, rss_mb, status = drc_history.run_measured(f"klayout -b -r {runset_deck(runset)} -rd input={path} -rd report={report} -rd thr={deck_thr} {layers}{l2n}{switches}", rule_times)
+        statuses[runset] = status
+        if status != 0:
+            logging.error(f"{label} failed on cell {topcell_name} with exit status {status}.")
+
+        if l2n_file and status == 0 and os.path.exists(f"{l2n_file}.tmp"):
+            drc_cache.store_l2n(f"{l2n_file}.tmp", l2n_file)
+
+        # Finished runs feed the --estimate mode, pruned decks would skew it
+        if status == 0 and runset not in PROFILE_DECKS:
+            drc_history.record(path, f"{deck_dir}/{deck}", switches, arguments["--run_mode"], deck_thr, wall, rss_mb, topcell_name)
+
+        if status == 0 and rule_times and os.path.exists(report):
+            hits = {}
+            for category, _, _, multiplicity in iter_items(report):
+                hits[category] = hits.get(category, 0) + multiplicity
+            drc_history.record_rules(path, f"{deck_dir}/{deck}", switches, arguments["--run_mode"], wall, rule_times, hits, topcell_name)
+
+    return statuses
+
+def run_single_top(path, topcell_name, name_clean_, thr, switches):
+    """
+    It extracts one top cell of a GDS file with many top cells and runs DRC on it.
+
+    :param path: The path to the GDS file
+    :param topcell_name: The top cell to extract and check
+    :param name_clean_: The path prefix of the output lyrdb files of this top cell
+    :param thr: Number of threads used by each klayout run
+    :param switches: The switches passed to the rule decks
+    :return: A dict of {runset: klayout exit status}.
+    """
+    top_path = clean_gds_from_many_top_cells(path, topcell_name)
+    statuses = run_drc_decks(top_path, topcell_name, name_clean_, thr, switches)
+    if os.path.exists(top_path):
+        os.remove(top_path)
+    return statuses
+
+def run_multi_top(path, tc_list, name_clean_, switches):
+    """
+    It runs DRC on each top cell concurrently with a shared thread budget, then merges
+    the results of all top cells into one report per rule deck.
+
+    :param path: The path to the GDS file
+    :param tc_list: The top cell names of the GDS file
+    :param name_clean_: The path prefix of the merged lyrdb files
+    :param switches: The switches passed to the rule decks
+    :return: The top cells whose runs failed, their markers are missing from the merged reports.
+    """
+    gf = arguments['--gf180mcu']
+    thr = max(1, thrCount // len(tc_list))
+
+    jobs = []
+    for topcell_name in tc_list:
+        jobs.append((topcell_name, thr, run_single_top, (path, topcell_name, f"{name_clean_}_{topcell_name}", thr, switches)))
+    results = run_jobs(jobs, thrCount)
+
+    failed = [t for t in tc_list if results[t] is None or any(status != 0 for status in results[t].values())]
+    if failed:
+        logging.error(f"DRC failed on the top cells {failed}, the merged reports don't cover them.")
+
+    for lyrdb in ["main_drc", "antenna", "density"]:
+        tops = [t for t in tc_list if os.path.exists(f"{name_clean_}_{t}_{lyrdb}_gf{gf}.lyrdb")]
+        if len(tops) == 0:
+            continue
+        inputs = [f"{name_clean_}_{t}_{lyrdb}_gf{gf}.lyrdb" for t in tops]
+
+        # Record the top cell on every marker
+        def add_top(i, category, cell, values):
+            return values + [f"text: 'top_cell={tops[i]}'"]
+
+        merge_lyrdbs(inputs, f"{name_clean_}_{lyrdb}_gf{gf}.lyrdb", add_top)
+        for lyrdb_path in inputs:
+            os.remove(lyrdb_path)
+
+    return failed
+
+def report_cells(path, lyrdb_path):
+    """
+    It attaches the instance count of their cell master to the markers of a deep mode report,
+    logs and saves the per cell summary, and expands the markers to every placement if asked.
+
+    :param path: The path to the GDS file
+    :param lyrdb_path: The path to the lyrdb file
+    """
+    topcells = [arguments["--topcell"]] if arguments["--topcell"] else get_top_cell_names(path)
+    summary = drc_rollup.rollup_lyrdb(lyrdb_path, drc_rollup.cell_placements(path, topcells))
+    drc_rollup.log_cell_summary(summary)
+    csv_path = lyrdb_path.replace(".lyrdb", "_cells.csv")
+    drc_rollup.write_cell_summary(summary, csv_path)
+    logging.info(f"Per cell summary at {csv_path}")
+
+    if arguments["--expand_cells"]:
+        if len(topcells) > 1:
+            logging.warning("Expanding the markers of layouts with many top cells isn't supported, please select one with --topcell.")
+            return
+        expanded_path = lyrdb_path.replace(".lyrdb", "_expanded.lyrdb")
+        count = drc_rollup.expand_lyrdb(path, lyrdb_path, expanded_path, topcells[0])
+        if count is None:
+            logging.error(f"Expanding the markers of {lyrdb_path} failed.")
+        else:
+            logging.info(f"{count} markers expanded to all placements at {expanded_path}")
+
+def parse_budget(budget):
+    """
+    It converts a time budget like 300, 300s, 5m or 1h to seconds.
+    """
+    units = {"s": 1, "m": 60, "h": 3600}
+    budget = budget.strip().lower()
+    if budget[-1:] in units:
+        return float(budget[:-1]) * units[budget[-1]]
+    return float(budget)
+
+def quick_profile(path, switches):
+    """
+    It selects the rules of the main runset catching the most recorded violations within the
+    time budget, and prunes the main rule deck to them for this run.
+
+    :param path: The path to the GDS file
+    :param switches: The switches passed to the rule decks
+    :return: The {rule: (estimated seconds, hit rate)} of the skipped rules.
+    """
+    deck = f"{os.environ['PDK_ROOT']}/{os.environ['PDK']}/{RUNSETS['main_drc'][0]}"
+    census = drc_history.layout_census(path, arguments["--topcell"])
+    if census is None:
+        logging.error("Couldn't read the layout census, please check the GDS file.")
+        exit(1)
+
+    enabled = []
+    for rule in get_rules([deck]):
+        if rule["name"] not in enabled and guard_enabled(rule["guards"], parse_switches(switches)):
+            enabled.append(rule["name"])
+
+    budget = parse_budget(arguments["--budget"])
+    selected, stats = drc_history.select_rules(census, deck, switches, arguments["--run_mode"], enabled, budget)
+
+    digest = hashlib.sha1(f"{file_hash(deck)}\n{' '.join(sorted(selected))}".encode()).hexdigest()
+    pruned = os.path.join(cache_dir("profiles"), f"quick_{digest[:16]}.drc")
+    if not os.path.exists(pruned):
+        prune_deck(deck, set(selected), f"{pruned}.{os.getpid()}")
+        os.replace(f"{pruned}.{os.getpid()}", pruned)
+    PROFILE_DECKS["main_drc"] = pruned
+
+    estimated = sum(stats[r][0] for r in selected)
+    logging.info(f"Quick profile: {len(selected)} of {len(enabled)} rules selected for a {budget:.0f}s budget, "
+                 f"estimated {estimated:.0f}s of rule time.")
+    return {r: stats[r] for r in enabled if r not in selected}
+
+def estimate_run(path, switches):
+    """
+    It prints the estimated wall time and peak RSS of the selected rule decks for each run mode
+    and thread count, from the layout census and the timing history, without running any rule.
+
+    :param path: The path to the GDS file
+    :param switches: The switches passed to the rule decks
+    """
+    deck_dir = f"{os.environ['PDK_ROOT']}/{os.environ['PDK']}"
+    census = drc_history.layout_census(path, arguments["--topcell"])
+    if census is None:
+        logging.error("Couldn't read the layout census, please check the GDS file.")
+        exit(1)
+
+    logging.info(f"Layout census: {census['cells']} cells, {census['instances']} instances, {census['shapes']} shapes "
+                 f"({census['flat_shapes']} flat), bbox area {census['area_um2'] / 1e6:.2f} mm2")
+
+    history = drc_history.load_history()
+    if arguments["--thr"]:
+        threads = [thrCount]
+    else:
+        threads = [1 << i for i in range(os.cpu_count().bit_length()) if 1 << i <= os.cpu_count()]
+
+    print(f"{'deck':<22} {'mode':<7} {'thr':>4} {'wall (s)':>10} {'90% band (s)':>20} {'peak RSS (MB)':>14} {'90% band (MB)':>20}  samples")
+    for runset in selected_runsets(arguments):
+        deck = RUNSETS[runset][0]
+        for run_mode in ["flat", "deep", "tiling"]:
+            for n in threads:
+                est = drc_history.estimate(census, f"{deck_dir}/{deck}", switches, run_mode, n, history)
+                if est is None:
+                    print(f"{deck:<22} {run_mode:<7} {n:>4} {'no timing history':>10}")
+                    continue
+                wall, rss = est["wall"], est["max_rss_mb"]
+                pooled = " (all modes)" if est["pooled"] else ""
+                print(f"{deck:<22} {run_mode:<7} {n:>4} {wall[0]:>10.0f} {f'{wall[1]:.0f} - {wall[2]:.0f}':>20} "
+                      f"{rss[0]:>14.0f} {f'{rss[1]:.0f} - {rss[2]:.0f}':>20}  {est['samples']}{pooled}")
+
+def main():
+
+    # check gds file existance
+    if os.path.exists(arguments["--path"]):
+        pass
+    else:
+        logging.error("The input GDS file path doesn't exist, please recheck.")
+        exit()
+
+    if arguments["--waiver"] and not os.path.exists(arguments["--waiver"]):
+        logging.error("The waiver file path doesn't exist, please recheck.")
+        exit()
+
+    if arguments["--cell_rollup"] and arguments["--run_mode"] != "deep":
+        logging.error("The per cell roll-up needs the hierarchical results of --run_mode=deep.")
+        exit()
+
+    # Env. variables
+    pdk_root = os.environ['PDK_ROOT']
+    pdk      = os.environ['PDK']
+
+    # ======= Checking Klayout version =======
+    klayout_v_ = os.popen("klayout -v").read()
+    klayout_v_ = klayout_v_.split("\n")[0]
+    klayout_v  = int (klayout_v_.split(".") [-1])
+
+    logging.info(f"Your Klayout version is: {klayout_v_}"  )
+
+    if klayout_v < 8:
+        logging.info(f"Prerequisites at a minimum: KLayout 0.27.8")
+        logging.error("Using this klayout version has not been assesed in this development. Limits are unknown")
+
+    # Switches used in run
+    switches = build_switches(arguments)
+
+    if arguments["--estimate"]:
+        estimate_run(arguments["--path"], switches)
+        return
+
+    skipped = {}
+    if arguments["--profile"] == "quick":
+        if arguments["--antenna_only"] or arguments["--density_only"]:
+            logging.error("The quick profile selects rules of the main runset, it can't be used with --antenna_only or --density_only.")
+            exit()
+        skipped = quick_profile(arguments["--path"], switches)
+    elif arguments["--profile"] != "full":
+        logging.error("Allowed profiles are (full , quick) only")
+        exit()
+
     # Generate databases
     if arguments["--path"]:
         path = arguments["--path"]
@@ -167,49 +481,42 @@ def main():
 
         if ".gds" in path:
             name_clean_= path.replace(".gds","")
-            name_clean = name_clean_.split("/")[-1]
-
-            tc_list = get_top_cell_names(path)
-            if len(tc_list) < 2:
-                topcell_name = tc_list[0]
-            else:
-                print("## File has multiple topcell names")
-                # print("## File has multiple topcell names, must provide topcellname.")
-                # if topcell_name is None:
-                print("## Will have to stop.")
-                exit()
-
-            # if not topcell_name is None:
-            switches = switches + f'-rd topcell={topcell_name}'
 
             # Removing old db
             os.system(f"rm -rf {name_clean_}_main_drc_gf{arguments['--gf180mcu']}.lyrdb {name_clean_}_antenna_gf{arguments['--gf180mcu']}.lyrdb {name_clean_}_density_gf{arguments['--gf180mcu']}.lyrdb")
 
-            # Running DRC using klayout
-            if (arguments["--antenna_only"]) and not (arguments["--density_only"]):
-                logging.info(f"Running Global Foundries 180nm MCU antenna checks on design {name_clean} on cell {topcell_name}:")
-                os.system(f"klayout -b -r $PDK_ROOT/$PDK/gf180mcu_antenna.drc -rd input={path} -rd report={name_clean}_antenna_gf{arguments['--gf180mcu']}_gf{arguments['--gf180mcu']}.lyrdb -rd thr={thrCount} {switches}")
-
-            elif (arguments["--density_only"]) and not (arguments["--antenna_only"]):
-                logging.info(f"Running Global Foundries 180nm MCU density checks on design {name_clean} on cell {topcell_name}:")
-                os.system(f"klayout -b -r $PDK_ROOT/$PDK/gf180mcu_density.drc -rd input={path} -rd report={name_clean}_density_gf{arguments['--gf180mcu']}.lyrdb -rd thr={thrCount} {switches}")
-
-            elif arguments["--antenna_only"] and arguments["--density_only"]:
-                logging.info(f"Running Global Foundries 180nm MCU antenna checks on design {name_clean} on cell {topcell_name}:")
-                os.system(f"klayout -b -r $PDK_ROOT/$PDK/gf180mcu_antenna.drc -rd input={path} -rd report={name_clean}_antenna_gf{arguments['--gf180mcu']}.lyrdb -rd thr={thrCount} {switches}")
-
-                logging.info(f"Running Global Foundries 180nm MCU density checks on design {name_clean} on cell {topcell_name}:")
-                os.system(f"klayout -b -r $PDK_ROOT/$PDK/gf180mcu_density.drc -rd input={path} -rd report={name_clean}_density_gf{arguments['--gf180mcu']}.lyrdb -rd thr={thrCount} {switches}")
-
+            if arguments["--clear_cache"]:
+                drc_cache.clear()
+                logging.info("DRC run cache cleared.")
+
+            # Byte-identical runs reuse the stored reports, see drc_cache.py
+            gf = arguments['--gf180mcu']
+            runsets = selected_runsets(arguments)
+            outputs = {r: f"{name_clean_}_{r}_gf{gf}.lyrdb" for r in runsets}
+            run_switches = switches + f'-rd topcell={topcell_name} ' + " ".join(runsets)
+            key = drc_cache.run_key(path, [runset_deck(r) for r in runsets], run_switches, klayout_v_)
+            restored = None if arguments["--no_cache"] else drc_cache.lookup(key, outputs)
+
+            tc_list = [] if restored is not None else get_top_cell_names(path)
+            failed = []
+            if restored is not None:
+                logging.info(f"DRC cache hit {key[:12]}, reusing the reports of an identical run: {', '.join(restored) or 'no reports'}")
+            elif topcell_name in tc_list:
+                statuses = run_drc_decks(path, topcell_name, name_clean_, thrCount, switches)
+                failed = [topcell_name] if any(status != 0 for status in statuses.values()) else []
+            elif topcell_name:
+                logging.error(f"The topcell {topcell_name} isn't a top cell of {path}, its top cells are {tc_list}.")
+                exit(1)
+            elif len(tc_list) < 2:
+                statuses = run_drc_decks(path, tc_list[0], name_clean_, thrCount, switches)
+                failed = [tc_list[0]] if any(status != 0 for status in statuses.values()) else []
             else:
-                logging.info(f"Running main Global Foundries 180nm MCU runset on design {name_clean} on cell {topcell_name}:")
-                os.system(f"klayout -b -r $PDK_ROOT/$PDK/gf180mcu.drc -rd input={path} -rd report={name_clean}_main_drc_gf{arguments['--gf180mcu']}.lyrdb -rd thr={thrCount} {switches}")
-                if arguments["--antenna"]:
-                    logging.info(f"Running Global Foundries 180nm MCU antenna checks on design {name_clean} on cell {topcell_name}:")
-                    os.system(f"klayout -b -r $PDK_ROOT/$PDK/gf180mcu_antenna.drc -rd input={path} -rd report={name_clean}_antenna_gf{arguments['--gf180mcu']}.lyrdb -rd thr={thrCount} {switches}")
-                if arguments["--density"]:
-                    logging.info(f"Running Global Foundries 180nm MCU density checks on design {name_clean} on cell {topcell_name}:")
-                    os.system(f"klayout -b -r $PDK_ROOT/$PDK/gf180mcu_density.drc -rd input={path} -rd report={name_clean}_density_gf{arguments['--gf180mcu']}.lyrdb -rd thr={thrCount} {switches}")
+                logging.info(f"File has multiple topcell names {tc_list}, running DRC on each of them.")
+                failed = run_multi_top(path, tc_list, name_clean_, switches)
+
+            # Only complete runs are stored, a failed klayout run is retried next time
+            if restored is None and not failed and not arguments["--no_cache"] and all(os.path.exists(o) for o in outputs.values()):
+                drc_cache.store(key, outputs, {"path": os.path.abspath(path), "switches": run_switches})
         else:
             logging.error("Script only support gds files, please select one")
             exit()
@@ -221,25 +528,35 @@ def main():
     rule_deck_path = [f"{pdk_root}/{pdk}/gf180mcu.drc" , f"{pdk_root}/{pdk}/gf180mcu_antenna.drc" , f"{pdk_root}/{pdk}/gf180mcu_density.drc"]
 
     # Get rules from rule deck
-    rules = []
-
-    # Get rules from rule deck
-    for runset in rule_deck_path:
-        with open(runset, 'r') as f:
-            for line in f:
-                if ".output" in line:
-                    line_list = line.split('"')
-                    if line_list[1] in rules:
-                        pass
-                    else:
-                        rules.append(line_list[1])
+    rules = rule_names(rule_deck_path)
 
     # Get results
     lyrdbs  = [ "main_drc"     , "antenna"          , "density"         ]
     runsets = [ "gf180mcu"     , "gf180mcu_antenna" , "gf180mcu_density"]
     for i,lyrdb in enumerate(lyrdbs):
-        if os.path.exists(f"{name_clean_}_{lyrdb}_gf{arguments['--gf180mcu']}.lyrdb"):
-            get_results(runsets[i],rules,name_clean_, lyrdb)
+        lyrdb_path = f"{name_clean_}_{lyrdb}_gf{arguments['--gf180mcu']}.lyrdb"
+        if os.path.exists(lyrdb_path):
+            if arguments["--waiver"]:
+                lyrdb_path, _ = apply_waivers(lyrdb_path, arguments["--waiver"])
+            get_results(runsets[i],rules,lyrdb_path)
+            if arguments["--cell_rollup"]:
+                report_cells(path, lyrdb_path)
+
+    # The rules left out by the quick profile are listed with their estimated cost and hit rate
+    if skipped:
+        skipped_path = f"{name_clean_}_main_drc_gf{arguments['--gf180mcu']}_skipped.csv"
+        with open(skipped_path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["rule", "estimated_seconds", "hit_rate"])
+            for rule, (cost, rate) in sorted(skipped.items(), key=lambda kv: -kv[1][1]):
+                writer.writerow([rule, f"{cost:.2f}", f"{rate:.2f}"])
+        logging.warning(f"Quick profile: {len(skipped)} rules were skipped and not checked, see {skipped_path}: "
+                        f"{', '.join(sorted(skipped))}")
+
+    # The results above don't cover the cells of failed klayout runs
+    if failed:
+        logging.error(f"DRC didn't complete on the top cells {failed}, please check the klayout logs above.")
+        exit(1)
 
 # ================================================================
 # -------------------------- MAIN --------------------------------
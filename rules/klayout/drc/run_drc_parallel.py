@@ -5,7 +5,7 @@ Run Globalfoundries 180u DRC.
 
 Usage: 
     run_drc.py (--help| -h)
-    run_drc.py (--path=<file_path>) (--gf180mcu=<combined_options>) [--topcell=<topcell_name>] [--thr=<thr>] [--run_mode=<run_mode>] [--no_feol] [--no_beol] [--connectivity] [--density] [--density_only] [--antenna] [--antenna_only] [--no_offgrid]
+    run_drc.py (--path=<file_path>) (--gf180mcu=<combined_options>) [--topcell=<topcell_name>] [--thr=<thr>] [--run_mode=<run_mode>] [--no_feol] [--no_beol] [--connectivity] [--density] [--density_only] [--antenna] [--antenna_only] [--no_offgrid] [--all_layers] [--no_cache] [--max_markers_per_rule=<n>] [--waiver=<waiver_file>] [--shards=<shards_dir>]
 
 Options:
     --help -h                           Print this help message.
@@ -25,6 +25,11 @@ Options:
     --antenna                           Turn on Antenna checks.
     --antenna_only                      Turn on Antenna checks only.
     --no_offgrid                        Turn off OFFGRID checking rules.     
+    --all_layers                        Load all layers of the layout, by default only the layers read by the enabled rules are loaded.
+    --no_cache                          Extract the connectivity for this run only, don't reuse or store it in the L2N cache.
+    --max_markers_per_rule=<n>          Write at most this many markers (a random sample) per rule, the exact counts are kept.
+    --waiver=<waiver_file>              Apply the waivers of the given csv file to the results.
+    --shards=<shards_dir>               Directory of the rule decks run in parallel, e.g. the output of gen_rule_decks.py. Default is $PDK_ROOT/$PDK/rule_decks.
 """
 
 from docopt import docopt
@@ -32,10 +37,16 @@ import os
 import xml.etree.ElementTree as ET
 import logging
 import subprocess
-import concurrent.futures
 # import logging
 # from multiprocessing import Process, log_to_stderr
 
+from drc_waiver import apply_waivers
+from drc_jobs import run_jobs
+from drc_lyrdb import capped_counts
+import drc_cache
+from drc_catalog import rule_names, layers_switch
+from drc_autotune import tuned_threads
+
 def call_simulator(arg):
     """
     It runs the simulator with the given rule deck and input file, and saves the output to a database
@@ -82,9 +93,9 @@ def combine_results(path, rule_decks):
     os.system(f"mkdir {path_clean}/logs")
     os.system(f"mv *.log {path_clean}/logs")
 
-def get_results(rule_deck,rules,lyrdb, type):
+def get_results(rule_deck,rules,lyrdb_path):
 
-    mytree = ET.parse(f"{lyrdb}_{type}_gf{arguments['--gf180mcu']}.lyrdb")
+    mytree = ET.parse(lyrdb_path)
     myroot = mytree.getroot()
 
     violated = []
@@ -96,12 +107,16 @@ def get_results(rule_deck,rules,lyrdb, type):
                 violated.append(lrule)
                 break
 
-    lyrdb_clean = lyrdb.split("/") [-1]
+    lyrdb_clean = lyrdb_path.split("/") [-1]
        
     if len(violated) > 0:
-        logging.error(f"\nTotal # of DRC violations in {rule_deck}.drc is {len(violated)}. Please check {lyrdb_clean}_{type}_gf{arguments['--gf180mcu']}.lyrdb file For more details")
+        logging.error(f"\nTotal # of DRC violations in {rule_deck}.drc is {len(violated)}. Please check {lyrdb_clean} file For more details")
         logging.info("Klayout GDS DRC Not Clean")
         logging.info(f"Violated rules are : {violated}\n")
+        capped = capped_counts(lyrdb_path)
+        if capped:
+            logging.warning(f"Markers of {len(capped)} rules were capped, kept / total markers: " +
+                            ", ".join(f"{r}: {kept} / {total}" for r, (kept, total) in sorted(capped.items())))
     else:
         logging.info(f"\nCongratulations !!. No DRC Violations found in {lyrdb_clean} for {rule_deck}.drc rule deck with switch gf{arguments['--gf180mcu']}")
         logging.info("Klayout GDS DRC Clean\n")
@@ -150,6 +165,10 @@ def main():
     else:
         logging.error("The input GDS file path doesn't exist, please recheck.")
         exit()
+
+    if arguments["--waiver"] and not os.path.exists(arguments["--waiver"]):
+        logging.error("The waiver file path doesn't exist, please recheck.")
+        exit()
     
     # Env. variables
     pdk_root = os.environ['PDK_ROOT']
@@ -198,6 +217,9 @@ def main():
     if arguments["--density"]:      switches = switches + '-rd density=true '
     else:                           switches = switches + '-rd density=false '
 
+    if arguments["--max_markers_per_rule"]:
+        switches = switches + f'-rd max_markers_per_rule={int(arguments["--max_markers_per_rule"])} '
+
     # Generate databases
     if arguments["--path"]:
         path = arguments["--path"]
@@ -241,15 +263,50 @@ def main():
                                                  
             else:     
                 logging.info(f"Running main Global Foundries 180nm MCU runset on design {name_clean} on cell {topcell_name}:")
-                rule_decks = os.listdir(f"{os.environ['PDK_ROOT']}/{os.environ['PDK']}/rule_decks/")
+                shards_dir = arguments["--shards"] or f"{os.environ['PDK_ROOT']}/{os.environ['PDK']}/rule_decks"
+                rule_decks = sorted(d for d in os.listdir(shards_dir) if d.endswith(".drc"))
+
+                # The connectivity is extracted once by the main deck (with its rules off), the rule decks load it
+                l2n = l2n_file = ""
+                if arguments["--connectivity"]:
+                    main_deck = f"{pdk_root}/{pdk}/gf180mcu.drc"
+                    if arguments["--no_cache"]:
+                        # Extracted again and kept next to the reports until the rule decks are done
+                        l2n_file = f"{name_clean_}_gf{arguments['--gf180mcu']}.l2n"
+                        if os.path.exists(l2n_file):
+                            os.remove(l2n_file)
+                    else:
+                        l2n_file = drc_cache.l2n_path(path, topcell_name, main_deck)
+                    if not os.path.exists(l2n_file):
+                        logging.info(f"Extracting the connectivity of design {name_clean} once for all rule decks:")
+                        conn_switches = (switches.replace("-rd feol=true", "-rd feol=false").replace("-rd beol=true", "-rd beol=false")
+                                         .replace("-rd offgrid=true", "-rd offgrid=false"))
+                        os.system(f"klayout -b -r {main_deck} -rd input={path} -rd report={name_clean_}_l2n.lyrdb -rd thr={thrCount} "
+                                  f"-rd l2n_out={l2n_file}.tmp {'' if arguments['--all_layers'] else layers_switch([main_deck], conn_switches)}{conn_switches}")
+                        if os.path.exists(f"{l2n_file}.tmp") and arguments["--no_cache"]:
+                            os.replace(f"{l2n_file}.tmp", l2n_file)
+                        elif os.path.exists(f"{l2n_file}.tmp"):
+                            drc_cache.store_l2n(f"{l2n_file}.tmp", l2n_file)
+                        if os.path.exists(f"{name_clean_}_l2n.lyrdb"):
+                            os.remove(f"{name_clean_}_l2n.lyrdb")
+                    if os.path.exists(l2n_file):
+                        l2n = f"-rd l2n_in={l2n_file} "
+
+                # Each rule deck gets its share of the threads, or its tuned thread count without --thr,
+                # so all klayout runs together stay within thrCount
                 for i, rule_deck in enumerate(rule_decks):
+                    shard_thr = max(1, thrCount // len(rule_decks))
+                    if arguments["--thr"] == None:
+                        shard_thr = tuned_threads(rule_deck, path, shard_thr)
+                    # Each rule deck loads only the layers read by its enabled rules
+                    shard_layers = "" if arguments["--all_layers"] else layers_switch([f"{shards_dir}/{rule_deck}"], switches)
                     #os.system(f"klayout -b -r $PDK_ROOT/$PDK/gf180mcu.drc -rd input={path} -rd report={name_clean}_main_drc_gf{arguments['--gf180mcu']}.lyrdb -rd thr={thrCount} {switches}")
-                    arg = f"klayout -b -r $PDK_ROOT/$PDK/rule_decks/{rule_deck} -rd input={path} -rd report={name_clean}_main_drc_gf{arguments['--gf180mcu']}_{i}.lyrdb -rd thr={thrCount} {switches} | tee {rule_deck}.log"
-                    runs.append(arg)
+                    arg = f"klayout -b -r {shards_dir}/{rule_deck} -rd input={path} -rd report={name_clean}_main_drc_gf{arguments['--gf180mcu']}_{i}.lyrdb -rd thr={shard_thr} {shard_layers}{l2n}{switches} | tee {rule_deck}.log"
+                    runs.append((rule_deck, shard_thr, call_simulator, (arg,)))
 
-                with concurrent.futures.ProcessPoolExecutor(max_workers=thrCount) as executor:
-                    for run in runs:
-                        executor.submit(call_simulator, run)
+                run_jobs(runs, thrCount)
+                if arguments["--no_cache"] and os.path.exists(l2n_file):
+                    os.remove(l2n_file)
 
                 # log_to_stderr(logging.DEBUG)
 
@@ -278,25 +335,17 @@ def main():
     rule_deck_path = [f"{pdk_root}/{pdk}/gf180mcu.drc" , f"{pdk_root}/{pdk}/gf180mcu_antenna.drc" , f"{pdk_root}/{pdk}/gf180mcu_density.drc"]
 
     # Get rules from rule deck 
-    rules = []
-
-    # Get rules from rule deck 
-    for runset in rule_deck_path:
-        with open(runset, 'r') as f:
-            for line in f:
-                if ".output" in line:
-                    line_list = line.split('"')
-                    if line_list[1] in rules:
-                        pass 
-                    else:
-                        rules.append(line_list[1])            
+    rules = rule_names(rule_deck_path)
 
     # Get results
     lyrdbs  = [ "main_drc"     , "antenna"          , "density"         ]        
     runsets = [ "gf180mcu"     , "gf180mcu_antenna" , "gf180mcu_density"]
     for i,lyrdb in enumerate(lyrdbs):
-        if os.path.exists(f"{name_clean_}_{lyrdb}_gf{arguments['--gf180mcu']}.lyrdb"):
-            get_results(runsets[i],rules,name_clean_, lyrdb)
+        lyrdb_path = f"{name_clean_}_{lyrdb}_gf{arguments['--gf180mcu']}.lyrdb"
+        if os.path.exists(lyrdb_path):
+            if arguments["--waiver"]:
+                lyrdb_path, _ = apply_waivers(lyrdb_path, arguments["--waiver"])
+            get_results(runsets[i],rules,lyrdb_path)
 
 # ================================================================
 # -------------------------- MAIN --------------------------------
@@ -0,0 +1,309 @@
+# Copyright 2022 GlobalFoundries PDK Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Run GlobalFoundries 180nm MCU DRC on tiles of the layout, each tile in its own klayout process.
+
+Usage:
+    run_drc_tiled.py (--help| -h)
+    run_drc_tiled.py (--path=<file_path>) (--gf180mcu=<combined_options>) [--topcell=<topcell_name>] [--thr=<thr>] [--tile_size=<tile_size>] [--halo=<halo>] [--tiles=<tiles>] [--run_dir=<run_dir>] [--no_feol] [--no_beol] [--connectivity] [--no_offgrid] [--all_layers] [--waiver=<waiver_file>]
+
+Options:
+    --help -h                           Print this help message.
+    --path=<file_path>                  The input GDS file path.
+    --gf180mcu=<combined_options>       Select combined options of metal_top, mim_option, and metal_level. Allowed values (A, B, C).
+                                        gf180mcu=A: Select  metal_top=30K  mim_option=A  metal_level=3LM
+                                        gf180mcu=B: Select  metal_top=11K  mim_option=B  metal_level=4LM
+                                        gf180mcu=C: Select  metal_top=9K   mim_option=B  metal_level=5LM
+    --topcell=<topcell_name>            Topcell name to use.
+    --thr=<thr>                         The number of threads shared by all tile runs.
+    --tile_size=<tile_size>             Size in um of the tile core. [default: 1000]
+    --halo=<halo>                       Extra border in um checked around each tile core. Default is the largest distance used in the rule deck.
+    --tiles=<tiles>                     Comma separated tiles to (re)run, e.g. 0_1,2_3. Results of the other tiles are reused from the run dir.
+    --run_dir=<run_dir>                 Directory of the tile results. Default is <gds name>_tiles next to the GDS file.
+    --no_feol                           Turn off FEOL rules from running.
+    --no_beol                           Turn off BEOL rules from running.
+    --connectivity                      Turn on connectivity rules.
+    --no_offgrid                        Turn off OFFGRID checking rules.
+    --all_layers                        Load all layers of the layout, by default only the layers read by the enabled rules are loaded.
+    --waiver=<waiver_file>              Apply the waivers of the given csv file to the results.
+
+Each tile is checked on its core plus the halo, only the markers anchored (bbox center) inside the core
+are kept, so a violation is reported by exactly one tile. Rules filtering shapes by area or length
+(with_area, with_length, ...) would see the shapes cut at the tile border and aren't run, they are
+listed in the log and have to be checked with run_drc.py.
+"""
+
+from docopt import docopt
+import os
+import re
+import math
+import logging
+import subprocess
+
+from drc_jobs import run_jobs
+from drc_lyrdb import merge_lyrdbs, value_bbox
+from drc_waiver import apply_waivers
+from drc_catalog import load_deck, prune_deck, rule_names, layers_switch, _code
+from run_drc import build_switches, get_top_cell_names, get_results
+
+# Distance measurements of the rule deck with their arguments, the largest distance bounds the interaction
+# range of a rule, e.g. space(0.28.um, euclidian), enclosing(metal1, 0.06.um) or drc(width <= 0.5.um)
+DISTANCE_OP = re.compile(r"\.(?:space|separation|enclosing|enclosed|width|isolated|notch|sized|overlap|drc)\(((?:[^()]|\([^()]*\))*)\)")
+UM_VALUE = re.compile(r"(?<![\w.])(\d+(?:\.\d+)?)\.um\b")
+
+# Filters on the size of whole shapes, wrong on shapes cut at the tile border
+SIZE_FILTER = re.compile(r"\.(?:with|without)_(?:area|length|perimeter|bbox_\w+|holes)\(|\.drc\(\s*(?:area|length|perimeter)\b")
+
+# Float slack for coordinates written with limited precision
+EPS = 1e-6
+
+
+def deck_halo(rule_deck):
+    """
+    Returns the largest distance in um measured by the rule deck.
+
+    :param rule_deck: The path to the rule deck
+    :return: The halo in um.
+    """
+    halo = 0.0
+    with open(rule_deck, "r") as f:
+        for line in f:
+            if line.lstrip().startswith("#"):
+                continue
+            for args in DISTANCE_OP.findall(line):
+                for value in UM_VALUE.findall(args):
+                    halo = max(halo, float(value))
+    return halo
+
+
+def untileable_rules(rule_deck):
+    """
+    Returns the rules of a deck filtering shapes by area or length, in their code or in the derived layers they read.
+
+    :param rule_deck: The path to the rule deck
+    :return: A set of rule names.
+    """
+    catalog = load_deck(rule_deck)
+    with open(rule_deck, "r") as f:
+        lines = f.read().split("\n")
+
+    rules = set()
+    for rule in catalog["rules"]:
+        numbers = set(range(rule["lines"][0], rule["lines"][1] + 1)) | set(rule["dep_lines"])
+        if any(SIZE_FILTER.search(_code(lines[n - 1])) for n in numbers):
+            rules.add(rule["name"])
+    return rules
+
+
+def get_layout_bbox(gds_path, topcell):
+    """
+    Returns the bounding box of the top cell in um.
+
+    :param gds_path: The path to the GDS file
+    :param topcell: The top cell name
+    :return: A tuple (left, bottom, right, top).
+    """
+    pdk_root = os.environ['PDK_ROOT']
+    pdk      = os.environ['PDK']
+
+    proc = subprocess.run(['klayout', '-b', '-r', f"{pdk_root}/{pdk}/utils/get_layout_bbox.rb", "-rd", f"infile={gds_path}",
+                           "-rd", f"topcell={topcell}"], stdout=subprocess.PIPE)
+    return tuple(float(v) for v in proc.stdout.decode().split()[-4:])
+
+
+def make_tiles(bbox, tile_size):
+    """
+    Splits the layout bbox into tile cores.
+
+    :param bbox: The layout bbox (left, bottom, right, top) in um
+    :param tile_size: The size of a tile core in um
+    :return: A dict of {"ix_iy": (left, bottom, right, top)} tile cores.
+    """
+    left, bottom, right, top = bbox
+    nx = max(1, int(math.ceil((right - left) / tile_size)))
+    ny = max(1, int(math.ceil((top - bottom) / tile_size)))
+
+    tiles = {}
+    for ix in range(nx):
+        for iy in range(ny):
+            tiles[f"{ix}_{iy}"] = (left + ix * tile_size, bottom + iy * tile_size,
+                                   min(right, left + (ix + 1) * tile_size), min(top, bottom + (iy + 1) * tile_size))
+    return tiles
+
+
+def run_tile(rule_deck, path, topcell, core, halo, report, thr, switches):
+    """
+    Runs the rule deck on one tile core plus its halo.
+
+    :return: True if klayout finished and wrote the tile report.
+    """
+    clip = ",".join(str(v) for v in (core[0] - halo, core[1] - halo, core[2] + halo, core[3] + halo))
+    if os.path.exists(report):
+        os.remove(report)
+
+    status = os.system(f"klayout -b -r {rule_deck} -rd input={path} -rd topcell={topcell} -rd report={report} "
+                       f"-rd thr={thr} -rd clip={clip} {switches} > {report.replace('.lyrdb', '.log')} 2>&1")
+    return status == 0 and os.path.exists(report)
+
+
+def merge_tiles(tiles, reports, output, bbox):
+    """
+    Merges the tile reports, keeping each marker only in the tile owning its anchor.
+
+    The anchor is the center of the marker bbox. Tile cores are half open so an anchor on
+    a shared border belongs to exactly one tile. Markers crossing a core border may be
+    found by several tiles with the same geometry, these are de-duplicated.
+
+    :param tiles: A dict of {tile name: core bbox} of the merged tiles
+    :param reports: A dict of {tile name: lyrdb path} in the same order
+    :param output: The merged lyrdb path
+    :param bbox: The layout bbox, cores on the layout border are open towards the outside
+    :return: The number of markers written.
+    """
+    names = list(reports)
+    seen = set()
+
+    def owns(core, x, y):
+        left = -math.inf if core[0] <= bbox[0] + EPS else core[0]
+        bottom = -math.inf if core[1] <= bbox[1] + EPS else core[1]
+        right = math.inf if core[2] >= bbox[2] - EPS else core[2]
+        top = math.inf if core[3] >= bbox[3] - EPS else core[3]
+        return left <= x < right and bottom <= y < top
+
+    def keep(i, category, cell, values):
+        core = tiles[names[i]]
+        boxes = [b for b in (value_bbox(v) for v in values) if b is not None]
+        if not boxes:
+            key = (category, cell, tuple(values))
+            if key in seen:
+                return None
+            seen.add(key)
+            return values
+
+        l, b = min(x[0] for x in boxes), min(x[1] for x in boxes)
+        r, t = max(x[2] for x in boxes), max(x[3] for x in boxes)
+        if not owns(core, (l + r) / 2, (b + t) / 2):
+            return None
+
+        # Only markers crossing the core border can be reported again by a neighbour
+        if l < core[0] or b < core[1] or r > core[2] or t > core[3]:
+            key = (category, cell, tuple(values))
+            if key in seen:
+                return None
+            seen.add(key)
+        return values
+
+    return merge_lyrdbs([reports[n] for n in names], output, keep)
+
+
+def main():
+
+    # check gds file existance
+    path = arguments["--path"]
+    if not os.path.exists(path) or ".gds" not in path:
+        logging.error("The input GDS file path doesn't exist or isn't a gds file, please recheck.")
+        exit()
+
+    if arguments["--waiver"] and not os.path.exists(arguments["--waiver"]):
+        logging.error("The waiver file path doesn't exist, please recheck.")
+        exit()
+
+    pdk_root = os.environ['PDK_ROOT']
+    pdk      = os.environ['PDK']
+    rule_deck = f"{pdk_root}/{pdk}/gf180mcu.drc"
+    gf = arguments['--gf180mcu']
+
+    name_clean_ = path.replace(".gds", "").replace(".gz", "")
+    run_dir = arguments["--run_dir"] or f"{name_clean_}_tiles"
+    os.makedirs(run_dir, exist_ok=True)
+
+    # The area and length rules are left out of the tiled deck
+    skipped = untileable_rules(rule_deck)
+    rules = [r for r in rule_names([rule_deck]) if r not in skipped]
+    tiled_deck = os.path.join(run_dir, "gf180mcu_tiled.drc")
+    prune_deck(rule_deck, set(rules), tiled_deck)
+    logging.warning(f"{len(skipped)} rules filter shapes by area or length and aren't checked in tiled runs, "
+                    f"check them with run_drc.py: {' '.join(sorted(skipped))}")
+
+    # Tiles are always checked flat, the density rules need the full layout
+    switches = build_switches(dict(arguments, **{"--run_mode": "flat", "--density": False}))
+    if not arguments["--all_layers"]:
+        switches = layers_switch([tiled_deck], switches) + switches
+
+    tc_list = get_top_cell_names(path)
+    if arguments["--topcell"] and arguments["--topcell"] not in tc_list:
+        logging.error(f"The topcell {arguments['--topcell']} isn't a top cell of {path}, its top cells are {tc_list}.")
+        exit(1)
+    topcell = arguments["--topcell"] or tc_list[0]
+    if len(tc_list) > 1 and not arguments["--topcell"]:
+        logging.warning(f"File has multiple topcell names {tc_list}, using {topcell}.")
+
+    halo = float(arguments["--halo"]) if arguments["--halo"] else deck_halo(tiled_deck)
+    tile_size = float(arguments["--tile_size"])
+    if tile_size <= 0:
+        logging.error("Tile size should be a positive number.")
+        exit()
+
+    bbox = get_layout_bbox(path, topcell)
+    tiles = make_tiles(bbox, tile_size)
+    logging.info(f"Layout bbox {bbox}, {len(tiles)} tiles of {tile_size}um with {halo}um halo.")
+
+    selected = list(tiles)
+    if arguments["--tiles"]:
+        selected = [t.strip() for t in arguments["--tiles"].split(",") if t.strip()]
+        unknown = [t for t in selected if t not in tiles]
+        if unknown:
+            logging.error(f"Unknown tiles {unknown}, tiles of this layout are 0_0 to {list(tiles)[-1]}.")
+            exit()
+
+    # The tiles share the thread budget with the same admission control as the other runners
+    thr = max(1, thrCount // len(selected))
+    reports = {t: os.path.join(run_dir, f"tile_{t}.lyrdb") for t in tiles}
+    jobs = [(t, thr, run_tile, (tiled_deck, path, topcell, tiles[t], halo, reports[t], thr, switches)) for t in selected]
+    status = run_jobs(jobs, thrCount)
+
+    failed = sorted(t for t in tiles if not status.get(t, os.path.exists(reports[t])))
+    if failed:
+        logging.error(f"Tiles {failed} failed or have no results, rerun them with --tiles={','.join(failed)}")
+
+    done = {t: reports[t] for t in tiles if t not in failed}
+    if not done:
+        exit()
+
+    lyrdb_path = f"{name_clean_}_main_drc_gf{gf}.lyrdb"
+    count = merge_tiles(tiles, done, lyrdb_path, bbox)
+    logging.info(f"Merged {len(done)} tiles into {lyrdb_path} with {count} markers.")
+
+    if arguments["--waiver"]:
+        lyrdb_path, _ = apply_waivers(lyrdb_path, arguments["--waiver"])
+    get_results("gf180mcu", rules, lyrdb_path, gf)
+
+# ================================================================
+# -------------------------- MAIN --------------------------------
+# ================================================================
+
+if __name__ == "__main__":
+
+    # logs format
+    logging.basicConfig(level=logging.DEBUG, format=f"%(asctime)s | %(levelname)-7s | %(message)s", datefmt='%d-%b-%Y %H:%M:%S')
+
+    # arguments
+    arguments     = docopt(__doc__, version='RUN DRC TILED: 0.1')
+
+    # No. of threads
+    thrCount = os.cpu_count()*2 if arguments["--thr"] == None else int(arguments["--thr"])
+
+    # Calling main function
+    main()
@@ -0,0 +1,249 @@
+# Copyright 2022 GlobalFoundries PDK Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Run GlobalFoundries 180nm MCU DRC Benchmark.
+
+Usage:
+    run_benchmark.py (--help| -h)
+    run_benchmark.py [--path=<file_path>]... [--seed=<seed_path>] [--copies=<copies>] [--run_modes=<run_modes>] [--threads=<threads>] [--runners=<runners>] [--gf180mcu=<combined_options>] [--repeat=<repeat>] [--run_name=<run_name>] [--plot]
+    run_benchmark.py (--results=<results_file>) [--plot]
+
+Options:
+    --help -h                           Print this help message.
+    --path=<file_path>                  Layouts of the corpus. Default is all layouts in testcases, sc_testcases and ip_testcases.
+    --seed=<seed_path>                  Seed layout of the synthetic scaled-up designs. [default: ip_testcases/gf180mcu_fd_ip_sram__sram512x8m8wm1.gds]
+    --copies=<copies>                   Comma separated copies of the seed in the synthetic designs, empty to skip them. [default: 1,2,4,8]
+    --run_modes=<run_modes>             Comma separated klayout modes to run. [default: flat,deep,tiling]
+    --threads=<threads>                 Comma separated thread counts to run. [default: 1,2,4,8]
+    --runners=<runners>                 Comma separated runners to benchmark. [default: run_drc,run_drc_parallel]
+    --gf180mcu=<combined_options>       Select combined options of metal_top, mim_option, and metal_level. Allowed values (A, B, C). [default: C]
+    --repeat=<repeat>                   Number of runs of each configuration. [default: 1]
+    --run_name=<run_name>               Select your run name. Default is the date of the run.
+    --results=<results_file>            Plot the results file of a previous benchmark instead of running one.
+    --plot                              Plot the strong and weak scaling curves (needs matplotlib).
+"""
+
+from docopt import docopt
+import os
+import sys
+import glob
+import json
+import time
+import logging
+import platform
+import subprocess
+import datetime
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from drc_catalog import file_hash
+
+# Bump when the results layout changes
+RESULTS_VERSION = 1
+
+DRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def corpus_layouts():
+    layouts = []
+    for folder in ["testcases", "sc_testcases", "ip_testcases"]:
+        for ext in ["gds", "gds.gz"]:
+            layouts += glob.glob(f"{folder}/**/*.{ext}", recursive=True)
+    return sorted(layouts)
+
+
+def link_layout(layout, out_dir):
+    """
+    Links a corpus layout into the benchmark directory, the runners write their reports next to it there.
+
+    :return: The path of the link.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    link = os.path.join(out_dir, layout.replace(os.sep, "__"))
+    if not os.path.lexists(link):
+        os.symlink(os.path.abspath(layout), link)
+    return link
+
+
+def make_synthetic(seed, copies, out_dir):
+    """
+    Builds a design of `copies` arrayed copies of the seed layout.
+
+    :return: The path of the synthetic design.
+    """
+    pdk_root = os.environ['PDK_ROOT']
+    pdk      = os.environ['PDK']
+
+    name = os.path.basename(seed).split(".")[0]
+    out = os.path.join(out_dir, f"{name}_x{copies}.gds")
+    if not os.path.exists(out):
+        subprocess.run(['klayout', '-b', '-r', f"{pdk_root}/{pdk}/utils/scale_layout.rb", "-rd", f"infile={seed}",
+                        "-rd", f"outfile={out}", "-rd", f"copies={copies}"], stdout=subprocess.DEVNULL)
+    return out
+
+
+def measure(cmd, log):
+    """
+    Runs one command and measures it.
+
+    :return: A dict with the wall time, the cpu time (user + system) in seconds, the peak RSS in MB
+             of the largest process of the run and the exit status.
+    """
+    with open(log, "w") as f:
+        t0 = time.time()
+        proc = subprocess.Popen(cmd, shell=True, stdout=f, stderr=subprocess.STDOUT)
+        # wait4 includes the klayout processes the runner waited for
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall = time.time() - t0
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return {"wall": wall, "cpu": usage.ru_utime + usage.ru_stime, "max_rss_mb": usage.ru_maxrss / 1024,
+            "status": proc.returncode}
+
+
+def plot_results(results_file):
+    """
+    Plots the strong scaling (speedup against threads per layout) and weak scaling
+    (efficiency with the synthetic design growing with the threads) curves.
+    """
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        logging.error("Plotting needs matplotlib, please install it.")
+        return
+
+    with open(results_file, "r") as f:
+        data = json.load(f)
+
+    runs = {}
+    for r in data["results"]:
+        if r["status"] != 0:
+            continue
+        key = (r["layout"], r["synthetic"], r["copies"], r["runner"], r["run_mode"])
+        runs.setdefault(key, {}).setdefault(r["threads"], []).append(r["wall"])
+
+    best = {k: {n: min(t) for n, t in v.items()} for k, v in runs.items()}
+    name = results_file.replace(".json", "")
+
+    fig, ax = plt.subplots(figsize=(8, 6))
+    for (layout, synthetic, copies, runner, mode), times in sorted(best.items()):
+        if len(times) < 2:
+            continue
+        n0 = min(times)
+        threads = sorted(times)
+        ax.plot(threads, [times[n0] / times[n] for n in threads], marker="o",
+                label=f"{os.path.basename(layout)} {runner} {mode}")
+    ax.set_xlabel("threads")
+    ax.set_ylabel("speedup")
+    ax.set_title("Strong scaling")
+    ax.legend(fontsize="x-small")
+    fig.savefig(f"{name}_strong.png")
+
+    fig, ax = plt.subplots(figsize=(8, 6))
+    weak = {}
+    for (layout, synthetic, copies, runner, mode), times in best.items():
+        if synthetic and copies in times:
+            weak.setdefault((runner, mode), {})[copies] = times[copies]
+    for (runner, mode), times in sorted(weak.items()):
+        if 1 not in times or len(times) < 2:
+            continue
+        n = sorted(times)
+        ax.plot(n, [times[1] / times[k] for k in n], marker="o", label=f"{runner} {mode}")
+    ax.set_xlabel("threads (= copies of the seed)")
+    ax.set_ylabel("efficiency")
+    ax.set_title("Weak scaling")
+    ax.legend(fontsize="x-small")
+    fig.savefig(f"{name}_weak.png")
+
+    logging.info(f"Scaling plots at {name}_strong.png and {name}_weak.png")
+
+
+def main():
+
+    if arguments["--results"]:
+        plot_results(arguments["--results"])
+        return
+
+    pdk_root = os.environ['PDK_ROOT']
+    pdk      = os.environ['PDK']
+
+    run_name = arguments["--run_name"] or datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    run_dir = f"benchmark_{run_name}"
+    os.makedirs(run_dir, exist_ok=True)
+
+    # The runners write their reports next to the layout, the corpus stays clean
+    layouts = [(link_layout(p, f"{run_dir}/layouts"), 1, False) for p in (arguments["--path"] or corpus_layouts())]
+    copies_list = [int(c) for c in arguments["--copies"].split(",") if c.strip()]
+    for copies in copies_list:
+        layouts.append((make_synthetic(arguments["--seed"], copies, run_dir), copies, True))
+
+    modes = arguments["--run_modes"].split(",")
+    threads = [int(n) for n in arguments["--threads"].split(",")]
+    runners = arguments["--runners"].split(",")
+
+    klayout_v = os.popen("klayout -v").read().strip()
+    git_rev = os.popen(f"git -C {DRC_DIR} rev-parse HEAD 2>/dev/null").read().strip()
+    decks = glob.glob(f"{pdk_root}/{pdk}/*.drc") + glob.glob(f"{pdk_root}/{pdk}/rule_decks/*.drc")
+
+    data = {"version": RESULTS_VERSION, "run_name": run_name, "date": datetime.datetime.now().isoformat(),
+            "host": platform.node(), "cpus": os.cpu_count(), "klayout": klayout_v, "git": git_rev,
+            "decks": {os.path.relpath(d, f"{pdk_root}/{pdk}"): file_hash(d) for d in sorted(decks)},
+            "gf180mcu": arguments["--gf180mcu"], "results": []}
+    results_file = f"{run_dir}/results.json"
+
+    total = len(layouts) * len(runners) * len(modes) * len(threads) * int(arguments["--repeat"])
+    count = 0
+    for layout, copies, synthetic in layouts:
+        for runner in runners:
+            for mode in modes:
+                for n in threads:
+                    for rep in range(int(arguments["--repeat"])):
+                        count += 1
+                        name = f"{os.path.basename(layout).split('.')[0]}_{runner}_{mode}_{n}_{rep}"
+                        cmd = (f"python3 {DRC_DIR}/{runner}.py --path={layout} --gf180mcu={arguments['--gf180mcu']} "
+                               f"--thr={n} --run_mode={mode}")
+                        # A cached report or connectivity would be reused whatever the thread count, every run has to run klayout
+                        cmd += " --no_cache"
+                        result = measure(cmd, f"{run_dir}/{name}.log")
+                        result.update({"layout": layout, "size_bytes": os.path.getsize(layout), "copies": copies,
+                                       "synthetic": synthetic,
+                                       "runner": runner, "run_mode": mode, "threads": n, "repeat": rep})
+                        data["results"].append(result)
+                        logging.info(f"[{count}/{total}] {name}: wall {result['wall']:.1f} s, cpu {result['cpu']:.1f} s, "
+                              f"peak RSS {result['max_rss_mb']:.0f} MB, status {result['status']}")
+
+                        # Saved after each run, an interrupted benchmark keeps its results
+                        with open(results_file, "w") as f:
+                            json.dump(data, f, indent=1)
+
+    logging.info(f"Benchmark results at {results_file}")
+
+    if arguments["--plot"]:
+        plot_results(results_file)
+
+# ================================================================
+# -------------------------- MAIN --------------------------------
+# ================================================================
+
+if __name__ == "__main__":
+
+    # logs format
+    logging.basicConfig(level=logging.DEBUG, format=f"%(asctime)s | %(levelname)-7s | %(message)s", datefmt='%d-%b-%Y %H:%M:%S')
+
+    # arguments
+    arguments = docopt(__doc__, version='DRC BENCHMARK: 0.1')
+
+    # Calling main function
+    main()
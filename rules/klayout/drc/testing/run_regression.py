@@ -17,7 +17,7 @@ Run GlobalFoundries 180nm MCU DRC Regression.
 
 Usage:
     run_regression.py (--help| -h)
-    run_regression.py (--path=<file_path>)... [--thr=<thr>] [--no_feol] [--no_beol] [--metal_top=<metal_top>] [--mim_option=<mim_option>] [--metal_level=<metal_level>] [--no_offgrid] [--run_name=<run_name>]
+    run_regression.py (--path=<file_path>)... [--thr=<thr>] [--no_feol] [--no_beol] [--metal_top=<metal_top>] [--mim_option=<mim_option>] [--metal_level=<metal_level>] [--no_offgrid] [--run_name=<run_name>] [--no_cache] [--changed_since=<git_rev>] [--micro]
 
 Options:
     --help -h                           Print this help message.
@@ -30,29 +30,195 @@ Options:
     --metal_level=<metal_level>         Select the number of metal layers in stack. Allowed values (2, 3, 4, 5, 6). [default: 6]
     --no_offgrid                        Turn off OFFGRID checking rules.
     --run_name=<run_name>               Select your run name.
+    --no_cache                          Always run the marker pass, don't use or update the cached marker layouts.
+    --changed_since=<git_rev>           Only regress the rules whose code changed since this git revision, the other rules keep their results of the last final_detailed_report_<run_name>.csv.
+    --micro                             Regress each rule alone on its own test structures cut out of the testcases, with a deck pruned to the rule.
 """
 
 from docopt import docopt
 import os
+import sys
 import datetime
-import xml.etree.ElementTree as ET
 import csv
 import time
 import re
+import collections
+import shutil
+import subprocess
+import hashlib
+import json
 
 from sympy import arg
 
-def call_regression(rule_deck_path, path):
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from drc_catalog import get_rules, rule_names, load_deck, prune_deck, _code, cache_dir, file_hash, undefined_reads, PRUNE_VERSION
+from drc_jobs import run_jobs
+import drc_cache
+from drc_lyrdb import read_header, iter_items, clean_category
+
+SPLITTER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils", "split_rule_testcases.rb")
+
+HUNK = re.compile(r"^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@")
+
+
+def changed_lines(deck, rev):
+    """
+    Returns the code lines of a rule deck changed since a git revision, comments and blank lines are left out.
+
+    :param deck: The rule deck path
+    :param rev: The git revision
+    :return: A set of line numbers of the current deck, a removal marks the lines around it. None if the deck isn't in the revision.
+    """
+    folder, name = os.path.split(os.path.abspath(deck))
+    if subprocess.run(["git", "cat-file", "-e", f"{rev}:./{name}"], cwd=folder, capture_output=True).returncode != 0:
+        return None
+    diff = subprocess.run(["git", "diff", "-U0", "-b", rev, "--", name], cwd=folder, capture_output=True, text=True, check=True).stdout
+
+    # Lines of each hunk: (first line, added code lines, whether code lines were removed)
+    hunks = []
+    new_line = None
+    for line in diff.split("\n"):
+        m = HUNK.match(line)
+        if m:
+            # A hunk of removed lines only starts at the line before the removal
+            new_line = int(m.group(1)) + (1 if m.group(2) == "0" else 0)
+            hunks.append((new_line, [], [False]))
+        elif new_line is None:
+            continue
+        elif line.startswith("+"):
+            if _code(line[1:]).strip():
+                hunks[-1][1].append(new_line)
+            new_line += 1
+        elif line.startswith("-") and _code(line[1:]).strip():
+            hunks[-1][2][0] = True
+
+    lines = set()
+    for start, added, removed in hunks:
+        lines.update(added)
+        # A removal without replacement changes the code around it
+        if removed[0] and not added:
+            lines.update([start - 1, start])
+    return lines
+
+
+def changed_rules(deck, rev):
+    """
+    Returns the rules of a rule deck affected by its changes since a git revision.
+
+    A changed line affects the rules whose block or dependencies (derived and input layers) contain it.
+    Changed lines outside of them, e.g. switches, functions or connectivity, may affect any rule.
+
+    :param deck: The rule deck path
+    :param rev: The git revision
+    :return: A set of rule names, None if all rules may be affected.
+    """
+    lines = changed_lines(deck, rev)
+    if lines is None:
+        return None
+
+    catalog = load_deck(deck)
+    covered = set()
+    rules = set()
+    for rule in catalog["rules"]:
+        used = set(range(rule["lines"][0], rule["lines"][1] + 1)) | set(rule["dep_lines"])
+        covered |= used
+        if used & lines:
+            rules.add(rule["name"])
+
+    # Definitions no rule reads don't change any result
+    unused = {n for defs in catalog["derived"].values() for n in defs} - covered
+    if lines - covered - unused:
+        return None
+    return rules
+
+
+def read_baseline(report_path):
+    """
+    Reads the rule results of a previous final detailed report.
+
+    :param report_path: The path of the final_detailed_report csv
+    :return: A dict of {rule: [false positive, false negative, total violations, not tested]}, empty if there is no report.
+             Rules whose run failed are left out, so they are regressed again.
+    """
+    if not os.path.exists(report_path):
+        return {}
+    with open(report_path, "r") as f:
+        rows = list(csv.reader(f))
+    return {row[0]: [int(v) for v in row[1:5]] for row in rows[1:] if len(row) >= 5 and row[5:6] != ["1"]}
+
+
+def rule_labels(rule):
+    """
+    Returns the texts of the (11, 222) labels marking the test structures of a rule.
+
+    :param rule: The rule name, e.g. "DV.2_3.3V"
+    :return: A list of label texts, e.g. ["DV.2_LV"]
+    """
+    name_list = rule.split("_")
+    base = "_".join(name_list[:-1])
+    if "3.3V" in name_list[-1]:
+        return [f"{base}_LV"]
+    elif "5V" in name_list[-1]:
+        return [f"{base}_MV", f"{base}_5V", f"{base}_MV_5V"]
+    elif "6V" in name_list[-1]:
+        return [f"{base}_MV", f"{base}_6V", f"{base}_MV_6V"]
+    return [rule]
+
+
+def safe_name(rule):
+    return re.sub(r"[^\w.+-]", "_", rule)
+
+
+def micro_testcases(path, deck):
+    """
+    Cuts the test structures of each rule of a deck out of a testcase (utils/split_rule_testcases.rb).
+
+    The layouts are kept in the DRC cache, keyed by the testcase and the rule labels.
+
+    :param path: The testcase GDS path
+    :param deck: The rule deck path
+    :return: A dict of {rule: gds path} of the rules with test structures in the testcase.
+    """
+    rules = {rule: rule_labels(rule) for rule in rule_names([deck], skip_sections=("GEOMETRY RULES",))}
+    key = hashlib.sha1(f"{file_hash(path)}\n{json.dumps(rules, sort_keys=True)}".encode()).hexdigest()
+    outdir = cache_dir("micro", key)
+    index = os.path.join(outdir, "index.json")
+
+    if not os.path.exists(index):
+        with open(os.path.join(outdir, "rules.json"), "w") as f:
+            json.dump(rules, f)
+        out = subprocess.run(["klayout", "-b", "-r", SPLITTER, "-rd", f"infile={path}", "-rd", f"rules={outdir}/rules.json",
+                              "-rd", f"outdir={outdir}"], capture_output=True, text=True, check=True).stdout
+        files = json.loads(out.strip().split("\n")[-1])
+        with open(index, "w") as f:
+            json.dump(files, f)
+
+    with open(index, "r") as f:
+        return json.load(f)
+
+
+def micro_deck(deck, rule):
+    """
+    Returns a copy of a deck pruned to one rule, generated once per deck and prune_deck version.
+    """
+    path = os.path.join(cache_dir("micro_decks", f"v{PRUNE_VERSION}", file_hash(deck), safe_name(rule)), os.path.basename(deck))
+    if not os.path.exists(path):
+        prune_deck(deck, {rule}, f"{path}.{os.getpid()}")
+        os.replace(f"{path}.{os.getpid()}", path)
+    return path
+
+
+def call_regression(rule_deck_path, path, thrCount):
     t0 = time.time()
     marker_gen = []
-    rules =[]
     ly = 0
 
-    # set folder structure for each run
+    # set folder structure for each run, pairs of the same deck run at the same time so the testcase is in the name
     x = f"{datetime.datetime.now()}"
     x = x.replace(" ", "_")
 
     name_ext = str(rule_deck_path).replace(".drc","").split("/")[-1]
+    name_ext = f"{os.path.basename(path).split('.gds')[0]}_{name_ext}"
     os.system(f"mkdir run_{x}_{name_ext}")
 
     # Get the same rule deck with gds output
@@ -66,7 +232,8 @@ def call_regression(rule_deck_path, path):
                 ly +=1
             marker_gen.append(line)
 
-    marker_gen.append(f'\n source.layout.write("{os.getcwd()}/run_{x}_{name_ext}/merged_output.gds") \n')
+    # The output path is passed at run time, the marker deck of a deck is the same in every run dir
+    marker_gen.append('\n source.layout.write($marker_out) \n')
 
     data = ''.join(marker_gen)
     data = re.sub("if\s\$report.*\n.*\.*\n.*\n.*\n.*\n.*\nend", "",data)
@@ -76,24 +243,30 @@ def call_regression(rule_deck_path, path):
     marker_file.write(data)
     marker_file.close()
 
-    # Getting threads count
-    if args["--thr"]:
-        thrCount = args["--thr"][0]
-    else:
-        thrCount = os.cpu_count() * 2
-
-    # Generate gds
-    iname = path.split('.gds')
-    if '/' in iname[0]:
-        file = iname[0].split('/')
-        os.system(f"klayout -b -r run_{x}_{name_ext}/markers.drc -rd input={path} -rd report={file[-1]}.lyrdb -rd thr={thrCount} {switches} ")
+    # Generate gds, or get it from the marker cache if the deck, testcase and switches didn't change
+    marker_gds = f"run_{x}_{name_ext}/merged_output.gds"
+    cached_gds = None if args["--no_cache"] else drc_cache.marker_path(path, f"run_{x}_{name_ext}/markers.drc", switches, klayout_v)
+    if cached_gds and os.path.exists(cached_gds):
+        print(f"Using the cached markers of {name_ext}")
+        shutil.copyfile(cached_gds, marker_gds)
+        os.utime(cached_gds)
     else:
-        os.system(f"klayout -b -r run_{x}_{name_ext}/markers.drc -rd input={path} -rd report={iname[0]}.lyrdb -rd thr={thrCount} {switches} ")
+        iname = path.split('.gds')
+        if '/' in iname[0]:
+            file = iname[0].split('/')
+            os.system(f"klayout -b -r run_{x}_{name_ext}/markers.drc -rd input={path} -rd report={file[-1]}.lyrdb -rd thr={thrCount} -rd marker_out={os.getcwd()}/{marker_gds} {switches} ")
+        else:
+            os.system(f"klayout -b -r run_{x}_{name_ext}/markers.drc -rd input={path} -rd report={iname[0]}.lyrdb -rd thr={thrCount} -rd marker_out={os.getcwd()}/{marker_gds} {switches} ")
+        if cached_gds and os.path.exists(marker_gds):
+            drc_cache.store_marker(marker_gds, cached_gds)
 
     marker_gen = []
     ly = 0
     remove_if = False
 
+    # Rules of the regression deck, in the order of their marker layers
+    rules = [r["name"] for r in get_rules([rule_deck_path], skip_sections=("GEOMETRY RULES",))]
+
     # Get the small rule deck with gds output
     with open(rule_deck_path, 'r') as f:
         for line in f:
@@ -106,17 +279,8 @@ def call_regression(rule_deck_path, path):
                 break
             if ".output" in line:
                 line_list = line.split('"')
-                rules.append(line_list[1])
-                name_list = line_list[1].split("_")
-                rule = line_list[1]
-                if "3.3V" in name_list[-1]:
-                    rule = '_'.join(name_list[:-1]) + '_LV")'
-                elif "5V" in name_list[-1]:
-                    rule = '_'.join(name_list[:-1]) + f'_MV").or(input(11, 222).texts("{"_".join(name_list[:-1])}_5V")).or(input(11, 222).texts("{"_".join(name_list[:-1])}_MV_5V"))'
-                elif "6V" in name_list[-1]:
-                    rule = '_'.join(name_list[:-1]) + f'_MV").or(input(11, 222).texts("{"_".join(name_list[:-1])}_6V")).or(input(11, 222).texts("{"_".join(name_list[:-1])}_MV_6V"))'
-                else:
-                    rule = rule + '")'
+                labels = rule_labels(line_list[1])
+                rule = labels[0] + '")' + ''.join(f'.or(input(11, 222).texts("{label}"))' for label in labels[1:])
 
                 line = f'''(input(2, 222).interacting(input(11, 222).texts("{rule})).interacting(input(10000, {ly})).output("{line_list[1]}_false_positive", "{line_list[1]}_false_positive occurred") \n
     ((input(6, 222).interacting(input(3, 222).interacting(input(11, 222).texts("{rule}))).or((input(3, 222).interacting(input(11, 222).texts("{rule})).not_interacting(input(6, 222)))).not_interacting(input(10000, {ly})).output("{line_list[1]}_false_negative", "{line_list[1]}_false_negative occurred") \n
@@ -137,8 +301,10 @@ def call_regression(rule_deck_path, path):
     # Cleaning directories
     # os.system(f"rm -rf regression.drc markers.drc merged_output.gds")
 
-    mytree = ET.parse(f'run_{x}_{name_ext}/database.lyrdb')
-    myroot = mytree.getroot()
+    # One streaming pass over the results, the items are counted by category
+    database = f'run_{x}_{name_ext}/database.lyrdb'
+    run_categories = {clean_category(name) for name, _ in read_header(database)["categories"]}
+    counts = collections.Counter(category for category, _, _, _ in iter_items(database))
 
     report = [["Rule_Name", "False_Positive", "False_Negative", "Total_Violations", "Not_Tested"]]
     conc = [["Rule_Name", "Status"]]
@@ -147,29 +313,11 @@ def call_regression(rule_deck_path, path):
     failed = 0
     not_tested_counter = 0
     for lrule in rules:
-        # Values of each rule in results
-        falseNeg = 0
-        falsePos = 0
-        not_tested = 0
-        not_run = 1
-        total = 0
-
-        # Check whether the rule was run or not
-        for z in myroot[5]:
-            if f"{lrule}_not_tested" == f"{z[0].text}":
-                not_run = 0
-                break
-
-        # Loop on database to get the violations of required rule
-        for z in myroot[7]:
-            if f"'{lrule}_not_tested'" == f"{z[1].text}" or not_run == 1:#(f"{rule}" in f"{z[1].text}") and ("tested" in f"{z[1].text}"):
-                not_tested += 1
-                break
-            else:
-                if f"'{lrule}_false_positive'" == f"{z[1].text}":#(f"{rule}" in f"{z[1].text}") and ("positive" in f"{z[1].text}"):
-                    falsePos += 1
-                if f"'{lrule}_false_negative'" == f"{z[1].text}":#(f"{rule}" in f"{z[1].text}") and ("negative" in f"{z[1].text}"):
-                    falseNeg += 1
+        # Values of each rule in results, a rule is not tested if it didn't run or has no test structures
+        falsePos = counts[f"{lrule}_false_positive"]
+        falseNeg = counts[f"{lrule}_false_negative"]
+        not_run = f"{lrule}_not_tested" not in run_categories
+        not_tested = 1 if not_run or counts[f"{lrule}_not_tested"] else 0
 
         total = falsePos + falseNeg
         report.append([lrule, falsePos, falseNeg, total, not_tested])
@@ -204,10 +352,8 @@ def call_regression(rule_deck_path, path):
 
 if __name__ == "__main__":
 
-    sub_report = []
-    full_report = []
     final_report = [["Rule_Name", "Status"]]
-    final_detailed_report = [["Rule_Name", "False_Postive", "False_Negative", "Total_Violations", "Not_Tested"]]
+    final_detailed_report = [["Rule_Name", "False_Postive", "False_Negative", "Total_Violations", "Not_Tested", "Run_Failed"]]
 
     t0 = time.time()
 
@@ -232,7 +378,7 @@ if __name__ == "__main__":
 
     # Getting threads count
     if args["--thr"]:
-        thrCount = args["--thr"]
+        thrCount = int(args["--thr"])
     else:
         thrCount = os.cpu_count() * 2
 
@@ -255,48 +401,124 @@ if __name__ == "__main__":
         exit()
 
 
-    os.system("klayout -v")
+    # The marker cache is keyed by the klayout version
+    klayout_v = os.popen("klayout -v").read()
+    print(klayout_v, end="")
 
     rule_deck_path = []
 
     files = os.listdir(f'..')
 
-    for file in files:
-        if ".drc" in file:
+    # Decks without rules (e.g. the dummy fill script) have nothing to regress
+    for file in sorted(files):
+        if file.endswith(".drc") and rule_names([f"../{file}"]):
             rule_deck_path.append(f"../{file}")
 
-    for path in args["--path"]:
+    run_name = args["--run_name"]
+    all_rules = rule_names(rule_deck_path, skip_sections=("GEOMETRY RULES",))
+
+    # Only the rules changed since the revision and the rules missing from the baseline are regressed,
+    # with decks pruned to them
+    baseline = {}
+    if args["--changed_since"]:
+        baseline = read_baseline(f'final_detailed_report_{run_name}.csv')
+        if not baseline:
+            print(f"No baseline final_detailed_report_{run_name}.csv, all rules are regressed")
+        changed_decks = []
         for runset in rule_deck_path:
-            return_report = call_regression(runset, path)
-            sub_report += return_report[1:]
-        full_report.append(sub_report)
-        sub_report = []
-
-
-    rule_num = 0
-
-    for rule in full_report[0]:
-        fail = 0
-        no_test = 1
-        falseNeg = 0
-        falsePos = 0
-        for file in range(len(full_report)):
-            falsePos = falsePos + full_report[file][rule_num][1]
-            falseNeg = falseNeg + full_report[file][rule_num][2]
-            fail = fail + full_report[file][rule_num][3]
-            no_test = no_test * full_report[file][rule_num][4]
-
-        final_detailed_report.append([rule[0], falsePos, falseNeg, fail, no_test])
-
-        if fail == 0 and no_test == 0:
-            final_report.append([rule[0], "Pass"])
+            names = set(rule_names([runset], skip_sections=("GEOMETRY RULES",)))
+            rules = changed_rules(runset, args["--changed_since"])
+            if rules is not None:
+                rules = (rules & names) | {n for n in names if n not in baseline}
+            if rules is None or rules == names:
+                print(f"Regressing all {len(names)} rules of {runset}")
+                changed_decks.append(runset)
+            elif rules:
+                print(f"Regressing {len(rules)} of {len(names)} rules of {runset}: {' '.join(sorted(rules))}")
+                os.makedirs("changed_decks", exist_ok=True)
+                pruned = os.path.join("changed_decks", os.path.basename(runset))
+                prune_deck(runset, rules, pruned)
+                # A pruned deck reading a layer it no longer defines would fail all its rules
+                catalog = load_deck(runset)
+                missing = undefined_reads(pruned, set(catalog["derived"]) | set(catalog["layers"]))
+                if missing:
+                    print(f"The pruned {pruned} reads undefined layers ({' '.join(sorted(missing))}), regressing all rules of {runset}")
+                    pruned = runset
+                changed_decks.append(pruned)
+            else:
+                print(f"No rule of {runset} changed since {args['--changed_since']}")
+        rule_deck_path = changed_decks
+
+    # All (testcase, deck) pairs run at once, each with its share of the threads,
+    # so their klayout passes together stay within thrCount
+    pairs = [(path, runset) for path in args["--path"] for runset in rule_deck_path]
+
+    # Micro runs: each rule runs alone on its own test structures, a slow or crashing rule only fails its own run
+    untested = []
+    run_failed = set()
+    if args["--micro"]:
+        micro_pairs = []
+        for path, runset in pairs:
+            # Density rules are checked over windows of the whole chip, they keep the full testcase
+            if "density" in os.path.basename(runset):
+                micro_pairs.append((path, runset))
+                continue
+            try:
+                testcases = micro_testcases(path, runset)
+            except (subprocess.CalledProcessError, ValueError) as e:
+                print(f"Splitting {path} for the rules of {runset} failed, its rules are reported as failed: {e}")
+                run_failed |= set(rule_names([runset], skip_sections=("GEOMETRY RULES",)))
+                continue
+            for rule in rule_names([runset], skip_sections=("GEOMETRY RULES",)):
+                if rule in testcases:
+                    micro_pairs.append((testcases[rule], micro_deck(runset, rule)))
+                else:
+                    untested.append(rule)
+        pairs = micro_pairs
+        print(f"Regressing {len(pairs)} micro runs")
+
+    pair_thr = max(1, thrCount // max(1, len(pairs)))
+    runs = [(f"{path}:{runset}", pair_thr, call_regression, (runset, path, pair_thr)) for path, runset in pairs]
+    results = run_jobs(runs, thrCount)
+
+    # Rule results summed over all pairs, a rule is not tested if no testcase tests it.
+    # The rules of a failed run fail, whatever the other testcases gave.
+    full_report = {}
+    for path, runset in pairs:
+        return_report = results[f"{path}:{runset}"]
+        if return_report is None:
+            print(f"Regression of {runset} on {path} failed, its rules are reported as failed")
+            run_failed |= set(rule_names([runset], skip_sections=("GEOMETRY RULES",)))
+            continue
+        for rule, falsePos, falseNeg, fail, not_tested in return_report[1:]:
+            totals = full_report.setdefault(rule, [0, 0, 0, 1])
+            totals[0] += falsePos
+            totals[1] += falseNeg
+            totals[2] += fail
+            totals[3] *= not_tested
+
+    # Rules without test structures in a testcase aren't tested by it
+    for rule in untested:
+        full_report.setdefault(rule, [0, 0, 0, 1])
+
+    # The rules that weren't regressed again keep their baseline results
+    if baseline:
+        full_report = {rule: full_report.get(rule, baseline.get(rule)) for rule in all_rules if rule in full_report or rule in baseline}
+
+    for rule in run_failed:
+        full_report.setdefault(rule, [0, 0, 0, 0])
+
+    for rule, (falsePos, falseNeg, fail, no_test) in full_report.items():
+        final_detailed_report.append([rule, falsePos, falseNeg, fail, no_test, int(rule in run_failed)])
+
+        if rule in run_failed:
+            final_report.append([rule, "Fail"])
+        elif fail == 0 and no_test == 0:
+            final_report.append([rule, "Pass"])
         elif no_test != 0:
-            final_report.append([rule[0], "Not_Tested"])
+            final_report.append([rule, "Not_Tested"])
         else:
-            final_report.append([rule[0], "Fail"])
-        rule_num += 1
-
-    run_name = args["--run_name"]
+            final_report.append([rule, "Fail"])
 
     with open(f'final_detailed_report_{run_name}.csv', 'w') as f:
         writer = csv.writer(f, delimiter=',')
@@ -309,3 +531,7 @@ if __name__ == "__main__":
     t1 = time.time()
 
     print(f'Total execution time {t1 - t0} s')
+
+    if run_failed:
+        print(f"{len(run_failed)} rules failed to run: {' '.join(sorted(run_failed))}")
+        exit(1)
@@ -17,21 +17,32 @@ Run GlobalFoundries 180nm MCU DRC SC Regression.
 
 Usage:
     run_sc_regression.py (--help| -h)
-    run_sc_regression.py (--path=<file_path>)... [--thr=<thr>]
+    run_sc_regression.py (--path=<file_path>)... [--thr=<thr>] [--batch=<servers>]
 
 Options:
     --help -h           Print this help message
     --path=<file_path>  The input GDS file path.
     --thr=<thr>         The number of threads used in run.
+    --batch=<servers>   Run the cells on this many DRC servers, each loads a library once for all its cells,
+                        instead of one klayout run per cell and rule deck.
 
 """
 from docopt import docopt
 import os
+import sys
 import xml.etree.ElementTree as ET
 import csv
 import time
+import subprocess
 import concurrent.futures
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from drc_catalog import get_rules, rule_names
+from drc_jobs import run_jobs
+from drc_server import start_server, request
+
+DRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
 
 def get_results(rule_deck_path, iname, file, x):
     """
@@ -67,6 +78,76 @@ def get_results(rule_deck_path, iname, file, x):
     print(f" The file {file[-1]} with rule deck {rule_deck[-1]} is {status} \n")
     return file[-1], rule_deck[-1], ' '.join(violated), status
 
+def list_cells(path):
+    """
+    Returns the names of all cells of a layout.
+    """
+    out = subprocess.run(["klayout", "-b", "-r", f"{DRC_DIR}/utils/get_cell_names.rb", "-rd", f"infile={path}"],
+                         capture_output=True, text=True, check=True).stdout
+    return [name for name in out.split("\n") if name.strip()]
+
+
+def run_batches(jobs, servers, thrCount):
+    """
+    Runs DRC jobs on a few DRC servers (utils/drc_server.rb) instead of one klayout process per job.
+
+    Each server keeps the layouts loaded and the rule decks read between its jobs, so a library is
+    loaded once per server and each cell is checked as the top cell of the library.
+
+    :param jobs: A list of (input path, top cell, rule deck path, report path) tuples, top cell None for the layout top cell
+    :param servers: The number of servers, the jobs are dealt round robin to them
+    :param thrCount: The total number of threads, shared by the servers
+    :return: The set of report paths of the jobs that failed, all of them if no server started.
+    """
+    servers = max(1, min(servers, len(jobs)))
+    thr = max(1, thrCount // servers)
+    layouts = len({path for path, _, _, _ in jobs})
+    script = f"{DRC_DIR}/utils/drc_server.rb"
+    socks = [f"/tmp/gf180mcu_sc_{os.getpid()}_{i}.sock" for i in range(servers)]
+    socks = [sock for sock in socks if start_server(sock, layouts, script)]
+    if not socks:
+        print("No DRC server started, all batched cells are reported as failed")
+        return {report for _, _, _, report in jobs}
+
+    failed = set()
+
+    def run_server_jobs(sock, server_jobs):
+        alive = True
+        for path, cell, runset, report in server_jobs:
+            # A stale report of an earlier run would hide a failed job
+            if os.path.exists(report):
+                os.remove(report)
+            if not alive:
+                failed.add(report)
+                continue
+            variables = {"input": os.path.abspath(path), "report": os.path.abspath(report), "thr": str(thr), "conn_drc": "true"}
+            if cell:
+                variables["topcell"] = cell
+            done = {}
+            try:
+                for answer in request(sock, {"cmd": "drc", "deck": os.path.abspath(runset), "vars": variables}):
+                    if answer.get("done"):
+                        done = answer
+            except (OSError, ValueError) as e:
+                done = {"error": f"server lost ({e})"}
+                # The server crashed on this cell, a new one checks the next cells
+                alive = start_server(sock, layouts, script)
+            if not done.get("ok"):
+                print(f"DRC of {cell or path} with {runset} failed: {done.get('error')}")
+                failed.add(report)
+
+    try:
+        run_jobs([(sock, thr, run_server_jobs, (sock, jobs[i::len(socks)])) for i, sock in enumerate(socks)], thrCount)
+    finally:
+        for sock in socks:
+            try:
+                for _ in request(sock, {"cmd": "stop"}):
+                    pass
+            except OSError:
+                pass
+    return failed
+
+
 def call_simulator(arg):
     """
     It runs the simulator with the given rule deck and input file, and saves the output to a database
@@ -90,31 +171,24 @@ if __name__ == "__main__":
 
     # Get threads count
     if args["--thr"]:
-        thrCount = args["--thr"][0]
+        thrCount = int(args["--thr"])
     else:
         thrCount = os.cpu_count() * 2
 
     os.system("klayout -v")
 
     rule_deck_path = []
-    rules = []
     runs = []
 
     files = os.listdir('..')
 
-    for file in files:
-        if ".drc" in file:
+    # Decks without rules (e.g. the dummy fill script) have nothing to check
+    for file in sorted(files):
+        if file.endswith(".drc") and rule_names([f"../{file}"]):
             rule_deck_path.append(f"../{file}")
 
     # Get rules names
-    for runset in rule_deck_path:
-        with open(runset, 'r') as f:
-            for line in f:
-                if 'GEOMETRY RULES' in line:
-                    break
-                if ".output" in line:
-                    line_list = line.split('"')
-                    rules.append(line_list[1])
+    rules = [r["name"] for r in get_rules(rule_deck_path, skip_sections=("GEOMETRY RULES",))]
 
     # Create GDS splitter script
     with open('split_gds.rb', 'w') as f:
@@ -131,54 +205,71 @@ if __name__ == "__main__":
                         ly2.write("sc/#{cell.name}.gds")
                     end''')
 
-    # Split standard cells top-cells into multiple gds files
+    # Split standard cells top-cells into multiple gds files, batched runs check them in the library
+    batch_jobs = []
+    batch_cells = []
     for path in args["--path"]:
         iname = path.split('.gds')
         file = iname[0].split('/')
-        if "sc" in file[-1]:
+        if "sc" in file[-1] and args["--batch"]:
+            os.makedirs("sc", exist_ok=True)
+            for cell in list_cells(path):
+                batch_cells.append(f"{cell}.gds")
+                for x, runset in enumerate(rule_deck_path):
+                    batch_jobs.append((path, cell, runset, f"sc/{cell}_{x}.lyrdb"))
+        elif "sc" in file[-1]:
             os.system(f"klayout -b -r split_gds.rb -rd input={path}")
             print(f"File {path} was splitted into multiple gds files")
 
+    # The split libraries themselves aren't checked, their cells are
+    libraries = [path for path in args["--path"] if "sc" in path.split('.gds')[0].split('/')[-1]]
+
     if os.path.exists("sc"):
         other_files = os.listdir('sc')
-        args["--path"] = args["--path"] + other_files
+        args["--path"] = args["--path"] + other_files + batch_cells
 
     # Get input data for simulator
     for path in args["--path"]:
         x = 0
-        iname = path.split('.gds')
-        file = iname[0].split('/')
-        if "sc" in file[-1]:
+        if path in libraries:
             continue
         if "/" not in path:
             path = f"sc/{path}"
         iname = path.split('.gds')
         file = iname[0].split('/')
         for runset in rule_deck_path:
-            arg = f"klayout -b -r {runset} -rd input={path} -rd report={file[-1]}_{x}.lyrdb -rd thr={thrCount} -rd conn_drc=true"
-            runs.append(arg)
+            if args["--batch"]:
+                if not path.startswith("sc/"):
+                    batch_jobs.append((path, None, runset, f"{iname[0]}_{x}.lyrdb"))
+            else:
+                arg = f"klayout -b -r {runset} -rd input={path} -rd report={file[-1]}_{x}.lyrdb -rd thr={thrCount} -rd conn_drc=true"
+                runs.append(arg)
             x += 1
 
     # Run DRC
-    with concurrent.futures.ProcessPoolExecutor(max_workers=thrCount) as executor:
-        for run in runs:
-            executor.submit(call_simulator, run)
+    failed = set()
+    if args["--batch"]:
+        failed = run_batches(batch_jobs, int(args["--batch"]), thrCount)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=thrCount) as executor:
+            for run in runs:
+                executor.submit(call_simulator, run)
 
     # Get results
     for path in args["--path"]:
         x = 0
-        iname = path.split('.gds')
-        file = iname[0].split('/')
-        if "sc" in file[-1]:
+        if path in libraries:
             continue
         if "/" not in path:
             path = f"sc/{path}"
         iname = path.split('.gds')
         file = iname[0].split('/')
         for runset in rule_deck_path:
-            if os.path.exists(f"{iname[0]}_{x}.lyrdb"):
-                file, rule_deck, violations, status = get_results(runset, iname, file, x)
-                report.append([file, rule_deck, violations, status])
+            if f"{iname[0]}_{x}.lyrdb" in failed:
+                report.append([file[-1], runset.split("../")[-1], "", "Failed"])
+            elif os.path.exists(f"{iname[0]}_{x}.lyrdb"):
+                file_name, rule_deck, violations, status = get_results(runset, iname, file, x)
+                report.append([file_name, rule_deck, violations, status])
             x += 1
 
     with open(f'sc_drc_report.csv', 'w') as f:
@@ -193,3 +284,7 @@ if __name__ == "__main__":
 
     t1 = time.time()
     print(f'Total execution time {t1 - t0} s')
+
+    if failed:
+        print(f"{len(failed)} cell runs failed, see the Failed rows of sc_drc_report.csv")
+        exit(1)
@@ -12,103 +12,151 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+"""
+Run GlobalFoundries 180nm MCU DRC Switch Checking.
+
+Usage:
+    run_switch_checking.py (--help| -h)
+    run_switch_checking.py [--full_matrix] [--thr=<thr>] [--jobs_thr=<jobs_thr>]
+
+Options:
+    --help -h                           Print this help message.
+    --full_matrix                       Check every combination of the switches, not only one case per switch.
+    --thr=<thr>                         The number of threads shared by all cases. Default is the number of CPUs.
+    --jobs_thr=<jobs_thr>               The number of threads of each case. [default: 1]
+
+Each case runs run_drc.py on switch_checking/simple_por.gds.gz in its own directory of
+switch_checking/run_switch_results, all cases at once within the thread budget. The log of
+each case is matched against the lines the rule decks print for its switches (e.g.
+"FEOL is disabled."), the results are written to switch_checking/run_switch_results/results.csv.
+"""
+
+from docopt import docopt
 import os
-import pandas as pd
-import subprocess
+import re
+import sys
+import csv
+import time
+import shutil
 import logging
-import warnings
-warnings.simplefilter(action='ignore', category=FutureWarning)
-
-# ======================  Generation of switches patterns ====================================
-def gen_patterns():
-
-    switches = [ "--gf180mcu=A --no_feol"
-    , "--gf180mcu=A --no_beol"
-    ,"--gf180mcu=A"
-    ,"--gf180mcu=B"
-    ,"--gf180mcu=C"
-    ,"--gf180mcu=C  --connectivity"
-    , "--gf180mcu=A --no_offgrid"
-    ]
-
-    expected_logs = [ "FEOL is disabled"
-    ,"BEOL is disabled"
-    ,"METAL_TOP Selected is 30K"
-    ,"METAL_TOP Selected is 9K"
-    , "connectivity rules are disabled"
-    , "Offgrid enabled  false"
-    ]
-
-    mydataset = {'test_case_name': [ switches[0]+"_switch" ],
-                'switches': [ switches[0]],
-                'expected_output':['pass'],
-                'expected_logs':[ expected_logs[0]]
-                }
-
-    initial_dataframe = pd.DataFrame(mydataset)
-
-    for i,switch in enumerate(switches [1: len(switches)]):
-
-        add_list = {'test_case_name':switch+"_switch",'switches':switch,'expected_output':'pass', 'expected_logs':expected_logs[i]}
-        initial_dataframe = initial_dataframe.append(add_list,ignore_index=True)
-
-    initial_dataframe[["test_case_name","switches","expected_output","expected_logs"]].to_csv("pattern.csv",index=False)
-
-
-
-# ================================== Running patterns and checking results ==================================
-
-
-def run_switches():
-
-    RUN_DIRECTORY = "switch_checking/run_switch_results/"
-    csv_path = "pattern.csv"
-    PASS = "pass"
-    FAIL = "fail"
-    ERROR_MESSEGE = "More than one variable for"
-    LOG_FILE_NAME = "run.log"
-
-    def run_test_case(test_case, switches, expected_result,expected_log):
-        test_case = test_case.split("--")[-1]
-        run_directory = RUN_DIRECTORY + test_case
-        os.system('mkdir -p {0}'.format(run_directory))
-
-        log_file = run_directory + "/" + test_case + ".log"
-        os.system('python3 ../run_drc.py --path=switch_checking/simple_por.gds.gz {0} >> {1}'.format(switches, log_file))
-
-        check_output_log(log_file, expected_result)
-
-    def check_output_log(log_file, expected_result):
-        proc = subprocess.Popen('grep -irn "{0}" {1}'.format(expected_log, log_file), shell=True, stdout=subprocess.PIPE)
-        (out, err) = proc.communicate()
-        out = str(out.decode())
-        if len(out) == 0 and expected_result == PASS:
-            logging.info("Test case passed.")
-            os.system('echo Test case passed. >> {0}{1}'.format(RUN_DIRECTORY,LOG_FILE_NAME))
-        else:
-            logging.error("Test case FAILD check log file for more info.")
-            os.system('echo Test case FAILD check log file for more info. >> {0}{1}'.format(RUN_DIRECTORY,LOG_FILE_NAME))
-
-    ## read testcases from csv file
-    df = pd.read_csv(csv_path)
-    test_cases = df["test_case_name"]
-    switches = df["switches"]
-    expected_results = df["expected_output"]
-    expected_log = df["expected_logs"]
-
-    ## init log file
-    os.system('mkdir -p {0}'.format(RUN_DIRECTORY))
-    os.system('touch {0}temp.log'.format(RUN_DIRECTORY))
-    os.system('mv -f {0}temp.log {0}{1}'.format(RUN_DIRECTORY,LOG_FILE_NAME))
-
-    for test_case_index in range(0,len(test_cases)):
-        test_case_switches = switches[test_case_index]
-
-        running_msg = "\nrunning: "+test_cases[test_case_index] + "     with switches: " + test_case_switches + "..."
-        logging.info(running_msg)
-        os.system('echo "{0}" >> {1}{2}'.format(running_msg, RUN_DIRECTORY, LOG_FILE_NAME))
+import itertools
+import subprocess
 
-        run_test_case(test_cases[test_case_index], test_case_switches, expected_results[test_case_index],expected_log[test_case_index])
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from drc_jobs import run_jobs
+
+TESTING_DIR = os.path.dirname(os.path.abspath(__file__))
+RUN_DIRECTORY = os.path.join(TESTING_DIR, "switch_checking", "run_switch_results")
+TEST_LAYOUT = os.path.join(TESTING_DIR, "switch_checking", "simple_por.gds.gz")
+RUN_DRC = os.path.join(TESTING_DIR, "..", "run_drc.py")
+
+# Stack selected by each --gf180mcu option: (metal top, MIM option, metal level)
+GF180MCU_OPTIONS = {"A": ("30K", "A", "3LM"),
+                    "B": ("11K", "B", "4LM"),
+                    "C": ("9K", "B", "5LM")}
+
+# Flags of run_drc.py and the lines the rule decks print when they are (True) or aren't (False) given
+SWITCH_LOGS = {"--no_feol":      {True: "FEOL is disabled.", False: "FEOL is enabled."},
+               "--no_beol":      {True: "BEOL is disabled.", False: "BEOL is enabled."},
+               "--connectivity": {True: "connectivity rules are enabled.", False: "connectivity rules are disabled."},
+               "--no_offgrid":   {True: "Offgrid enabled  false", False: "Offgrid enabled  true"}}
+
+# Lines that fail any case
+ERROR_LOGS = [re.compile(r"More than one variable for"), re.compile(r"^ERROR", re.MULTILINE)]
+
+# One case per switch, as checked on every commit
+BASIC_CASES = [("A", ["--no_feol"]),
+               ("A", ["--no_beol"]),
+               ("A", []),
+               ("B", []),
+               ("C", []),
+               ("C", ["--connectivity"]),
+               ("A", ["--no_offgrid"])]
+
+
+def gen_patterns(full_matrix):
+    """
+    Returns the switch checking cases.
+
+    :param full_matrix: Every combination of the --gf180mcu options and the flags, instead of one case per switch
+    :return: A list of (case name, run_drc.py switches, {expected log line: compiled pattern}) tuples.
+    """
+    if full_matrix:
+        cases = [(option, [flag for flag, used in zip(SWITCH_LOGS, flags) if used])
+                 for option in GF180MCU_OPTIONS
+                 for flags in itertools.product([False, True], repeat=len(SWITCH_LOGS))]
+    else:
+        cases = BASIC_CASES
+
+    patterns = []
+    for option, flags in cases:
+        metal_top, mim_option, metal_level = GF180MCU_OPTIONS[option]
+        expected = [f"METAL_TOP Selected is {metal_top}",
+                    f"MIM Option selected {mim_option}",
+                    f"METAL_STACK Selected is {metal_level}"]
+        expected += [logs[flag in flags] for flag, logs in SWITCH_LOGS.items()]
+
+        name = "_".join([f"gf180mcu_{option}"] + [flag.strip("-") for flag in flags])
+        switches = [f"--gf180mcu={option}"] + flags
+        patterns.append((name, switches, {line: re.compile(re.escape(line)) for line in expected}))
+    return patterns
+
+
+def run_test_case(name, switches, expected, thr):
+    """
+    Runs run_drc.py for one case in its own directory and matches its log.
+
+    :param name: The case name, also the name of its run directory
+    :param switches: The run_drc.py switches of the case
+    :param expected: The log lines expected for the switches, with their compiled patterns
+    :param thr: The number of threads of the run
+    :return: A dict with the case results.
+    """
+    run_directory = os.path.join(RUN_DIRECTORY, name)
+    os.makedirs(run_directory, exist_ok=True)
+    layout = os.path.join(run_directory, os.path.basename(TEST_LAYOUT))
+    shutil.copyfile(TEST_LAYOUT, layout)
+
+    # Cached runs don't run the decks, so they print nothing to match
+    t0 = time.time()
+    proc = subprocess.run([sys.executable, RUN_DRC, f"--path={layout}", f"--thr={thr}", "--no_cache"] + switches,
+                          cwd=run_directory, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    log = proc.stdout
+
+    with open(os.path.join(run_directory, f"{name}.log"), "w") as f:
+        f.write(log)
+
+    missing = [line for line, pattern in expected.items() if not pattern.search(log)]
+    errors = [match.group(0) for match in (pattern.search(log) for pattern in ERROR_LOGS) if match]
+    status = "pass" if not missing and not errors and proc.returncode == 0 else "fail"
+
+    if status == "pass":
+        logging.info(f"Test case {name} passed.")
+    else:
+        logging.error(f"Test case {name} failed, check {run_directory}/{name}.log for more info.")
+
+    return {"test_case_name": name, "switches": " ".join(switches), "status": status,
+            "return_code": proc.returncode, "missing_logs": "; ".join(missing),
+            "error_logs": "; ".join(errors), "seconds": f"{time.time() - t0:.1f}"}
+
+
+def run_switches(patterns, thr_budget, jobs_thr):
+    """
+    Runs all cases at once within the thread budget.
+
+    :return: A list of case result dicts, in the order of the cases.
+    """
+    shutil.rmtree(RUN_DIRECTORY, ignore_errors=True)
+    os.makedirs(RUN_DIRECTORY)
+
+    jobs = [(name, jobs_thr, run_test_case, (name, switches, expected, jobs_thr)) for name, switches, expected in patterns]
+    results = run_jobs(jobs, thr_budget)
+
+    rows = []
+    for name, switches, _ in patterns:
+        rows.append(results[name] or {"test_case_name": name, "switches": " ".join(switches), "status": "fail",
+                                      "return_code": "", "missing_logs": "", "error_logs": "run failed", "seconds": ""})
+    return rows
 
 
 def main():
@@ -116,14 +164,26 @@ def main():
     # logs format
     logging.basicConfig(level=logging.DEBUG, format=f"%(asctime)s | %(levelname)-7s | %(message)s", datefmt='%d-%b-%Y %H:%M:%S')
 
-    # Remove old files
-    os.system("rm -rf patterns.csv switch_checking/run_switch_results")
-
-    # Gen. patterns
-    gen_patterns ()
-
-    # Run. switches
-    run_switches ()
+    arguments = docopt(__doc__)
+    thr_budget = int(arguments["--thr"]) if arguments["--thr"] else os.cpu_count()
+    jobs_thr = int(arguments["--jobs_thr"])
+
+    t0 = time.time()
+    patterns = gen_patterns(arguments["--full_matrix"])
+    logging.info(f"Running {len(patterns)} switch checking cases.")
+    rows = run_switches(patterns, thr_budget, jobs_thr)
+
+    results_path = os.path.join(RUN_DIRECTORY, "results.csv")
+    with open(results_path, "w") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    failed = [row["test_case_name"] for row in rows if row["status"] != "pass"]
+    logging.info(f"{len(rows) - len(failed)} of {len(rows)} cases passed in {time.time() - t0:.1f} s, results at {results_path}")
+    if failed:
+        logging.error(f"Failed cases: {' '.join(failed)}")
+        exit(1)
 
 if __name__ == "__main__":
     main()
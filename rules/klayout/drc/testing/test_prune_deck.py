@@ -0,0 +1,68 @@
+# Copyright 2022 GlobalFoundries PDK Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Checks that the pruned rule decks (quick profile, generated shards, regression decks)
+still define every layer they read:
+    python3 -m pytest test_prune_deck.py
+"""
+
+import os
+import sys
+
+import pytest
+
+DRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(DRC_DIR)
+from drc_catalog import load_deck, prune_deck, rule_names, undefined_reads
+
+DECKS = ["gf180mcu.drc", "gf180mcu_antenna.drc", "gf180mcu_density.drc"]
+
+# Rules whose layers are filled by x.data.insert loops, and a sample of the others
+INSERT_RULES = ["MIM.11", "MIMTM.11"]
+SAMPLE_STEP = 40
+
+
+def deck_names(deck):
+    catalog = load_deck(deck)
+    return set(catalog["derived"]) | set(catalog["layers"])
+
+
+@pytest.fixture(autouse=True)
+def cache(tmp_path, monkeypatch):
+    # Keeps the parsed catalogs out of the user cache
+    monkeypatch.setenv("GF180MCU_DRC_CACHE", str(tmp_path / "cache"))
+
+
+@pytest.mark.parametrize("deck", DECKS)
+def test_full_deck_defines_its_reads(deck):
+    deck = os.path.join(DRC_DIR, deck)
+    assert undefined_reads(deck, deck_names(deck)) == {}
+
+
+@pytest.mark.parametrize("deck", DECKS)
+@pytest.mark.parametrize("prune_layers", [False, True])
+def test_pruned_decks_define_their_reads(deck, prune_layers, tmp_path):
+    deck = os.path.join(DRC_DIR, deck)
+    names = deck_names(deck)
+    rules = rule_names([deck])
+    sample = [r for r in INSERT_RULES if r in rules] + rules[::SAMPLE_STEP]
+    output = str(tmp_path / "pruned.drc")
+
+    for rule in sample:
+        # One rule alone (micro runs, shards) and all rules but one (quick profile)
+        for keep in [{rule}, set(rules) - {rule}]:
+            prune_deck(deck, keep, output, prune_layers=prune_layers)
+            assert undefined_reads(output, names) == {}, f"{os.path.basename(deck)} pruned to {len(keep)} rules around {rule}"
+            assert set(rule_names([output])) == keep
@@ -0,0 +1,60 @@
+# Copyright 2022 GlobalFoundries PDK Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Bounded report output, loaded by the rule decks when -rd max_markers_per_rule=N is given.
+# A rule with more than N markers still counts all of them, but only a reservoir sample of
+# N markers is written to the report. The category description of such a rule ends with
+# "[N of M markers kept]", the runners read the exact count M from it.
+
+unless DRC::DRCLayer.method_defined?(:unbounded_output)
+
+  class DRC::DRCLayer
+
+    alias_method :unbounded_output, :output
+
+    def output(*args)
+      cap = $max_markers_per_rule.to_i
+      if cap <= 0 || !args[0].is_a?(String)
+        return unbounded_output(*args)
+      end
+
+      total = self.data.count
+      if total <= cap
+        return unbounded_output(*args)
+      end
+
+      # Reservoir sampling, one pass over the markers whatever their number
+      random = Random::new(cap)
+      sample = []
+      seen = 0
+      self.data.each do |marker|
+        if seen < cap
+          sample << marker
+        else
+          j = random.rand(seen + 1)
+          sample[j] = marker if j < cap
+        end
+        seen += 1
+      end
+
+      kept = self.data.class::new
+      sample.each { |marker| kept.insert(marker) }
+
+      description = "#{args[1] || args[0]} [#{cap} of #{total} markers kept]"
+      DRC::DRCLayer::new(@engine, kept).unbounded_output(args[0], description, *args[2..-1])
+    end
+
+  end
+
+end
@@ -0,0 +1,216 @@
+# Copyright 2022 GlobalFoundries PDK Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Long-lived DRC/LVS server, started by drc_server.py:
+#   klayout -b -r drc_server.rb -rd socket=/tmp/gf180mcu_drc.sock -rd max_layouts=4
+#
+# Requests are one JSON line per connection:
+#   {"cmd": "drc"|"lvs", "deck": path, "vars": {"input": path, "report": path, ...}}
+#   {"cmd": "status"} / {"cmd": "stop"}
+# Answers are JSON lines, {"log": line} for the run log (sent while the job runs), {"rule": name, "count": n} for
+# each violated rule and a final {"done": true, ...} line.
+
+require 'socket'
+require 'json'
+require 'digest'
+require 'time'
+
+$socket ||= "/tmp/gf180mcu_drc.sock"
+$max_layouts = ($max_layouts || 4).to_i
+
+# Layouts are kept loaded between runs, keyed by path, checked against mtime and file hash
+class LayoutCache
+
+  def initialize(max_layouts)
+    @max_layouts = max_layouts
+    @layouts = {}
+  end
+
+  def get(path)
+    path = File.expand_path(path)
+    stat = File.stat(path)
+    entry = @layouts.delete(path)
+
+    if entry && (entry[:mtime] != stat.mtime || entry[:size] != stat.size)
+      # Touched but maybe not changed, the hash decides
+      hash = Digest::SHA1.file(path).hexdigest
+      entry = nil if hash != entry[:hash]
+    end
+
+    hit = !entry.nil?
+    if !entry
+      layout = RBA::Layout::new
+      layout.read(path)
+      entry = { :layout => layout, :hash => Digest::SHA1.file(path).hexdigest }
+    end
+    entry[:mtime] = stat.mtime
+    entry[:size] = stat.size
+
+    @layouts[path] = entry
+    while @layouts.size > @max_layouts
+      @layouts.delete(@layouts.keys.first)._destroy rescue nil
+    end
+    return entry[:layout], hit
+  end
+
+  def status
+    @layouts.map { |path, e| { "path" => path, "hash" => e[:hash], "mtime" => e[:mtime].to_s } }
+  end
+
+end
+
+# Makes source(file, cell) of the rule decks use the cached layouts
+module CachedSource
+
+  def source(arg = nil, arg2 = nil)
+    if arg.is_a?(String) && File.exist?(arg)
+      layout, hit = $layout_cache.get(arg)
+      $cache_hit = hit
+      return arg2 ? super(layout, arg2) : super(layout)
+    end
+    arg ? (arg2 ? super(arg, arg2) : super(arg)) : super()
+  end
+
+end
+
+$layout_cache = LayoutCache::new($max_layouts)
+$deck_cache = {}
+$job_vars = []
+
+def deck_text(deck)
+  mtime = File.mtime(deck)
+  entry = $deck_cache[deck]
+  if !entry || entry[0] != mtime
+    entry = [mtime, File.read(deck)]
+    $deck_cache[deck] = entry
+  end
+  entry[1]
+end
+
+def set_job_vars(vars)
+  # The decks read their switches from globals, as set by -rd on the command line
+  $job_vars.each { |name| eval("$#{name} = nil") }
+  $job_vars = []
+  vars.each do |name, value|
+    next if name !~ /\A[a-z_][a-z0-9_]*\z/i
+    eval("$#{name} = #{value.to_s.inspect}")
+    $job_vars << name
+  end
+end
+
+# Sends the lines of a job log to the client while the job writes it, until the thread is told to stop
+def follow_log(log, client)
+  Thread::new do
+    File.open(log, "r") do |f|
+      buffer = ""
+      loop do
+        # Checked before reading, the lines written before the stop are still sent
+        stop = Thread.current[:stop]
+        data = f.read
+        buffer << data
+        lines = buffer.split("\n", -1)
+        buffer = lines.pop
+        lines.each { |line| client.puts({ "log" => line }.to_json) }
+        if data.empty?
+          break if stop
+          sleep 0.2
+        end
+      end
+      client.puts({ "log" => buffer }.to_json) unless buffer.empty?
+    end
+  end
+end
+
+def run_job(req, client)
+  deck = req["deck"]
+  vars = req["vars"] || {}
+  log = vars["report"] ? "#{vars["report"]}.log" : "#{$socket}.job.log"
+  start = Time.now
+  error = nil
+  $cache_hit = false
+
+  set_job_vars(vars)
+  engine = req["cmd"] == "lvs" ? LVS::LVSEngine::new : DRC::DRCEngine::new
+  engine.singleton_class.prepend(CachedSource)
+
+  # The decks log to STDOUT, it is redirected to the job log while the deck runs and followed from there
+  saved = STDOUT.dup
+  STDOUT.reopen(log, "w")
+  STDOUT.sync = true
+  follower = follow_log(log, client)
+  begin
+    engine._start("#{req["cmd"]} server job") if engine.respond_to?(:_start)
+    engine.instance_eval(deck_text(deck), deck)
+  rescue Exception => e
+    error = e.to_s
+  ensure
+    begin
+      engine._finish if engine.respond_to?(:_finish)
+    rescue Exception => e
+      error ||= e.to_s
+    end
+    STDOUT.flush
+    STDOUT.reopen(saved)
+    saved.close
+    follower[:stop] = true
+    follower.join
+  end
+
+  done = { "done" => true, "ok" => error.nil?, "error" => error, "report" => vars["report"],
+           "cached" => $cache_hit, "seconds" => Time.now - start }
+
+  if req["cmd"] == "drc" && vars["report"] && File.exist?(vars["report"])
+    rdb = RBA::ReportDatabase::new("")
+    rdb.load(vars["report"])
+    total = 0
+    rdb.each_category do |cat|
+      next if cat.num_items == 0
+      client.puts({ "rule" => cat.name, "count" => cat.num_items }.to_json)
+      total += cat.num_items
+    end
+    done["violations"] = total
+  end
+
+  client.puts(done.to_json)
+end
+
+File.delete($socket) if File.exist?($socket)
+server = UNIXServer::new($socket)
+puts "GF180MCU DRC server listening on #{$socket}"
+
+loop do
+  client = server.accept
+  begin
+    req = JSON.parse(client.gets || "{}")
+    case req["cmd"]
+    when "drc", "lvs"
+      run_job(req, client)
+    when "status"
+      client.puts({ "done" => true, "ok" => true, "pid" => Process.pid, "layouts" => $layout_cache.status }.to_json)
+    when "stop"
+      client.puts({ "done" => true, "ok" => true }.to_json)
+      client.close
+      break
+    else
+      client.puts({ "done" => true, "ok" => false, "error" => "Unknown command #{req["cmd"]}" }.to_json)
+    end
+  rescue Exception => e
+    client.puts({ "done" => true, "ok" => false, "error" => e.to_s }.to_json) rescue nil
+  ensure
+    client.close unless client.closed?
+  end
+end
+
+server.close
+File.delete($socket) if File.exist?($socket)
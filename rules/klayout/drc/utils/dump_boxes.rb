@@ -0,0 +1,50 @@
+# Copyright 2022 GlobalFoundries PDK Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Dumps the flat merged shapes of some layers as rectangles, for the numpy checks of drc_via_check.py:
+#   klayout -b -r dump_boxes.rb -rd infile=design.gds -rd vias=33/0,35/0 -rd metals=34/0 -rd outdir=boxes [-rd topcell=top]
+# Each layer is merged. The via layers are written polygon by polygon, the metal layers are decomposed
+# into horizontal trapezoids first. The rectangles are written to <outdir>/<layer>_<datatype>.boxes and
+# the bounding boxes of the other polygons (odd vias, non manhattan metal) to <outdir>/<layer>_<datatype>.other,
+# as little endian int32 (left, bottom, right, top) in dbu.
+# Prints the database unit and the top cell name as JSON.
+
+require 'json'
+
+layout = RBA::Layout::new
+layout.read($infile)
+top = $topcell ? layout.cell($topcell) : layout.top_cell
+
+def dump_layer(layout, top, spec, decompose)
+  l, d = spec.split("/").collect { |v| v.to_i }
+  boxes = []
+  other = []
+  li = layout.find_layer(l, d)
+  if li
+    region = RBA::Region::new(top.begin_shapes_rec(li))
+    region.merge
+    region = region.decompose_trapezoids_to_region(RBA::Polygon::TD_htrapezoids) if decompose
+    region.each do |poly|
+      b = poly.bbox
+      (poly.is_box? ? boxes : other).push(b.left, b.bottom, b.right, b.top)
+    end
+  end
+  File.open(File.join($outdir, "#{l}_#{d}.boxes"), "wb") { |f| f.write(boxes.pack("l<*")) }
+  File.open(File.join($outdir, "#{l}_#{d}.other"), "wb") { |f| f.write(other.pack("l<*")) }
+end
+
+($vias || "").split(",").each { |spec| dump_layer(layout, top, spec, false) }
+($metals || "").split(",").each { |spec| dump_layer(layout, top, spec, true) }
+
+puts({ "dbu" => layout.dbu, "top_cell" => top.name }.to_json)
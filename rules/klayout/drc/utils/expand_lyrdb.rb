@@ -0,0 +1,83 @@
+# Copyright 2022 GlobalFoundries PDK Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Expands the per cell markers of a deep mode report to every placement of their cell:
+#   klayout -b -r expand_lyrdb.rb -rd infile=design.gds -rd report=design.lyrdb -rd outfile=design_expanded.lyrdb [-rd topcell=top]
+# All markers of the output report are in top cell coordinates.
+
+layout = RBA::Layout::new
+layout.read($infile)
+top = $topcell ? layout.cell($topcell) : layout.top_cell
+
+rdb = RBA::ReportDatabase::new("")
+rdb.load($report)
+
+out = RBA::ReportDatabase::new(rdb.description)
+out.generator = rdb.generator
+out.top_cell_name = top.name
+out_top = out.create_cell(top.name)
+
+categories = {}
+rdb.each_category do |cat|
+  categories[cat.rdb_id] = out.create_category(cat.name)
+  categories[cat.rdb_id].description = cat.description
+end
+
+def transformed_value(value, t)
+  if value.is_polygon?
+    RBA::RdbItemValue::new(value.polygon.transformed(t))
+  elsif value.is_box?
+    RBA::RdbItemValue::new(value.box.transformed(t))
+  elsif value.is_edge?
+    RBA::RdbItemValue::new(value.edge.transformed(t))
+  elsif value.is_edge_pair?
+    RBA::RdbItemValue::new(value.edge_pair.transformed(t))
+  elsif value.is_path?
+    RBA::RdbItemValue::new(value.path.transformed(t))
+  elsif value.is_text?
+    RBA::RdbItemValue::new(value.text.transformed(t))
+  else
+    value
+  end
+end
+
+expanded = 0
+rdb.each_cell do |rdb_cell|
+  cell = layout.cell(rdb_cell.name)
+  next if cell.nil?
+
+  # Transformations of all placements of the cell into the top cell, in um
+  if cell.cell_index == top.cell_index
+    placements = [RBA::DCplxTrans::new]
+  else
+    placements = []
+    iter = top.begin_instances_rec
+    iter.targets = [cell.cell_index]
+    while !iter.at_end?
+      placements << iter.dtrans * iter.inst_dtrans
+      iter.next
+    end
+  end
+
+  rdb.each_item_per_cell(rdb_cell.rdb_id) do |item|
+    placements.each do |t|
+      new_item = out.create_item(out_top.rdb_id, categories[item.category_id].rdb_id)
+      item.each_value { |v| new_item.add_value(transformed_value(v, t)) }
+      expanded += 1
+    end
+  end
+end
+
+out.save($outfile)
+puts expanded
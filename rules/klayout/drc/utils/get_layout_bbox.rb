@@ -0,0 +1,26 @@
+# Copyright 2022 GlobalFoundries PDK Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+layout = RBA::Layout::new
+layout.read($infile)
+
+if $topcell
+  top = layout.cell($topcell)
+else
+  top = layout.top_cell
+end
+
+# left bottom right top in um
+box = top.dbbox
+puts "#{box.left} #{box.bottom} #{box.right} #{box.top}"
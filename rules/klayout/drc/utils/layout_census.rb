@@ -0,0 +1,69 @@
+# Copyright 2022 GlobalFoundries PDK Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Prints the census of a layout as JSON, without running any rule:
+#   klayout -b -r layout_census.rb -rd infile=design.gds [-rd topcell=top]
+# Shape counts are given per layer in the hierarchy (each cell counted once) and
+# flat (each cell counted once per placement), their ratio is the hierarchy reuse.
+# The placements give the number of flat placements of each cell under the top cell.
+
+require 'json'
+
+layout = RBA::Layout::new
+layout.read($infile)
+
+top = $topcell ? layout.cell($topcell) : layout.top_cell
+
+# Number of flat placements of each cell under the top cell
+placements = Hash::new(0)
+placements[top.cell_index] = 1
+instances = 0
+layout.each_cell_top_down do |ci|
+  next if placements[ci] == 0
+  layout.cell(ci).each_inst do |inst|
+    n = placements[ci] * inst.cell_inst.size
+    placements[inst.cell_index] += n
+    instances += n
+  end
+end
+
+layers = {}
+layout.layer_indexes.each do |li|
+  info = layout.get_info(li)
+  hier = 0
+  flat = 0
+  placements.each do |ci, n|
+    count = layout.cell(ci).shapes(li).size
+    hier += count
+    flat += count * n
+  end
+  next if hier == 0
+  layers["#{info.layer}/#{info.datatype}"] = { "shapes" => hier, "flat_shapes" => flat }
+end
+
+box = top.dbbox
+census = {
+  "top_cell" => top.name,
+  "dbu" => layout.dbu,
+  "bbox" => [box.left, box.bottom, box.right, box.top],
+  "area_um2" => box.width * box.height,
+  "cells" => placements.size,
+  "instances" => instances,
+  "shapes" => layers.values.sum { |l| l["shapes"] },
+  "flat_shapes" => layers.values.sum { |l| l["flat_shapes"] },
+  "layers" => layers,
+  "placements" => placements.map { |ci, n| [layout.cell(ci).name, n] }.to_h
+}
+
+puts census.to_json
@@ -0,0 +1,45 @@
+# Copyright 2022 GlobalFoundries PDK Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Builds a scaled-up synthetic design from a seed layout
+#   klayout -b -r scale_layout.rb -rd infile=seed.gds -rd outfile=seed_x16.gds -rd copies=16 [-rd flat=true]
+
+layout = RBA::Layout::new
+layout.read($infile)
+
+seed = layout.top_cell
+copies = ($copies || 4).to_i
+cols = Math.sqrt(copies).ceil
+rows = (copies.to_f / cols).ceil
+
+# 10% spacing between copies, so the copies don't interact
+box = seed.bbox
+dx = (box.width * 1.1).to_i
+dy = (box.height * 1.1).to_i
+
+top = layout.create_cell("#{seed.name}_x#{copies}")
+placed = 0
+rows.times do |r|
+  cols.times do |c|
+    next if placed >= copies
+    top.insert(RBA::CellInstArray::new(seed.cell_index, RBA::Trans::new(c * dx - box.left, r * dy - box.bottom)))
+    placed += 1
+  end
+end
+
+# A flat design has no hierarchy for deep mode to exploit
+top.flatten(true) if $flat == "true"
+
+layout.write($outfile)
+puts top.name
@@ -0,0 +1,61 @@
+# Copyright 2022 GlobalFoundries PDK Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Splits a regression testcase into one small layout per rule, for the micro runs of run_regression.py:
+#   klayout -b -r split_rule_testcases.rb -rd infile=testcase.gds -rd rules=rules.json -rd outdir=micro [-rd margin=5]
+# rules.json maps each rule to its label texts on layer (11, 222), e.g. {"DN.1": ["DN.1"], "DV.2_3.3V": ["DV.2_LV"]}.
+# The test structures of a rule are the (2, 222) and (3, 222) polygons touching its labels. The layout is clipped
+# to their bounding box enlarged by margin um and written with all layers to <outdir>/<rule>.gds.
+# Prints a JSON dict of {rule: gds file} for the rules that have test structures.
+
+require 'json'
+
+layout = RBA::Layout::new
+layout.read($infile)
+top = layout.top_cell
+margin = (($margin || "5").to_f / layout.dbu).round
+
+def layer_region(layout, top, l, d)
+  li = layout.find_layer(l, d)
+  li ? RBA::Region::new(top.begin_shapes_rec(li)) : RBA::Region::new
+end
+
+li = layout.find_layer(11, 222)
+labels = li ? RBA::Texts::new(top.begin_shapes_rec(li)) : RBA::Texts::new
+structures = layer_region(layout, top, 2, 222) + layer_region(layout, top, 3, 222)
+# Abutting structures of different rules stay apart
+structures.merged_semantics = false
+
+rules = JSON.parse(File.read($rules))
+files = {}
+
+rules.each do |rule, texts|
+  box = RBA::Box::new
+  texts.each do |text|
+    box += structures.interacting(labels.with_text(text, false)).bbox
+  end
+  next if box.empty?
+
+  clip = layout.clip(top.cell_index, box.enlarged(margin, margin))
+  options = RBA::SaveLayoutOptions::new
+  options.select_cell(clip)
+  path = File.join($outdir, "#{rule.gsub(/[^\w.+-]/, "_")}.gds")
+  layout.write(path, options)
+  files[rule] = path
+
+  # The clip shares the cells that are fully inside it with the testcase
+  layout.prune_cell(clip, -1)
+end
+
+puts files.to_json
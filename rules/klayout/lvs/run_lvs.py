@@ -45,9 +45,13 @@ from docopt import docopt
 import os
 import logging
 
-def main():
+def build_switches(args):
+    """
+    It builds the klayout switches of the LVS rule deck from the script arguments.
 
-    # Switches used in run
+    :param args: The docopt arguments of the script
+    :return: The switches string passed to klayout.
+    """
     switches = ''
 
     if args["--run_mode"] in ["flat" , "deep", "tiling"]:
@@ -89,6 +93,12 @@ def main():
 
     switches = switches + f'-rd lvs_sub={args["--lvs_sub"]} ' if args["--lvs_sub"] else switches
 
+    return switches
+
+def main():
+
+    # Switches used in run
+    switches = build_switches(args)
 
     # Generate databases
     if args["--design"]: